@@ -162,6 +162,16 @@ tf = LazyLoader('tensorflow', globals(), 'tensorflow')
 
 ######### GENERAL METHODS #########
 
+def _channels_first_float(array):
+    """Converts a channels-last array to a contiguous channels-first float
+    tensor, doing the layout and dtype conversion in a single pass."""
+    source = torch.from_numpy(array)
+    source = source.permute(0, 3, 1, 2) if source.ndim == 4 \
+        else source.permute(2, 0, 1)
+    out = torch.empty(source.shape, dtype = torch.float32)
+    return out.copy_(source)
+
+
 def _convert_image_to_torch(image):
     """Converts an image (np.ndarray) to a torch Tensor."""
     if isinstance(image, (list, tuple)):
@@ -169,10 +179,23 @@ def _convert_image_to_torch(image):
     if isinstance(image, torch.Tensor) or image.ndim == 4:
         return image
     if image.shape[0] > image.shape[-1]:
-        return torch.from_numpy(image).permute(2, 0, 1).float()
+        return _channels_first_float(image)
     return torch.from_numpy(image)
 
 
+def _convert_image_batch_to_torch(batch):
+    """Converts a batch of images (np.ndarray) to a torch Tensor.
+
+    A stacked batch of channels-last images is converted directly into
+    one channels-first float tensor, rather than converting each of the
+    images independently and then stacking them (which copies twice).
+    """
+    if batch.dtype != object and batch.ndim == 4 \
+            and batch.shape[1] > batch.shape[-1]:
+        return _channels_first_float(batch)
+    return torch.stack([_convert_image_to_torch(image) for image in batch])
+
+
 def _postprocess_torch_annotation(image):
     """Post-processes a spatially augmented torch annotation."""
     try:
@@ -18,6 +18,13 @@ from .public import (
 )
 from .public import download_public_dataset
 from .tools import (
-    coco_to_bboxes, convert_bbox_format
+    coco_to_bboxes, convert_bbox_format, convert_bboxes, bbox_iou,
+    clip_bboxes, normalize_bboxes, denormalize_bboxes, non_max_suppression
 )
+from .cache import (
+    set_image_cache_size, image_cache_info, clear_image_cache
+)
+from .packed import pack_dataset
+from .statistics import DatasetStatistics, compute_statistics
 from . import experimental
+from . import batch_transforms
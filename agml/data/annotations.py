@@ -0,0 +1,151 @@
+# Copyright 2021 UC Davis Plant AI and Biophysics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A pre-parsed, columnar store of the COCO JSON annotations of a dataset.
+"""
+import os
+import json
+import threading
+
+import numpy as np
+
+
+class COCOAnnotationStore(object):
+    """Stores the COCO JSON annotations of a dataset in flat arrays.
+
+    Rather than re-building the annotation of an image from its list of
+    COCO JSON dictionaries on every access, all of the annotations in the
+    dataset are parsed once, and stored in flat arrays sorted by image:
+    an `(N, 4)` `np.float32` array of bounding boxes, and `category_id`,
+    `area`, and `iscrowd` arrays (with the segmentations in an object array).
+    For each image, the start and end offsets of its annotations in these
+    arrays are stored, so an annotation is a set of zero-copy slices.
+
+    The arrays are read-only, since they are shared between all accesses
+    of an annotation; any code which modifies them needs to copy them.
+    """
+
+    # The names of the arrays in the store (see `save()` and `load()`).
+    _arrays = ('offsets', 'bbox', 'category_id', 'area',
+               'iscrowd', 'segmentation', 'image_id')
+
+    def __init__(self, coco_map, image_ids = None):
+        # The `coco_map` maps each image file name to a list of its COCO
+        # JSON annotations, and the `image_ids` map the names to their IDs.
+        names = list(coco_map.keys())
+        self._names = names
+        self._rows = {name: i for i, name in enumerate(names)}
+        counts = [len(coco_map[name]) for name in names]
+        self._offsets = np.zeros(len(names) + 1, dtype = np.int64)
+        np.cumsum(counts, out = self._offsets[1:])
+
+        annotations = [a for name in names for a in coco_map[name]]
+        self._bbox = np.array([a['bbox'] for a in annotations],
+                              dtype = np.float32).reshape(-1, 4)
+        self._category_id = np.array(
+            [a['category_id'] for a in annotations], dtype = np.int64)
+        self._area = np.array(
+            [a['area'] for a in annotations], dtype = np.float32)
+        self._iscrowd = np.array(
+            [a.get('iscrowd', 0) for a in annotations], dtype = np.int64)
+        self._segmentation = np.empty(len(annotations), dtype = object)
+        self._segmentation[:] = [a.get('segmentation', []) for a in annotations]
+
+        # The image IDs come from the annotations when there are any, or
+        # otherwise from the image metadata in the COCO JSON dictionary.
+        if image_ids is None:
+            image_ids = {}
+        ids = []
+        for name, count, start in zip(names, counts, self._offsets):
+            if count != 0:
+                ids.append(annotations[start]['image_id'])
+            else:
+                ids.append(image_ids.get(name, -1))
+        self._image_id = np.array(ids, dtype = np.int64)
+
+        for name in self._arrays:
+            getattr(self, f'_{name}').flags.writeable = False
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    @property
+    def num_annotations(self):
+        return len(self._bbox)
+
+    def save(self, directory):
+        """Saves the store into files in the directory.
+
+        The numeric arrays are saved as `.npy` files, and the segmentations
+        (which are arbitrarily nested lists) and names as a JSON file.
+        """
+        for name in self._arrays:
+            if name != 'segmentation':
+                np.save(os.path.join(directory, f'coco.{name}.npy'),
+                        getattr(self, f'_{name}'))
+        with open(os.path.join(directory, 'coco.json'), 'w') as f:
+            json.dump({'names': self._names,
+                       'segmentation': self._segmentation.tolist()}, f)
+
+    @classmethod
+    def load(cls, directory):
+        """Loads a saved store, with its numeric arrays memory-mapped."""
+        obj = cls.__new__(cls)
+        for name in cls._arrays:
+            if name != 'segmentation':
+                setattr(obj, f'_{name}', np.load(os.path.join(
+                    directory, f'coco.{name}.npy'), mmap_mode = 'r'))
+        with open(os.path.join(directory, 'coco.json'), 'r') as f:
+            contents = json.load(f)
+        obj._names = contents['names']
+        obj._rows = {name: i for i, name in enumerate(obj._names)}
+        obj._segmentation = np.empty(len(contents['segmentation']), dtype = object)
+        obj._segmentation[:] = contents['segmentation']
+        obj._segmentation.flags.writeable = False
+        return obj
+
+    def get(self, name):
+        """Returns the annotation of an image, or `None` if it isn't stored."""
+        i = self._rows.get(name, None)
+        if i is None:
+            return None
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return {'bbox': self._bbox[start:end],
+                'category_id': self._category_id[start:end],
+                'area': self._area[start:end],
+                'image_id': self._image_id[i, ...],
+                'iscrowd': self._iscrowd[start:end],
+                'segmentation': self._segmentation[start:end]}
+
+
+# The annotation stores of the object detection datasets which have been
+# loaded, keyed by the root of the dataset directory. These are shared by
+# all of the `DataObject`s (and copies of loaders) of a dataset.
+_COCO_STORES = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def register_coco_store(root, store):
+    """Registers the `COCOAnnotationStore` for a dataset directory."""
+    with _REGISTRY_LOCK:
+        _COCO_STORES[os.path.normpath(root)] = store
+
+
+def find_coco_store(root):
+    """Returns the `COCOAnnotationStore` for a dataset directory, if any."""
+    return _COCO_STORES.get(os.path.normpath(root), None)
@@ -0,0 +1,323 @@
+# Copyright 2021 UC Davis Plant AI and Biophysics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Transforms which are applied to entire batches of data at once.
+
+Regular transforms are applied to each sample before it is batched, so even
+simple operations (e.g., scaling an image) are run once per sample. These
+transforms are instead passed to the `batch_transform` argument of the
+`AgMLDataLoader.transform()` method, and run once per batch on the stacked
+`(B, H, W, C)` images (and the batched annotations), after the batch has been
+collated. This requires all of the images in a batch to have the same shape,
+e.g., by using `loader.resize_images()`.
+"""
+import copy
+
+import numpy as np
+
+from agml.data.tools import _COCO_BOX_KEYS # noqa
+from agml.data.managers.transform_helpers import (
+    TransformApplierBase, ScaleTransform, NormalizationTransform
+)
+
+
+__all__ = ['BatchTransform', 'Scale', 'Normalize',
+           'RandomFlip', 'MixUp', 'CutMix']
+
+
+# The default ImageNet mean and standard deviation.
+_IMAGENET_MEAN = (0.485, 0.456, 0.406)
+_IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def _check_image_batch(images):
+    """Validates that the images are a single stacked array."""
+    if not isinstance(images, np.ndarray) or images.dtype == object \
+            or images.ndim < 3:
+        raise ValueError(
+            "Batch transforms require a batch of images with the same "
+            "shape, stacked into a single array. Use `loader.resize_images()` "
+            "to resize all of the images to the same size.")
+    return images
+
+
+def _normalize_batch(kernel, images):
+    """Applies a compiled normalization to an entire batch of images.
+
+    The per-image normalization kernels work on `(H, W, C)` images, so
+    the batch is normalized as a single `(B * H, W, C)` image.
+    """
+    images = _check_image_batch(images)
+    return kernel.apply(images.reshape(
+        (-1, ) + images.shape[2:])).reshape(images.shape)
+
+
+def _check_soft_labels(annotations, name):
+    """Validates that labels are one-hot (or soft) label vectors."""
+    labels = np.asarray(annotations)
+    if labels.ndim != 2:
+        raise ValueError(
+            f"`{name}` requires one-hot labels for image classification. "
+            f"Use `loader.labels_to_one_hot()` to convert the labels.")
+    return labels.astype(np.float32)
+
+
+class BatchTransform(TransformApplierBase):
+    """The base class for transforms which are applied to entire batches.
+
+    A batch transform receives the batch of images, the batch of annotations,
+    and a random `np.random.Generator` for the batch, and returns the new
+    images and annotations. The batch belongs to the loader, so a batch
+    transform can modify it in-place. Subclasses implement `apply()`, and
+    can set `tasks` to the tasks which they support.
+
+    When a batch transform is assigned to a loader, it is copied with the
+    task of the loader set (see `for_task()`), since some transforms, e.g.,
+    flipping, also need to update the annotations depending on the task.
+    """
+    serializable = frozenset(('task', ))
+    uses_rng = True
+
+    # The tasks which the transform supports, or `None` for all tasks.
+    tasks = None
+
+    def __init__(self):
+        super().__init__(None)
+        self._task = None
+
+    def for_task(self, task):
+        """Returns a copy of the transform for the task of a loader."""
+        if self.tasks is not None and task not in self.tasks:
+            raise ValueError(
+                f"The `{self.__class__.__name__}` batch transform does "
+                f"not support the '{task}' task, it can only be used "
+                f"for the following tasks: {list(self.tasks)}.")
+        transform = copy.copy(self)
+        transform._task = task
+        return transform
+
+    def __call__(self, images, annotations, rng = None):
+        if rng is None:
+            rng = np.random.default_rng()
+        return self.apply(images, annotations, rng = rng)
+
+    def apply(self, images, annotations, rng = None):
+        """Applies the transform to a batch of images and annotations."""
+        raise NotImplementedError()
+
+    def __str__(self):
+        return self.__class__.__name__
+
+
+class Scale(BatchTransform):
+    """Scales a batch of images from the 0-255 range to 0-1 floats.
+
+    This is the batch equivalent of `loader.normalize_images('scale')`,
+    and integer images are scaled while floating-point images aren't.
+
+    Parameters
+    ----------
+    dtype : str
+        The dtype of the scaled images, either `float32` or `float16`.
+    """
+    serializable = frozenset(('task', 'kernel'))
+
+    def __init__(self, dtype = 'float32'):
+        super().__init__()
+        self._kernel = ScaleTransform(None, dtype = dtype)
+
+    def apply(self, images, annotations, rng = None):
+        return _normalize_batch(self._kernel, images), annotations
+
+
+class Normalize(BatchTransform):
+    """Normalizes a batch of images with a mean and standard deviation.
+
+    Integer images are scaled to the 0-1 range, and then the images are
+    normalized per channel, in a single pass over the batch (this uses the
+    same precomputed normalization as `loader.normalize_images()`). The
+    mean and standard deviation default to those of ImageNet.
+
+    Parameters
+    ----------
+    mean : Any
+        The mean of each of the channels of the images.
+    std : Any
+        The standard deviation of each of the channels of the images.
+    dtype : str
+        The dtype of the normalized images, either `float32` or `float16`.
+    """
+    serializable = frozenset(('task', 'kernel'))
+
+    def __init__(self, mean = _IMAGENET_MEAN, std = _IMAGENET_STD,
+                 dtype = 'float32'):
+        super().__init__()
+        self._kernel = NormalizationTransform((mean, std), dtype = dtype)
+
+    def apply(self, images, annotations, rng = None):
+        return _normalize_batch(self._kernel, images), annotations
+
+
+class RandomFlip(BatchTransform):
+    """Randomly flips each of the images in a batch.
+
+    Each image is flipped independently with probability `p`. For semantic
+    segmentation, the annotation masks are flipped with their images, and
+    for object detection, the bounding boxes are flipped as well.
+
+    Parameters
+    ----------
+    p : float
+        The probability with which each of the images is flipped.
+    horizontal : bool
+        Whether to flip images horizontally.
+    vertical : bool
+        Whether to flip images vertically (independently of horizontally).
+    """
+    serializable = frozenset(('task', 'p', 'horizontal', 'vertical'))
+
+    def __init__(self, p = 0.5, horizontal = True, vertical = False):
+        super().__init__()
+        if not 0 <= p <= 1:
+            raise ValueError(f"Expected a probability between 0 and 1, got {p}.")
+        self._p = p
+        self._horizontal = horizontal
+        self._vertical = vertical
+
+    def apply(self, images, annotations, rng = None):
+        images = _check_image_batch(images)
+        for axis, enabled in ((2, self._horizontal), (1, self._vertical)):
+            if not enabled:
+                continue
+            flip = np.flatnonzero(rng.random(len(images)) < self._p)
+            if len(flip) == 0:
+                continue
+            images[flip] = np.flip(images[flip], axis = axis)
+            if self._task == 'semantic_segmentation':
+                annotations[flip] = np.flip(annotations[flip], axis = axis)
+            elif self._task == 'object_detection':
+                annotations = self._flip_bboxes(
+                    annotations, flip, axis, images.shape[axis])
+        return images, annotations
+
+    @staticmethod
+    def _flip_bboxes(annotations, flip, axis, size):
+        # The position of the box is along the flipped axis (x for horizontal
+        # flips and y for vertical flips), and its size is two values later.
+        bboxes = annotations['bbox']
+        bboxes = bboxes.copy() if isinstance(bboxes, np.ndarray) else list(bboxes)
+        coordinate = 0 if axis == 2 else 1
+        for i in flip:
+            boxes = np.array(bboxes[i], copy = True)
+            boxes[..., coordinate] = \
+                size - boxes[..., coordinate] - boxes[..., coordinate + 2]
+            bboxes[i] = boxes
+        annotations = dict(annotations)
+        annotations['bbox'] = bboxes
+        return annotations
+
+
+class MixUp(BatchTransform):
+    """Mixes each image in a batch with another random image from the batch.
+
+    The images are blended with a weight drawn from a `Beta(alpha, alpha)`
+    distribution. For image classification, the (one-hot) labels are blended
+    with the same weight, and for object detection, the bounding boxes of
+    both of the images are kept.
+
+    Parameters
+    ----------
+    alpha : float
+        The parameter of the Beta distribution for the blending weight.
+    """
+    serializable = frozenset(('task', 'alpha'))
+    tasks = ('image_classification', 'object_detection')
+
+    def __init__(self, alpha = 0.2):
+        super().__init__()
+        if alpha <= 0:
+            raise ValueError(f"Expected a positive `alpha`, got {alpha}.")
+        self._alpha = alpha
+
+    def apply(self, images, annotations, rng = None):
+        images = _check_image_batch(images)
+        weight = np.float32(rng.beta(self._alpha, self._alpha))
+        permutation = rng.permutation(len(images))
+        mixed = np.multiply(images, weight, dtype = np.float32)
+        mixed += np.multiply(images[permutation], 1 - weight, dtype = np.float32)
+        if self._task == 'object_detection':
+            annotations = _concatenate_boxes(annotations, permutation)
+        else:
+            labels = _check_soft_labels(annotations, 'MixUp')
+            annotations = weight * labels + (1 - weight) * labels[permutation]
+        return mixed, annotations
+
+
+class CutMix(BatchTransform):
+    """Pastes a random region of another image into each image in a batch.
+
+    The area of the region is drawn from a `Beta(alpha, alpha)` distribution,
+    and the same region is used for the entire batch. For image classification,
+    the (one-hot) labels are blended by the area of the region, and for semantic
+    segmentation, the region of the annotation mask is pasted as well.
+
+    Parameters
+    ----------
+    alpha : float
+        The parameter of the Beta distribution for the area of the region.
+    """
+    serializable = frozenset(('task', 'alpha'))
+    tasks = ('image_classification', 'semantic_segmentation')
+
+    def __init__(self, alpha = 1.0):
+        super().__init__()
+        if alpha <= 0:
+            raise ValueError(f"Expected a positive `alpha`, got {alpha}.")
+        self._alpha = alpha
+
+    def apply(self, images, annotations, rng = None):
+        images = _check_image_batch(images)
+        height, width = images.shape[1:3]
+        ratio = np.sqrt(1 - rng.beta(self._alpha, self._alpha))
+        cx, cy = rng.integers(width), rng.integers(height)
+        half_w, half_h = int(width * ratio) // 2, int(height * ratio) // 2
+        x1, x2 = max(cx - half_w, 0), min(cx + half_w, width)
+        y1, y2 = max(cy - half_h, 0), min(cy + half_h, height)
+        permutation = rng.permutation(len(images))
+
+        # The regions are gathered (and thus copied) before any are pasted.
+        images[:, y1:y2, x1:x2] = images[permutation, y1:y2, x1:x2]
+        if self._task == 'semantic_segmentation':
+            annotations[:, y1:y2, x1:x2] = annotations[permutation, y1:y2, x1:x2]
+        else:
+            labels = _check_soft_labels(annotations, 'CutMix')
+            weight = np.float32(1 - (x2 - x1) * (y2 - y1) / (width * height))
+            annotations = weight * labels + (1 - weight) * labels[permutation]
+        return images, annotations
+
+
+def _concatenate_boxes(annotations, permutation):
+    """Combines the boxes of each sample with those of another sample."""
+    annotations = dict(annotations)
+    for key in _COCO_BOX_KEYS:
+        values = annotations.get(key, None)
+        if values is None:
+            continue
+        combined = np.empty(len(permutation), dtype = object)
+        for i, j in enumerate(permutation):
+            combined[i] = np.concatenate(
+                [np.asarray(values[i]), np.asarray(values[j])])
+        annotations[key] = combined
+    return annotations
@@ -0,0 +1,99 @@
+# Copyright 2021 UC Davis Plant AI and Biophysics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reusable, preallocated buffers which batches of images are collated into.
+"""
+import weakref
+import threading
+import collections
+
+import numpy as np
+
+
+class _PooledBuffer(object):
+    """The owner of the memory of a batch handed out by a `BatchBufferPool`.
+
+    NumPy collapses the `base` of every view to the object which owns its
+    memory, so a view of a pooled buffer would have the pooled buffer itself
+    as its base, and a slice of a batch wouldn't keep the batch alive. The
+    batches are instead created from this (non-array) object through the
+    array interface, so it is the base of the batch and of every array or
+    tensor derived from it, and it is only collected once all of them are.
+    """
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self.__array_interface__ = buffer.__array_interface__
+
+
+class BatchBufferPool(object):
+    """A capped pool of preallocated batch buffers.
+
+    When the shape of a batch is known ahead of time (e.g., when images
+    are resized to a fixed size), the samples of a batch can be written
+    directly into an existing buffer instead of being stacked into a new
+    array for every batch. This pool keeps up to `max_buffers` buffers for
+    each batch shape and data type, and recycles them between batches.
+
+    Each batch is handed out as an array whose base is a new owner object
+    for the buffer, and all views of the batch (slices, reshapes, or a
+    `torch.Tensor` created with `torch.from_numpy`) reference that owner.
+    The buffer is only returned to the pool once the owner has been garbage
+    collected, i.e., once the batch and every view of it have been released,
+    so memory that is still being held is never overwritten. Copies of the
+    batch don't reference the buffer, and so don't keep it from the pool.
+
+    If all of the buffers for a shape are still in use, then a new, unpooled
+    array is returned instead, so that the number of buffers in flight (and
+    thus the memory used by the pool) is capped.
+    """
+
+    def __init__(self, max_buffers = 4):
+        if max_buffers < 1:
+            raise ValueError(f"Expected at least one buffer, got {max_buffers}.")
+        self._max_buffers = max_buffers
+        self._free = collections.defaultdict(list)
+        self._allocated = collections.Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def max_buffers(self):
+        return self._max_buffers
+
+    def _release(self, key, buffer):
+        with self._lock:
+            self._free[key].append(buffer)
+
+    def acquire(self, shape, dtype):
+        """Returns an (uninitialized) array of the shape and data type."""
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            if self._free[key]:
+                buffer = self._free[key].pop()
+            elif self._allocated[key] < self._max_buffers:
+                buffer = np.empty(shape, dtype = dtype)
+                self._allocated[key] += 1
+            else:
+                return np.empty(shape, dtype = dtype)
+        owner = _PooledBuffer(buffer)
+        weakref.finalize(owner, self._release, key, buffer)
+        return np.asarray(owner)
+
+    def clear(self):
+        """Drops all of the free buffers in the pool."""
+        with self._lock:
+            for key, buffers in self._free.items():
+                self._allocated[key] -= len(buffers)
+            self._free.clear()
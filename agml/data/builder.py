@@ -17,9 +17,15 @@ import re
 import sys
 import json
 
+import numpy as np
+
 from agml.framework import AgMLSerializable
+from agml.data.packed import find_packed_dataset
+from agml.data.index import SampleIndex
+from agml.data.annotations import COCOAnnotationStore, register_coco_store
+from agml.data.manifest import load_manifest, write_manifest
 from agml.backend.config import data_save_path
-from agml.utils.downloads import download_dataset
+from agml.utils.downloads import download_dataset, dataset_is_complete
 from agml.utils.io import get_file_list, get_dir_list, is_image_file
 
 
@@ -37,8 +43,18 @@ class DataBuilder(AgMLSerializable):
     used by the `DataManager` inside the `AgMLDataLoader`.
     """
     serializable = frozenset(
-        ('name', 'task', 'info_map',
-         'dataset_root', 'data', 'external_image_sources'))
+        ('name', 'task', 'info_map', 'dataset_root', 'data',
+         'external_image_sources', 'source', 'source_indexes'))
+
+    # The contents of the dataset are never modified once they are
+    # generated, so they are shared between copies of the builder.
+    immutable = frozenset(
+        ('info_map', 'data', 'external_image_sources', 'source', 'source_indexes'))
+
+    # A builder can be a view of a subset of another builder's contents
+    # (see `view()`), in which case these store the source and indexes.
+    _source = None
+    _source_indexes = None
 
     def __init__(self, info, dataset_path, overwrite):
         # Attempt to locate or download the dataset.
@@ -68,6 +84,19 @@ class DataBuilder(AgMLSerializable):
         obj._external_image_sources = info.external_image_sources
         return obj
 
+    def view(self, indexes):
+        """Creates a `DataBuilder` for a subset of this builder's contents.
+
+        The contents of the new builder are only generated (from the
+        contents of this builder) if they are actually requested.
+        """
+        obj = super(DataBuilder, self).__new__(self.__class__)
+        obj.__setstate__(self.__getstate__())
+        obj._data = None
+        obj._source = self
+        obj._source_indexes = np.asarray(indexes, dtype = np.int64)
+        return obj
+
     @property
     def dataset_root(self):
         return self._dataset_root
@@ -89,18 +118,22 @@ class DataBuilder(AgMLSerializable):
         # ends with the name of the dataset, e.g., `/root/datasets/<name>`,
         # then we pop '<name>' from the end of the path in order to prevent
         # the dataset from being downloaded to `/root/datasets/<name>/<name>`.
+        #
+        # A dataset which is still being downloaded (or whose download was
+        # interrupted) is only partially extracted, so it isn't complete
+        # yet, and downloading it again resumes the download.
         if not overwrite:
             if kwargs.get('dataset_path', False):
                 path = kwargs.get('dataset_path')
                 if (os.path.basename(path) == self._name
-                    and os.path.exists(path)) or \
-                        os.path.exists(os.path.join(path, self._name)):
+                    and dataset_is_complete(path)) or \
+                        dataset_is_complete(os.path.join(path, self._name)):
                     if os.path.basename(path) != self._name:
                         path = os.path.join(path, self._name)
                     self._dataset_root = path
                     return
 
-            elif os.path.exists(os.path.join(
+            elif dataset_is_complete(os.path.join(
                     data_save_path(), self._name)):
                 self._dataset_root = os.path.join(
                     data_save_path(), self._name)
@@ -148,19 +181,59 @@ class DataBuilder(AgMLSerializable):
         """Dispatches to a content generation method for the provided task."""
         if self._data is not None:
             return
+
+        # A view selects its contents from the contents of its source.
+        if self._source is not None:
+            contents = self._source.get_contents()
+            if 'inputs' in contents.keys():
+                self._data = {k: [contents[k][i] for i in self._source_indexes]
+                              for k in ('inputs', 'outputs')}
+            else:
+                items = list(contents.items())
+                self._data = dict(items[i] for i in self._source_indexes)
+            return
+
+        self._packed = find_packed_dataset(self._dataset_root, refresh = True)
+
+        # If the contents have already been generated and stored in the
+        # manifest of the dataset (and it is still valid), then use that.
+        manifest = load_manifest(self._dataset_root, task)
+        if manifest is not None:
+            self._data, coco_store = manifest
+            if coco_store is not None:
+                register_coco_store(self._dataset_root, coco_store)
+            return
+
+        coco_store = None
         if task == 'image_classification':
             self._generate_image_classification_data()
         elif task == 'image_regression':
             self._generate_image_regression_data()
         elif task == 'object_detection':
-            self._generate_object_detection_data()
+            coco_store = self._generate_object_detection_data()
         else:
             self._generate_semantic_segmentation_data()
+        write_manifest(self._dataset_root, task,
+                       SampleIndex(self._data), coco_store)
 
     def get_contents(self):
         """Extracts the internal representation of the data content."""
         # Create the internal content representation of the dataset.
         self._generate_contents(self._task)
+        if isinstance(self._data, SampleIndex):
+            return self._data.to_contents()
+        return self._data
+
+    def compact(self):
+        """Converts the data content into a compact `SampleIndex`.
+
+        The `SampleIndex` replaces the internal content representation, so
+        that the builder doesn't keep its own copy of the content in Python
+        objects. The content can still be re-generated with `get_contents()`.
+        """
+        self._generate_contents(self._task)
+        if not isinstance(self._data, SampleIndex):
+            self._data = SampleIndex(self._data)
         return self._data
 
     def export_contents(self, export_format):
@@ -184,13 +257,49 @@ class DataBuilder(AgMLSerializable):
         if export_format == 'arrays':
             return list(contents.keys()), list(contents.values())
 
-        # A special case for COCO JSON dictionaries.
+        # A special case for COCO JSON dictionaries. If the contents were
+        # loaded from the manifest, the annotation file is loaded here.
         if export_format == 'coco':
             if self._task != 'object_detection':
                 raise ValueError("The `coco` export format is "
                                  "only for object detection tasks.")
+            if getattr(self, '_default_coco_annotations', None) is None:
+                self._default_coco_annotations = self._load_annotation_file()
             return self._default_coco_annotations
 
+    # If a packed copy of the dataset exists, then the directory listings
+    # and annotation files are read from the packed copy instead, which
+    # prevents any filesystem access to the individual dataset files.
+
+    _packed = None
+
+    def _list_dirs(self, path):
+        """Lists the sub-directories of a directory in the dataset."""
+        if self._packed is not None:
+            contents = self._packed.list_dir(
+                os.path.relpath(path, self._dataset_root).replace(os.sep, '/'))
+            if contents is not None:
+                return contents[0]
+        return get_dir_list(path)
+
+    def _list_files(self, path):
+        """Lists the files in a directory in the dataset."""
+        if self._packed is not None:
+            contents = self._packed.list_dir(
+                os.path.relpath(path, self._dataset_root).replace(os.sep, '/'))
+            if contents is not None:
+                return contents[1]
+        return get_file_list(path)
+
+    def _load_annotation_file(self):
+        """Loads the contents of the `annotations.json` file."""
+        if self._packed is not None:
+            contents = self._packed.read('annotations.json')
+            if contents is not None:
+                return json.loads(contents.tobytes().decode('utf-8'))
+        with open(os.path.join(self._dataset_root, 'annotations.json'), 'r') as f:
+            return json.load(f)
+
     # The following methods actually generate the content mappings for
     # the different tasks. In essence, for each image path, `image`, a
     # mapping is generated with a corresponding annotation, such as a
@@ -204,14 +313,12 @@ class DataBuilder(AgMLSerializable):
         they are placed in corresponds to their label in the dataset.
         """
         image_label_mapping = {}
-        candidate_dirs = get_dir_list(self._dataset_root)
+        candidate_dirs = self._list_dirs(self._dataset_root)
         for dir_ in candidate_dirs:
             if dir_.startswith('.'):
                 continue
             dir_path = os.path.join(self._dataset_root, dir_)
-            if len(get_file_list(dir_path)) == 0:
-                continue
-            for file_ in get_file_list(dir_path):
+            for file_ in self._list_files(dir_path):
                 file_ = os.path.join(dir_path, file_)
                 image_label_mapping[file_] = self._info_map[dir_]
         self._data = image_label_mapping
@@ -223,8 +330,7 @@ class DataBuilder(AgMLSerializable):
         well as other image formats in other various `*_images` folders,
         and an `annotations.json` file containing the regression outputs.
         """
-        with open(os.path.join(self._dataset_root, 'annotations.json'), 'r') as f:
-            annotations = json.load(f)
+        annotations = self._load_annotation_file()
         content_mapping = {'inputs': [], 'outputs': []}
         annotation_types = set(list(self._info_map.keys()))
         annotation_types.remove('regression')
@@ -250,8 +356,8 @@ class DataBuilder(AgMLSerializable):
         """
         image_dir = os.path.join(self._dataset_root, 'images')
         annotation_dir = os.path.join(self._dataset_root, 'annotations')
-        images, annotations = sorted(get_file_list(image_dir)), \
-                              sorted(get_file_list(annotation_dir))
+        images, annotations = sorted(self._list_files(image_dir)), \
+                              sorted(self._list_files(annotation_dir))
         image_annotation_map = {}
         for image_path, annotation_path in zip(images, annotations):
             image_annotation_map[os.path.join(image_dir, image_path)] \
@@ -264,8 +370,7 @@ class DataBuilder(AgMLSerializable):
         Image data is loaded from an `images` directory, and the COCO
         JSON annotations are loaded from an `annotations.json` file.
         """
-        with open(os.path.join(self._dataset_root, 'annotations.json')) as f:
-            self._default_coco_annotations = json.load(f)
+        self._default_coco_annotations = self._load_annotation_file()
         coco_annotations = self._default_coco_annotations
         categories, labels = coco_annotations['categories'], []
         for category in categories:
@@ -278,3 +383,10 @@ class DataBuilder(AgMLSerializable):
             coco_map[image_id_mapping[a_meta['image_id']]].append(a_meta)
         self._data = coco_map
 
+        # The annotations are also parsed once into a columnar store, from
+        # which the `DataObject`s get their annotations on each access.
+        coco_store = COCOAnnotationStore(
+            coco_map, image_ids = {v: k for k, v in image_id_mapping.items()})
+        register_coco_store(self._dataset_root, coco_store)
+        return coco_store
+
@@ -0,0 +1,471 @@
+# Copyright 2021 UC Davis Plant AI and Biophysics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Caching of decoded and resized image data, to prevent re-decoding files.
+"""
+import os
+import json
+import shutil
+import hashlib
+import threading
+import collections
+
+import numpy as np
+
+from agml.framework import AgMLSerializable
+from agml.data.tools import _COCO_BOX_KEYS # noqa
+
+
+__all__ = ['set_image_cache_size', 'image_cache_info', 'clear_image_cache']
+
+
+class DecodedImageCache(object):
+    """A bounded, thread-safe LRU cache of decoded images.
+
+    Decoded images are stored as read-only `np.ndarray`s, keyed by a
+    tuple which contains the absolute path of the image file and the
+    parameters which were used to decode it. The total size of all of
+    the cached arrays is bounded by `max_bytes`; when a new image would
+    exceed that budget, the least recently used images are evicted.
+
+    Since the cached arrays are shared between every access of an image,
+    they are marked as read-only; any code which modifies them needs to
+    make a copy first. A `max_bytes` of `0` disables the cache entirely.
+    """
+
+    def __init__(self, max_bytes = 0):
+        self._max_bytes = max_bytes
+        self._contents = collections.OrderedDict()
+        self._current_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._max_bytes > 0
+
+    def resize(self, max_bytes):
+        """Updates the byte budget, evicting images as necessary."""
+        if max_bytes is None or max_bytes < 0:
+            raise ValueError(f"Expected a non-negative number of "
+                             f"bytes for the cache, got {max_bytes}.")
+        with self._lock:
+            self._max_bytes = int(max_bytes)
+            self._evict()
+
+    def clear(self):
+        """Removes all images from the cache and resets the counters."""
+        with self._lock:
+            self._contents.clear()
+            self._current_bytes = 0
+            self._hits = 0
+            self._misses = 0
+
+    def info(self):
+        """Returns the current statistics of the cache."""
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses,
+                    'num_images': len(self._contents),
+                    'current_bytes': self._current_bytes,
+                    'max_bytes': self._max_bytes}
+
+    def _evict(self):
+        while self._current_bytes > self._max_bytes and self._contents:
+            _, evicted = self._contents.popitem(last = False)
+            self._current_bytes -= evicted.nbytes
+
+    def get_or_load(self, key, load_fn):
+        """Returns the image stored at `key`, or loads it using `load_fn`.
+
+        If the cache is disabled, then this directly returns the result
+        of `load_fn()`. Otherwise, the loaded image is inserted into the
+        cache (if it fits in the budget) and returned as a read-only array.
+        """
+        if not self.enabled:
+            return load_fn()
+        with self._lock:
+            image = self._contents.get(key, None)
+            if image is not None:
+                self._contents.move_to_end(key)
+                self._hits += 1
+                return image
+            self._misses += 1
+
+        # The actual loading happens outside of the lock, so that other
+        # threads can keep accessing the cache while this image decodes.
+        image = load_fn()
+        if not isinstance(image, np.ndarray):
+            return image
+        image.flags.writeable = False
+        if image.nbytes > self._max_bytes:
+            return image
+        with self._lock:
+            if key not in self._contents:
+                self._contents[key] = image
+                self._current_bytes += image.nbytes
+                self._evict()
+        return image
+
+
+# The process-wide cache used by all `DataObject`s, disabled by default.
+_IMAGE_CACHE = DecodedImageCache()
+
+
+def set_image_cache_size(max_bytes):
+    """Sets the memory budget for the process-wide decoded image cache.
+
+    By default, every time an image (or an annotation mask) is accessed
+    from an `AgMLDataLoader`, it is read from disk and decoded again. For
+    datasets which fit into memory, this repeated decoding on every epoch
+    can be avoided by enabling this cache, which keeps up to `max_bytes`
+    of decoded images in memory and evicts the least recently used ones.
+
+    The cache is shared between all loaders in the current process, and
+    keyed by the absolute path of each file and how it is decoded. Cached
+    images are read-only, but the loader makes a copy of them before they
+    are passed to any transforms, so this is transparent during loading.
+    Note that with `loader.disable_preprocessing()`, the raw (read-only)
+    cached arrays are returned directly.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The maximum number of bytes of decoded images to store. Passing
+        `0` disables the cache and removes all of the cached images.
+    """
+    _IMAGE_CACHE.resize(max_bytes)
+    if max_bytes == 0:
+        _IMAGE_CACHE.clear()
+
+
+def image_cache_info():
+    """Returns the statistics of the process-wide decoded image cache.
+
+    Returns
+    -------
+    A dictionary with the number of cache `hits` and `misses`, the number
+    of cached images, and the current and maximum size in bytes.
+    """
+    return _IMAGE_CACHE.info()
+
+
+def clear_image_cache():
+    """Removes all images from the process-wide decoded image cache."""
+    _IMAGE_CACHE.clear()
+
+
+def cached_image(key, load_fn):
+    """Loads an image through the process-wide decoded image cache."""
+    return _IMAGE_CACHE.get_or_load(key, load_fn)
+
+
+def _to_json(obj):
+    """Converts NumPy values in annotations to JSON-serializable values."""
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj)} is not JSON serializable.")
+
+
+class ResizedSampleCache(AgMLSerializable):
+    """A persistent on-disk cache of resized images and annotations.
+
+    When a loader resizes its images, every access would otherwise decode
+    the full-size image and shrink it again. This cache stores the result
+    of the resizing stage (the resized image, as well as the resized mask
+    for semantic segmentation or all of the per-box values for object
+    detection, since boxes can be removed by resizing) as raw `.npy` files,
+    which are read back as memory maps in later epochs and later runs
+    without any decoding.
+
+    The files are stored in a separate directory for each resize shape and
+    decoding mode (since JPEG images decoded at a reduced resolution differ
+    slightly from those decoded in full and then resized), so entries which
+    were created with a different `resize_images()` or `reduced_decode`
+    setting are never used. Since the cache is keyed by the absolute path
+    of each image and not its contents, it should be cleared if the dataset
+    files are modified.
+    """
+    serializable = frozenset(('location', 'task'))
+    immutable = serializable
+
+    def __init__(self, location, task):
+        self._location = location
+        self._task = task
+
+    @property
+    def location(self):
+        return self._location
+
+    @staticmethod
+    def supports(obj):
+        """Returns whether the contents of a `DataObject` can be cached."""
+        # Image regression inputs can be dictionaries of multiple images.
+        return isinstance(obj._image_object, str) # noqa
+
+    def _sample_path(self, obj, image_size, reduced_decode):
+        """Returns the base path of the cache files for a sample."""
+        # The key is the absolute path of the image, so that datasets with the
+        # same file names can share a cache location without colliding.
+        key = hashlib.sha1(
+            obj._image_path().encode('utf-8')).hexdigest() # noqa
+        directory = f'{image_size[0]}x{image_size[1]}'
+        if reduced_decode:
+            directory += '-reduced'
+        return os.path.join(self._location, directory, key[:2], key)
+
+    def load(self, obj, image_size, reduced_decode = True):
+        """Loads the resized contents of a sample, or `None` if not cached."""
+        base = self._sample_path(obj, image_size, reduced_decode)
+        try:
+            # The image (and mask) are loaded as copy-on-write memory maps,
+            # so they aren't read until used and can still be modified
+            # in-place by transforms without ever changing the cache files.
+            # The mask of a semantic segmentation sample is read directly
+            # from the cache, so the full-size mask is never decoded.
+            image = np.asarray(np.load(base + '.image.npy', mmap_mode = 'c'))
+            if self._task == 'semantic_segmentation':
+                return image, np.asarray(
+                    np.load(base + '.mask.npy', mmap_mode = 'c'))
+            annotation = obj.get_annotation()
+            if self._task == 'object_detection':
+                for key in _COCO_BOX_KEYS:
+                    if key == 'segmentation' and key in annotation:
+                        with open(base + '.segmentation.json', 'r') as f:
+                            segmentation = json.load(f)
+                        annotation[key] = np.empty(len(segmentation), dtype = object)
+                        annotation[key][:] = segmentation
+                    elif key in annotation:
+                        annotation[key] = np.load(f'{base}.{key}.npy')
+        except (OSError, ValueError):
+            return None
+        return image, annotation
+
+    def store(self, obj, image_size, contents, reduced_decode = True):
+        """Writes the resized contents of a sample to the cache."""
+        base = self._sample_path(obj, image_size, reduced_decode)
+        os.makedirs(os.path.dirname(base), exist_ok = True)
+        image, annotation = contents
+        arrays = {}
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        if self._task == 'semantic_segmentation':
+            arrays['mask'] = annotation
+        elif self._task == 'object_detection':
+            # All of the per-box values are stored, since resizing removes
+            # boxes which collapse, and the segmentations (which are nested
+            # lists) are stored as JSON rather than as a pickled array.
+            for key in _COCO_BOX_KEYS:
+                if key == 'segmentation' and key in annotation:
+                    path = base + '.segmentation.json'
+                    with open(path + suffix, 'w') as f:
+                        json.dump(list(annotation[key]), f, default = _to_json)
+                    os.replace(path + suffix, path)
+                elif key in annotation:
+                    arrays[key] = annotation[key]
+
+        # The image is written last, since its presence marks a complete
+        # entry. Each file is written to a temporary path and then moved,
+        # so that concurrent readers never see a partially written file.
+        arrays['image'] = image
+        for name, array in arrays.items():
+            path = f'{base}.{name}.npy'
+            with open(path + suffix, 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(path + suffix, path)
+
+    def clear(self):
+        """Removes all of the cached contents."""
+        if os.path.exists(self._location):
+            shutil.rmtree(self._location)
+
+
+class TensorStore(AgMLSerializable):
+    """A fixed-size, memory-mapped store of an entire resized dataset.
+
+    This stores all of the (resized) images of a loader in one contiguous
+    array of shape `(N, H, W, C)` (one for each input type, if there are
+    multiple), alongside either a second array of masks for semantic
+    segmentation, or flat arrays of labels for image classification and
+    regression. All of the arrays are stored as `.npy` files and opened as
+    read-only memory maps, so that there is no decoding at all, and the OS
+    page cache is shared between all of the processes reading the store.
+
+    Each row of the store is identified by the key of the `DataObject`
+    it was built from (see `TensorStore.object_key`), so that a store can
+    be used by any loader whose samples are a subset of the stored ones,
+    e.g., the splits of the loader which built it.
+    """
+    serializable = frozenset(('location', 'task'))
+    immutable = serializable
+
+    # The memory-mapped arrays and the layout of the stored contents.
+    # These are not serialized, but re-opened lazily in each copy.
+    _arrays = None
+    _layout = None
+    _rows = None
+
+    def __init__(self, location, task):
+        self._location = location
+        self._task = task
+
+    @property
+    def location(self):
+        return self._location
+
+    @property
+    def image_size(self):
+        return tuple(self._open()[1]['image_size'])
+
+    @staticmethod
+    def exists(location):
+        """Returns whether a complete store exists at the location."""
+        return os.path.exists(os.path.join(location, 'layout.json'))
+
+    def __len__(self):
+        return self._open()[1]['length']
+
+    @staticmethod
+    def object_key(obj):
+        """Returns the key which identifies a `DataObject` in a store."""
+        image = obj._image_object # noqa
+        if isinstance(image, dict):
+            return json.dumps(image, sort_keys = True)
+        return str(image)
+
+    def rows_for(self, objects):
+        """Returns the rows of the store for a set of `DataObject`s.
+
+        If any of the objects is not in the store, this returns `None`.
+        """
+        _, layout = self._open()
+        if self._rows is None:
+            self._rows = {key: i for i, key in enumerate(layout['keys'])}
+        try:
+            return np.array([self._rows[self.object_key(obj)]
+                             for obj in objects], dtype = np.int64)
+        except KeyError:
+            return None
+
+    def _open(self):
+        if self._arrays is None:
+            with open(os.path.join(self._location, 'layout.json'), 'r') as f:
+                layout = json.load(f)
+            arrays = {}
+            for name in layout['arrays']:
+                arrays[name] = np.load(os.path.join(
+                    self._location, f'{name}.npy'), mmap_mode = 'r')
+            self._layout, self._arrays = layout, arrays
+        return self._arrays, self._layout
+
+    @staticmethod
+    def _flatten(contents, prefix):
+        """Flattens a sample's image or annotation into named arrays."""
+        if isinstance(contents, dict):
+            return {f'{prefix}.{k}': np.asarray(v) for k, v in contents.items()}
+        return {prefix: np.asarray(contents)}
+
+    def _unflatten(self, arrays, prefix, kind):
+        if kind == 'dict':
+            return {name[len(prefix) + 1:]: array for name, array in arrays.items()
+                    if name.startswith(prefix + '.')}
+        return arrays[prefix]
+
+    @classmethod
+    def build(cls, location, task, image_size, objects, load_fn, num_workers = None):
+        """Builds a store by loading and writing all of the samples.
+
+        Each of the `objects` is loaded by calling `load_fn(obj)`, which
+        should return the resized image and annotation contents. All of the
+        samples need to have the same shapes as the first sample.
+        """
+        from agml.utils.parallel import build_executor
+        from agml.utils.logging import tqdm
+
+        tmp_location = location + '.tmp'
+        if os.path.exists(tmp_location):
+            shutil.rmtree(tmp_location)
+        os.makedirs(tmp_location)
+
+        # The layout (and the shapes and dtypes of each of the arrays)
+        # are determined from the first sample in the dataset.
+        length = len(objects)
+        image, annotation = load_fn(objects[0])
+        if task == 'object_detection':
+            raise ValueError("Object detection datasets cannot be stored as "
+                             "fixed-size tensors, since the number of bounding "
+                             "boxes varies between images.")
+        layout = {'length': length, 'image_size': list(image_size),
+                  'keys': [cls.object_key(obj) for obj in objects],
+                  'image': 'dict' if isinstance(image, dict) else 'array',
+                  'annotation': 'dict' if isinstance(annotation, dict) else 'array'}
+        first = {**cls._flatten(image, 'image'),
+                 **cls._flatten(annotation, 'annotation')}
+        layout['arrays'] = list(first.keys())
+        arrays = {name: np.lib.format.open_memmap(
+            os.path.join(tmp_location, f'{name}.npy'), mode = 'w+',
+            dtype = value.dtype, shape = (length, ) + value.shape)
+            for name, value in first.items()}
+
+        def _write(i):
+            image_, annotation_ = load_fn(objects[i])
+            values = {**cls._flatten(image_, 'image'),
+                      **cls._flatten(annotation_, 'annotation')}
+            for name_, value_ in values.items():
+                if value_.shape != arrays[name_].shape[1:]:
+                    raise ValueError(
+                        f"Sample {i} has a shape of {value_.shape} for '{name_}', "
+                        f"expected {arrays[name_].shape[1:]}. All samples need to "
+                        f"have the same shape to be stored as a tensor store.")
+                arrays[name_][i] = value_
+
+        with build_executor('thread', num_workers) as pool:
+            for _ in tqdm(pool.map(_write, range(length)),
+                          total = length, desc = 'Building Tensor Store'):
+                pass
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        # The layout file marks the store as complete, so the store is
+        # only moved into its final location once everything is written.
+        with open(os.path.join(tmp_location, 'layout.json'), 'w') as f:
+            json.dump(layout, f)
+        if os.path.exists(location):
+            shutil.rmtree(location)
+        os.rename(tmp_location, location)
+        return cls(location = location, task = task)
+
+    def get(self, index):
+        """Returns the stored image and annotation for one sample."""
+        arrays, layout = self._open()
+        sample = {}
+        for name, array in arrays.items():
+            # Scalars (e.g., labels) are returned as Python numbers.
+            value = np.array(array[index])
+            sample[name] = value.item() if value.ndim == 0 else value
+        image = self._unflatten(sample, 'image', layout['image'])
+        annotation = self._unflatten(sample, 'annotation', layout['annotation'])
+        return image, annotation
+
+    def get_batch(self, indexes):
+        """Returns the stored images and annotations for a batch of samples.
+
+        This is a single gather over each of the memory-mapped arrays.
+        """
+        arrays, layout = self._open()
+        indexes = np.asarray(indexes)
+        batch = {name: array[indexes] for name, array in arrays.items()}
+        return (self._unflatten(batch, 'image', layout['image']),
+                self._unflatten(batch, 'annotation', layout['annotation']))
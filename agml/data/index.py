@@ -0,0 +1,248 @@
+# Copyright 2021 UC Davis Plant AI and Biophysics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A compact, columnar index of the samples in a dataset.
+
+By default, every sample of a dataset is stored as its own `DataObject`,
+holding Python strings and annotation dictionaries. When a loader is used
+in forked worker processes (e.g., a `torch.utils.data.DataLoader` with
+`num_workers > 0`), merely accessing these objects updates their reference
+counts, which touches (and thus copies) every memory page that they are on,
+so each worker ends up with its own copy of the entire index.
+
+The `SampleIndex` instead stores the contents of the samples in a handful
+of NumPy arrays: all of the image paths in one encoded buffer with offsets
+into it, integer labels in an integer array, and any other annotations as
+encoded JSON in a second buffer. These arrays are a few Python objects in
+total, so they are never copied by the workers, and a `DataObject` is
+only created on demand when a sample is accessed.
+"""
+import os
+import json
+
+import numpy as np
+
+from agml.framework import AgMLSerializable
+from agml.data.object import DataObject
+
+
+def _json_default(obj):
+    """Converts NumPy values in annotations to JSON-serializable values."""
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj)} is not JSON serializable.")
+
+
+class EncodedColumn(AgMLSerializable):
+    """Stores a sequence of strings (or JSON values) in a single buffer.
+
+    The values are encoded as UTF-8 into one `np.uint8` buffer, with an
+    `np.int64` array of the offsets of each value into the buffer. Values
+    which aren't strings are encoded as JSON, and decoded when accessed.
+    """
+    serializable = frozenset(('buffer', 'offsets', 'is_json'))
+    immutable = serializable
+
+    def __init__(self, values):
+        self._is_json = not all(isinstance(v, str) for v in values)
+        if self._is_json:
+            values = [json.dumps(v, separators = (',', ':'),
+                                 default = _json_default) for v in values]
+        encoded = [v.encode('utf-8') for v in values]
+        self._offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+        np.cumsum([len(v) for v in encoded], out = self._offsets[1:])
+        self._buffer = np.frombuffer(b''.join(encoded), dtype = np.uint8)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self._offsets[i], self._offsets[i + 1]
+        value = self._buffer[start:end].tobytes().decode('utf-8')
+        if self._is_json:
+            return json.loads(value)
+        return value
+
+    @property
+    def nbytes(self):
+        return self._buffer.nbytes + self._offsets.nbytes
+
+    def save(self, directory, name):
+        """Saves the column into `.npy` files in the directory."""
+        np.save(os.path.join(directory, f'{name}.buffer.npy'), self._buffer)
+        np.save(os.path.join(directory, f'{name}.offsets.npy'), self._offsets)
+        return {'is_json': self._is_json}
+
+    @classmethod
+    def load(cls, directory, name, info):
+        """Loads a saved column, with its arrays memory-mapped."""
+        obj = cls.__new__(cls)
+        obj._buffer = np.load(os.path.join(
+            directory, f'{name}.buffer.npy'), mmap_mode = 'r')
+        obj._offsets = np.load(os.path.join(
+            directory, f'{name}.offsets.npy'), mmap_mode = 'r')
+        obj._is_json = info['is_json']
+        return obj
+
+
+class SampleIndex(AgMLSerializable):
+    """A columnar store of the inputs and annotations of a dataset.
+
+    This is constructed from the contents generated by a `DataBuilder`,
+    and can re-generate those contents (e.g., to split the dataset). The
+    inputs and annotations are stored as `EncodedColumn`s, except for
+    integer labels (image classification), which are an `np.int64` array.
+    """
+    serializable = frozenset(('inputs', 'outputs', 'is_mapping'))
+    immutable = serializable
+
+    def __init__(self, contents):
+        # The contents are either a mapping of inputs to annotations, or
+        # (for image regression) a dictionary of `inputs` and `outputs`.
+        self._is_mapping = 'inputs' not in contents.keys()
+        if self._is_mapping:
+            inputs, outputs = list(contents.keys()), list(contents.values())
+        else:
+            inputs, outputs = contents['inputs'], contents['outputs']
+        self._inputs = EncodedColumn(inputs)
+        if all(isinstance(o, int) and not isinstance(o, bool) for o in outputs):
+            self._outputs = np.array(outputs, dtype = np.int64)
+        else:
+            self._outputs = EncodedColumn(outputs)
+
+    def __len__(self):
+        return len(self._inputs)
+
+    def __getitem__(self, i):
+        """Returns the `(input, annotation)` contents of a sample."""
+        output = self._outputs[i]
+        if isinstance(output, np.integer):
+            output = int(output)
+        return self._inputs[i], output
+
+    @property
+    def nbytes(self):
+        """The total size of all of the arrays in the index, in bytes."""
+        return self._inputs.nbytes + self._outputs.nbytes
+
+    def save(self, directory):
+        """Saves the index into `.npy` files in the directory.
+
+        Returns a JSON-serializable dictionary with the information which
+        is needed to load the index again (see `SampleIndex.load()`).
+        """
+        info = {'is_mapping': self._is_mapping,
+                'inputs': self._inputs.save(directory, 'inputs')}
+        if isinstance(self._outputs, np.ndarray):
+            np.save(os.path.join(directory, 'outputs.npy'), self._outputs)
+            info['outputs'] = None
+        else:
+            info['outputs'] = self._outputs.save(directory, 'outputs')
+        return info
+
+    @classmethod
+    def load(cls, directory, info):
+        """Loads a saved index, with its arrays memory-mapped."""
+        obj = cls.__new__(cls)
+        obj._is_mapping = info['is_mapping']
+        obj._inputs = EncodedColumn.load(directory, 'inputs', info['inputs'])
+        if info['outputs'] is None:
+            obj._outputs = np.load(os.path.join(
+                directory, 'outputs.npy'), mmap_mode = 'r')
+        else:
+            obj._outputs = EncodedColumn.load(
+                directory, 'outputs', info['outputs'])
+        return obj
+
+    def to_contents(self):
+        """Re-generates the contents of the `DataBuilder` from the index."""
+        samples = [self[i] for i in range(len(self))]
+        if self._is_mapping:
+            return dict(samples)
+        return {'inputs': [s[0] for s in samples],
+                'outputs': [s[1] for s in samples]}
+
+
+class LazyDataObjects(AgMLSerializable):
+    """A sequence of `DataObject`s which are created on demand.
+
+    This stands in for the list of `DataObject`s in a `DataManager`, and
+    creates the object for a sample from a `SampleIndex` when accessed.
+    """
+    serializable = frozenset(('index', 'task', 'root'))
+    immutable = serializable
+
+    def __init__(self, index, task, root):
+        self._index = index
+        self._task = task
+        self._root = root
+
+    @property
+    def index(self):
+        return self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Index {i} out of range for {len(self)} objects.")
+        return DataObject.create(
+            contents = self._index[i], task = self._task,
+            root = self._root, from_store = True)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class DataObjectView(AgMLSerializable):
+    """A view of a subset of a sequence of `DataObject`s.
+
+    This is used by the `DataManager`s of split (and subset) loaders, which
+    access the `DataObject`s of the loader they were created from through an
+    array of indexes, rather than having their own copies of the objects.
+    """
+    serializable = frozenset(('objects', 'indexes'))
+    immutable = serializable
+
+    def __init__(self, objects, indexes):
+        # Views of views index directly into the original objects.
+        indexes = np.asarray(indexes, dtype = np.int64)
+        if isinstance(objects, DataObjectView):
+            indexes = objects._indexes[indexes]
+            objects = objects._objects
+        self._objects = objects
+        self._indexes = indexes
+
+    @property
+    def indexes(self):
+        return self._indexes
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self._objects[int(self._indexes[i])]
+
+    def __iter__(self):
+        for i in self._indexes:
+            yield self._objects[int(i)]
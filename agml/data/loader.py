@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
+import os
 from decimal import getcontext, Decimal
 
 import numpy as np
@@ -22,6 +22,8 @@ from agml.data.manager import DataManager
 from agml.data.builder import DataBuilder
 from agml.data.metadata import DatasetMetadata
 from agml.utils.general import NoArgument
+from agml.utils.parallel import prefetch_iterator
+from agml.utils.logging import log
 from agml.backend.tftorch import (
     get_backend, set_backend,
     user_changed_backend, StrictBackendError,
@@ -57,6 +59,18 @@ class AgMLDataLoader(AgMLSerializable):
             A custom path to download and load the dataset from.
         overwrite : bool, optional
             Whether to rewrite and re-install the dataset.
+        compact_index : bool, optional
+            Whether to store the index of the dataset's samples in a few
+            NumPy arrays rather than one Python object per sample. This
+            prevents worker processes forked from the loader (e.g., by a
+            `torch.utils.data.DataLoader`) from each copying the index.
+        seed : int, optional
+            The seed for the random transforms. Each sample is transformed
+            with its own random generator, derived from this seed, the epoch
+            and the index of the sample, so the transformed data is the same
+            regardless of how it is loaded (e.g., with parallel workers).
+            By default, the seed is derived from NumPy's global random state
+            (so it is reproducible with `np.random.seed`), without advancing it.
 
     Notes
     -----
@@ -65,6 +79,12 @@ class AgMLDataLoader(AgMLSerializable):
     serializable = frozenset((
         'info', 'builder', 'manager', 'train_data', 'val_data', 'test_data'))
 
+    # The dataset metadata and contents are shared between copies.
+    immutable = frozenset(('info', 'builder'))
+
+    # Whether the loader is a split of another loader (which can't be split).
+    _is_split = False
+
     def __init__(self, dataset, **kwargs):
         """Instantiates an `AgMLDataLoader` with the dataset."""
         # Set up the dataset and its associated metadata.
@@ -85,7 +105,9 @@ class AgMLDataLoader(AgMLSerializable):
             builder = self._builder,
             task = self._info.tasks.ml,
             name = self._info.name,
-            root = self._builder.dataset_root
+            root = self._builder.dataset_root,
+            compact_index = kwargs.get('compact_index', False),
+            seed = kwargs.get('seed', None)
         )
 
         # If the dataset is split, then the `AgMLDataLoader`s with the
@@ -105,8 +127,22 @@ class AgMLDataLoader(AgMLSerializable):
         return self._manager.get(indexes)
 
     def __iter__(self):
-        for indx in range(len(self)):
-            yield self[indx]
+        prefetch = self._manager._prefetch
+        if prefetch is None:
+            for indx in range(len(self)):
+                yield self[indx]
+        else:
+            depth, num_threads = prefetch
+            yield from prefetch_iterator(
+                self.__getitem__, range(len(self)),
+                depth = depth, num_threads = num_threads)
+
+        # If enabled (see `set_epoch()`), a full pass over the loader is an
+        # epoch, so the next pass gets new random transforms (and a sharded
+        # loader moves on to the next permutation, which all of the shards
+        # move on to together).
+        if self._manager._auto_epoch:
+            self._manager.set_epoch(self._manager._epoch + 1)
 
     def __repr__(self):
         out = f"<AgMLDataLoader: (dataset={self.name}"
@@ -157,53 +193,32 @@ class AgMLDataLoader(AgMLSerializable):
         """
         return self._manager._resize_manager.size
 
-    def _generate_split_loader(self, contents, split):
+    def _view(self, indexes):
+        """Creates an `AgMLDataLoader` which is a view of a subset of the data.
+
+        The `indexes` are the positions of the samples in the underlying
+        data of this loader (independent of any shuffling or batching). The
+        new loader shares the data of this loader, but has its own copy of
+        the transform, resizing, shuffling, and batching state.
+        """
+        loader = super(AgMLDataLoader, self).__new__(AgMLDataLoader)
+        loader._info = self._info
+        loader._manager = self._manager.view(indexes)
+        loader._builder = loader._manager._builder
+        for attr in ['train', 'val', 'test']:
+            setattr(loader, f'_{attr}_data', None)
+        return loader
+
+    def _generate_split_loader(self, indexes, split):
         """Generates a split `AgMLDataLoader`."""
         # Check if the data split exists.
-        if contents is None:
+        if indexes is None:
             raise ValueError(
                 f"Attempted to access '{split}' split when "
                 f"the data has not been split for '{split}'.")
-
-        # Load a new `DataManager` and update its internal managers
-        # using the state of the existing loader's `DataManager`.
-        builder = DataBuilder.from_data(
-            contents = contents,
-            info = self.info,
-            root = self.dataset_root)
-        current_manager = copy.deepcopy(self._manager.__getstate__())
-        current_manager.pop('builder')
-        current_manager['builder'] = builder
-
-        # Build the new accessors and construct the `DataManager`.
-        accessors = np.arange(len(builder.get_contents()))
-        if self._manager._shuffle:
-            np.random.shuffle(accessors)
-        current_manager['accessors'] = accessors
-        batch_size = current_manager.pop('batch_size')
-        current_manager['batch_size'] = None
-        new_manager = DataManager.__new__(DataManager)
-        new_manager.__setstate__(current_manager)
-
-        # After the builder and accessors have been generated, we need
-        # to generate a new list of `DataObject`s.
-        new_manager._create_objects(
-            new_manager._builder, self.task)
-
-        # Batching data needs to be done independently.
-        if batch_size is not None:
-            new_manager.batch_data(batch_size = batch_size)
-
-        # Instantiate a new `AgMLDataLoader` from the contents.
-        loader_state = self.copy().__getstate__()
-        loader_state['builder'] = builder
-        loader_state['manager'] = new_manager
-        cls = super(AgMLDataLoader, self).__new__(AgMLDataLoader)
-        cls.__setstate__(loader_state)
-        for attr in ['train', 'val', 'test']:
-            setattr(cls, f'_{attr}_data', None)
-        cls._is_split = True
-        return cls
+        loader = self._view(indexes)
+        loader._is_split = True
+        return loader
 
     @property
     def train_data(self):
@@ -301,8 +316,90 @@ class AgMLDataLoader(AgMLSerializable):
         If `as_keras_sequence()` is called and the `AgMLDataLoader` inherits
         from `tf.keras.utils.Sequence`, then this method will shuffle the
         dataset on the end of each epoch to improve training.
+
+        This also moves on to the next epoch, which changes the random
+        transforms applied to each sample, and if the loader is sharded,
+        re-generates the shard from the permutation for the next epoch.
+        """
+        self._manager.on_epoch_end()
+
+    def shard(self, num_shards, index, drop_remainder = False, seed = 0):
+        """Restricts the loader to one shard of the data for distributed use.
+
+        When training with multiple processes (e.g., one for each GPU with
+        PyTorch's `DistributedDataParallel`, or over multiple nodes), each of
+        the processes should only load its own part of the data. This method
+        restricts the loader to the shard with the given `index` (i.e., the
+        rank of the process) out of `num_shards` (i.e., the world size).
+
+        All of the shards are generated from the same permutation of the data,
+        which is derived from the `seed` and the current epoch, so every
+        process needs to use the same `seed` (which also replaces the seed for
+        the random transforms, see the `seed` argument of the loader). This
+        makes the shards disjoint, and at the end of each epoch (in
+        `on_epoch_end()`, which is called by Keras, in `set_epoch()`, or after
+        a full iteration over the loader if enabled in `set_epoch()`), all of
+        the shards move on to the same new permutation. A DataLoader from
+        `export_torch()` moves on to the next epoch by itself.
+
+        If the data is batched (before or after sharding), then the batches
+        are formed from the samples in the shard. Note that with bucketing
+        (see `batch()`), the shards may end up with different numbers of
+        batches.
+
+        Parameters
+        ----------
+        num_shards : int
+            The total number of shards, e.g., the world size.
+        index : int
+            The index of the shard for this loader, e.g., the rank.
+        drop_remainder : bool
+            If the number of samples isn't divisible by the number of shards,
+            then whether to drop the last samples of the permutation (`True`),
+            or to repeat the first samples of the permutation (`False`, the
+            default) so that all of the shards have the same number of samples.
+        seed : int
+            The seed for the permutation of the data, shared by all shards.
+
+        Returns
+        -------
+        The `AgMLDataLoader` object.
+        """
+        self._manager.shard(num_shards = num_shards,
+                            index = index,
+                            drop_remainder = drop_remainder,
+                            seed = seed)
+        return self
+
+    def set_epoch(self, epoch, auto_increment = None):
+        """Sets the current epoch of the loader.
+
+        The random transforms of each sample depend on the epoch (as do the
+        samples in each shard), so setting the same epoch in all of the
+        processes gives them all the same permutation and transforms. This
+        is analogous to `DistributedSampler.set_epoch()` in PyTorch.
+
+        By default, the epoch only changes when it is set here, so repeated
+        passes over the loader (e.g., evaluation passes) see exactly the same
+        data. With `auto_increment`, every complete pass of iterating over
+        the loader moves it on to the next epoch once the pass is finished.
+
+        Parameters
+        ----------
+        epoch : int
+            The current epoch.
+        auto_increment : bool, optional
+            Whether each complete iteration over the loader increments the
+            epoch. If not given, the current setting is kept.
+
+        Returns
+        -------
+        The `AgMLDataLoader` object.
         """
-        self._manager._maybe_shuffle()
+        self._manager.set_epoch(epoch)
+        if auto_increment is not None:
+            self._manager._auto_epoch = bool(auto_increment) # noqa
+        return self
 
     def as_keras_sequence(self) -> "AgMLDataLoader":
         """Sets the `DataLoader` in TensorFlow mode.
@@ -454,7 +551,7 @@ class AgMLDataLoader(AgMLSerializable):
             # Convert the splits from floats to ints. If the sum of the int
             # splits are greater than the total number of data, then the largest
             # split is decreased in order to keep compatibility in usage.
-            num_images = self._info.num_images
+            num_images = self.num_samples
             proportions = {k: int(v * Decimal(num_images)) for k, v in valid_args.items()}
             if sum(proportions.values()) != num_images:
                 diff = sum(proportions.values()) - num_images
@@ -467,14 +564,14 @@ class AgMLDataLoader(AgMLSerializable):
         # Create the actual data splits.
         if all(isinstance(i, int) for i in valid_args.values()):
             # Ensure that the sum of the splits is the length of the dataset.
-            if not sum(valid_args.values()) == self._info.num_images:
+            if not sum(valid_args.values()) == self.num_samples:
                 raise ValueError(f"Got ints for input splits and expected a sum "
-                                 f"equal to the dataset length, {self._info.num_images},"
+                                 f"equal to the dataset length, {self.num_samples},"
                                  f"but instead got {sum(valid_args.values())}.")
 
             # The splits will be generated as sequences of indices.
             generated_splits = {}
-            split = np.arange(0, self._info.num_images)
+            split = np.arange(0, self.num_samples)
             names, splits = list(valid_args.keys()), list(valid_args.values())
 
             # Shuffling of the indexes will occur first, such that there is an even
@@ -495,14 +592,10 @@ class AgMLDataLoader(AgMLSerializable):
                 generated_splits = {k: v for k, v in zip(
                     names, [split_1, split_2, split_3])}
 
-            # Get the actual split contents from the manager. These contents are
-            # not `DataObject`s, rather they are simply the actual mapping of
-            # data to be passed to a `DataBuilder` when constructing the splits.
-            contents = self._manager.generate_split_contents(generated_splits)
-
-            # Build new `DataBuilder`s and `DataManager`s for the split data.
-            for split, content in contents.items():
-                setattr(self, f'_{split}_data', content)
+            # Store the indexes of each of the splits. The split loaders are
+            # constructed as views of this loader when they are accessed.
+            for split, indexes in generated_splits.items():
+                setattr(self, f'_{split}_data', indexes)
 
         # Otherwise, raise an error for an invalid type.
         else:
@@ -510,7 +603,67 @@ class AgMLDataLoader(AgMLSerializable):
                 "Expected either only ints or only floats when generating "
                 f"a data split, got {[type(i) for i in arg_dict.values()]}.")
 
-    def batch(self, batch_size = None):
+    def subset(self, indexes):
+        """Returns a new loader with a subset of the data in this loader.
+
+        The `indexes` are the positions of the samples in the data of this
+        loader, in the same order as the unshuffled data (so they don't depend
+        on any shuffling or batching of the loader), e.g., to generate folds
+        for cross-validation using `np.array_split(np.arange(num_samples), k)`,
+        where `num_samples` is given by `loader.num_samples`.
+
+        The new loader is a view which shares the underlying data with this
+        loader, so creating it is cheap, regardless of the size of the data.
+        It starts with a copy of the transforms, resizing, and batching of this
+        loader, which can be changed independently, and it can itself be split.
+
+        Parameters
+        ----------
+        indexes : array_like
+            The positions of the samples to keep in the new loader.
+
+        Returns
+        -------
+        A new `AgMLDataLoader` with the subset of the data.
+        """
+        indexes = np.asarray(indexes, dtype = np.int64)
+        if indexes.ndim != 1:
+            raise ValueError(f"Expected a one-dimensional array of "
+                             f"indexes, got shape {indexes.shape}.")
+        num_samples = self.num_samples
+        if len(indexes) != 0 and (indexes.min() < -num_samples
+                                  or indexes.max() >= num_samples):
+            raise IndexError(f"Subset indexes are out of range for "
+                             f"a loader with {num_samples} samples.")
+        return self._view(indexes % max(num_samples, 1))
+
+    def take(self, n):
+        """Returns a new loader with the first `n` samples of this loader.
+
+        The samples are taken in the current order of the loader (so if the
+        loader is shuffled, this is a random selection of samples). Like
+        with `subset()`, the new loader is a cheap view of this loader.
+
+        Parameters
+        ----------
+        n : int
+            The number of samples to take.
+
+        Returns
+        -------
+        A new `AgMLDataLoader` with the first `n` samples.
+        """
+        accessors = self._manager._accessors
+        if self._manager._batch_size is not None:
+            accessors = np.concatenate(list(accessors))
+        return self._view(np.asarray(accessors[:n], dtype = np.int64))
+
+    @property
+    def num_samples(self):
+        """Returns the number of samples in the loader (ignoring batching)."""
+        return len(self._manager._data_objects)
+
+    def batch(self, batch_size = None, bucket_by = None, num_buckets = 8):
         """Batches sets of image and annotation data according to a size.
 
         This method will group sets of data together into batches of size
@@ -526,20 +679,112 @@ class AgMLDataLoader(AgMLSerializable):
         The data can be un-batched by passing `None` to batch size (or
         calling the method with no arguments).
 
+        If the images in the dataset have different sizes (or orientations),
+        then they can be grouped into buckets of images with a similar aspect
+        ratio (or size) using `bucket_by`, and the batches are then formed
+        within each bucket. All of the images in a batch are resized to the
+        size of their bucket while keeping their aspect ratio, and padded
+        to exactly that size, so that they can be stacked with only minimal
+        padding (rather than being distorted to one size for the dataset).
+
         Parameters
         ----------
         batch_size : int, None
             The number of groups to batch data together into.
+        bucket_by : str, optional
+            Either 'aspect_ratio' or 'size', to group the batches into buckets
+            of images with a similar aspect ratio or size. If the images are
+            also resized using `resize_images`, then with 'aspect_ratio' the
+            bucket sizes keep the area of that image size.
+        num_buckets : int, optional
+            The number of buckets to group the images into (8 by default).
 
         Notes
         -----
-        The last batch will be of size <= `batch_size`.
+        The last batch will be of size <= `batch_size`. With buckets, the
+        last batch of each bucket may be smaller than `batch_size`.
         """
         self._manager.batch_data(
-            batch_size = batch_size
+            batch_size = batch_size,
+            bucket_by = bucket_by,
+            num_buckets = num_buckets
+        )
+
+    def prefetch(self, depth = 2, num_threads = None):
+        """Enables background prefetching when iterating over the loader.
+
+        By default, iterating over the loader loads each item (an image and
+        annotation, or a batch of them) on demand, so the consumer waits for
+        every item to be read, decoded, resized, and transformed. With this
+        enabled, a pool of worker threads loads up to `depth` fully processed
+        items ahead of the consumer, keeping them in a bounded queue so that
+        the loading of data overlaps with the consumer's work (e.g., a training
+        step). OpenCV releases the GIL when decoding and resizing images, so
+        this can overlap most of the loading time even with threads.
+
+        Items are still returned in the same order as the loader, and any
+        exception raised while loading an item is re-raised to the caller
+        when that item is reached. Prefetching only applies to iteration
+        (e.g., `for image, annotation in loader`), not to direct indexing.
+
+        To disable prefetching, pass `None` or `0` as the depth.
+
+        Parameters
+        ----------
+        depth : int
+            The maximum number of items which are loaded ahead of time.
+        num_threads : int, optional
+            The number of threads used to load items. Defaults to `depth`,
+            bounded by the number of available cores.
+
+        Returns
+        -------
+        The `AgMLDataLoader` object.
+        """
+        self._manager.set_prefetch(
+            depth = depth, num_threads = num_threads
+        )
+        return self
+
+    def use_executor(self, kind = 'thread', num_workers = None):
+        """Loads the samples within each batch in parallel.
+
+        By default, when the loader is batched, the samples of a batch are
+        loaded, decoded, resized, and transformed one after another. With
+        this enabled, the per-sample work of each batch is fanned out to a
+        pool of workers and then gathered back in order before the batch is
+        stacked, so the time taken to load a single batch scales with cores.
+
+        Two kinds of executors are supported:
+
+        1. `thread`: A thread pool. OpenCV releases the GIL while decoding
+           and resizing images, so this is usually the best choice.
+        2. `process`: A process pool. This can help when the transforms are
+           expensive pure-Python methods, but each sample (along with the
+           resizing and transforms) has to be pickled and sent to a worker,
+           so any transforms which are passed need to be picklable.
+
+        This can be combined with `prefetch()`, in which case multiple batches
+        are loaded ahead of time and each of them is also loaded in parallel.
+        To return to serial loading, pass `None` as the kind of executor.
+
+        Parameters
+        ----------
+        kind : str, optional
+            Either 'thread' or 'process', or `None` to disable.
+        num_workers : int, optional
+            The number of workers, defaults to the number of available cores.
+
+        Returns
+        -------
+        The `AgMLDataLoader` object.
+        """
+        self._manager.set_executor(
+            kind = kind, num_workers = num_workers
         )
+        return self
 
-    def resize_images(self, image_size = None):
+    def resize_images(self, image_size = None, reduced_decode = True):
         """Resizes images within the loader to a specified size.
 
         This method applies a resizing parameter for images before they are
@@ -570,10 +815,19 @@ class AgMLDataLoader(AgMLSerializable):
           using a nearest-neighbor interpolation to keep it as similar
           as possible to the original mask (preventing data loss).
 
+        When images are resized to a much smaller size, JPEG images which are
+        at least twice as large as the target size (in both dimensions) are
+        decoded directly at 1/2, 1/4, or 1/8 of their full resolution, and are
+        then resized to the exact size. This is much faster and uses less memory
+        than a full decode, but the results may differ very slightly from those
+        of resizing the full image. Use `reduced_decode = False` to disable it.
+
         Parameters
         ----------
         image_size : optional
             The resizing parameter for the image.
+        reduced_decode : bool
+            Whether to decode large JPEG images at a reduced resolution.
 
         Notes
         -----
@@ -581,13 +835,159 @@ class AgMLDataLoader(AgMLSerializable):
         *before* being passed into the transform pipeline.
         """
         self._manager.assign_resize(
-            image_size = image_size
+            image_size = image_size,
+            reduced_decode = reduced_decode
         )
 
+    def use_batch_buffers(self, enable = True, max_buffers = 4):
+        """Collates batches into reusable, preallocated buffers.
+
+        By default, every batch is stacked into a newly allocated array (and
+        in the 'torch' state, converted to a tensor with another copy). When
+        the images are resized to a fixed size (see `resize_images()`), this
+        instead writes each of the images directly into a recycled buffer of
+        shape `(B, H, W, C)`, or `(B, C, H, W)` of `float32` in the 'torch'
+        state, which is then returned as the batch without any further copy.
+
+        A buffer is only reused once the batch using it (and any tensors
+        sharing its memory) has been released, so up to `max_buffers` batches
+        can be held at once (e.g., when prefetching). If more are held, then
+        any further batches are allocated normally until some are released.
+
+        Parameters
+        ----------
+        enable : bool
+            Whether to enable or disable the batch buffers.
+        max_buffers : int
+            The maximum number of buffers which are kept for each batch shape.
+
+        Returns
+        -------
+        The `AgMLDataLoader` object.
+        """
+        self._manager.set_batch_buffers(max_buffers if enable else None)
+        return self
+
+    def cache_resized_images(self, enable = True, location = None):
+        """Enables a persistent on-disk cache of the resized images.
+
+        When images are resized (see `resize_images()`), every access to an
+        image would otherwise read and decode the full-size image, and then
+        shrink it. With this cache enabled, the result of the resizing (the
+        resized image, and the resized mask for semantic segmentation or the
+        rescaled bounding boxes, with all of their values, for object
+        detection) is written to disk as a raw array the first time that it
+        is loaded, and is read back directly as a memory map on all later
+        accesses, including in later runs.
+
+        The cache sits between the resizing and the transforms, so any random
+        augmentations are still applied freshly on every access. Entries are
+        stored separately for every resize shape and `reduced_decode` setting,
+        so changing either with `resize_images()` automatically stops any
+        stale entries from being used. Use `build_resized_cache()` to fill
+        the cache ahead of time.
+
+        Parameters
+        ----------
+        enable : bool
+            Whether to enable or disable the cache.
+        location : str, optional
+            The directory in which to store the cache. Defaults to a hidden
+            `.agml_cache` directory inside of the local dataset directory.
+
+        Returns
+        -------
+        The `AgMLDataLoader` object.
+
+        Notes
+        -----
+        The cache is keyed by the file names of the images, so if the contents
+        of the dataset are modified, the cache directory should be deleted.
+        """
+        if not enable:
+            location = None
+        elif location is None:
+            location = os.path.join(
+                self.dataset_root, '.agml_cache', 'resized')
+        self._manager.set_resize_cache(location)
+        return self
+
+    def build_resized_cache(self, num_workers = None):
+        """Fills the on-disk resize cache with the entire dataset.
+
+        This loads and resizes every image (and annotation) in the loader
+        using a pool of threads, and writes the results to the resize cache,
+        so that no decoding is done at all, even in the first epoch. Both
+        `cache_resized_images()` and `resize_images()` need to be set first.
+
+        Parameters
+        ----------
+        num_workers : int, optional
+            The number of threads to use, defaults to the number of cores.
+
+        Returns
+        -------
+        The `AgMLDataLoader` object.
+        """
+        self._manager.build_resize_cache(num_workers = num_workers)
+        return self
+
+    def materialize(self, enable = True, location = None, num_workers = None):
+        """Stores the entire resized dataset as memory-mapped tensors.
+
+        This loads and resizes every sample in the loader once, and writes
+        them into a `TensorStore`: one contiguous `(N, H, W, C)` array of
+        images, and one array of labels (or masks, for semantic segmentation),
+        stored as `.npy` files. From then on, samples are read directly from
+        the memory-mapped arrays, without any decoding or resizing. If there
+        are no transforms to apply, a batch is loaded as a single gather from
+        the arrays, without any per-sample processing. Since the arrays are
+        memory-mapped, the OS page cache is shared between all processes (e.g.,
+        data loader workers) which read from the same store.
+
+        A store is only valid for one image size, so `resize_images()` needs to
+        be called first (with a fixed size), and if the image size is changed
+        afterwards, the loader goes back to reading the original images. An
+        existing store at the location is re-used if it matches the data.
+
+        Parameters
+        ----------
+        enable : bool
+            Whether to enable or disable the store.
+        location : str, optional
+            The directory in which to store the arrays. Defaults to a hidden
+            `.agml_cache` directory inside of the local dataset directory.
+        num_workers : int, optional
+            The number of threads used to build the store, defaults to the
+            number of cores.
+
+        Returns
+        -------
+        The `AgMLDataLoader` object.
+
+        Notes
+        -----
+        This is not supported for object detection, since the number of
+        bounding boxes varies between images.
+        """
+        if not enable:
+            location = None
+        elif location is None:
+            if self._manager._resize_manager.size is None:
+                raise ValueError(
+                    "Cannot materialize a dataset when no image resizing "
+                    "is set, use `loader.resize_images()` first.")
+            location = os.path.join(
+                self.dataset_root, '.agml_cache', 'tensors',
+                self._manager.default_tensor_store_name())
+        self._manager.materialize(location, num_workers = num_workers)
+        return self
+
     def transform(self,
                   transform = NoArgument,
                   target_transform = NoArgument,
-                  dual_transform = NoArgument):
+                  dual_transform = NoArgument,
+                  batch_transform = NoArgument):
         """Applies vision transforms to the input image and annotation data.
 
         This method applies transformations to the image and annotation data
@@ -630,6 +1030,19 @@ class AgMLDataLoader(AgMLSerializable):
               random seed, for reproducibility. Use the provided method
               `generate_keras_segmentation_dual_transform` for this.
 
+        The `batch_transform` argument is used for transforms which are applied
+        to an entire batch at once, after all of the other transforms, once the
+        images have been stacked into a `(B, H, W, C)` batch. These only apply
+        when the loader is batched, and can be:
+
+            - One of the vectorized transforms in `agml.data.batch_transforms`,
+              e.g., `Normalize`, `Scale`, `RandomFlip`, `MixUp`, or `CutMix`.
+            - A method which accepts a batch of images and a batch of
+              annotations, and returns the two of them.
+
+        Since these run once per batch rather than once per sample, they are
+        much faster than the equivalent per-sample transforms for large batches.
+
         If you want to reset the transforms, then simply call this method
         with no arguments. Alternatively, to reset just a single transform,
         pass the value of that argument as `None`.
@@ -642,6 +1055,9 @@ class AgMLDataLoader(AgMLSerializable):
             A transform to be applied independently to the annotation.
         dual_transform : optional
             A transform to be applied to both the input and annotation.
+        batch_transform : optional
+            A transform to be applied to an entire batch of images and
+            annotations, after the other transforms.
 
         Notes
         -----
@@ -653,14 +1069,23 @@ class AgMLDataLoader(AgMLSerializable):
           would normally be passed to `dual_transform` (e.g., they act on the
           input image and the output annotation) can simply be passed to the
           `transform` argument and they will automatically be applied.
+        - Functional transforms can accept an `rng` argument, which is passed
+          a random `Generator` derived from the seed, epoch, and sample index.
+          `albumentations` and `torchvision` transforms (and others which use
+          the global random states) are instead seeded from that generator
+          for every sample, so their output is also the same regardless of
+          parallel loading, but they hold a process-wide lock while running,
+          so they are applied one at a time even in a thread pool.
         """
         self._manager.push_transforms(
             transform = transform,
             target_transform = target_transform,
-            dual_transform = dual_transform
+            dual_transform = dual_transform,
+            batch_transform = batch_transform
         )
 
-    def normalize_images(self, method = 'scale'):
+    def normalize_images(self, method = 'scale',
+                         dtype = 'float32', channels_first = False):
         """Converts images from 0-255 integers to 0-1 floats and normalizes.
 
         This is a convenience method to convert all images from integer-valued
@@ -684,10 +1109,21 @@ class AgMLDataLoader(AgMLSerializable):
 
         To remove normalization altogether, pass `None` as a parameter.
 
+        The normalization is precomputed once here, so each image is normalized
+        in a single pass (using a lookup table for `uint8` images), which writes
+        the output `dtype` directly. Integer images are scaled from the 0-255
+        range, while floating-point images are assumed to already be in 0-1.
+
         Parameters
         ----------
         method : str
             The method by which to normalize the images.
+        dtype : str
+            The dtype of the normalized images, either `float32` or `float16`.
+        channels_first : bool
+            Whether to output the images in a channels-first (CHW) layout. As
+            this changes the layout of the images, it should only be used when
+            there are no transforms afterwards which expect channels-last images.
 
         Notes
         -----
@@ -696,6 +1132,9 @@ class AgMLDataLoader(AgMLSerializable):
         """
         if method not in ['scale', 'imagenet', 'standard', None]:
             raise ValueError(f"Received invalid normalization method: '{method}'.")
+        if np.dtype(dtype) not in (np.float16, np.float32):
+            raise ValueError(f"Expected a dtype of either `float32` "
+                             f"or `float16` for normalization, got {dtype}.")
 
         if method == 'scale':
             normalization_params = 'scale'
@@ -704,10 +1143,11 @@ class AgMLDataLoader(AgMLSerializable):
         elif method == 'standard':
             normalization_params = self._info.image_stats
         else:
-            normalization_params = None
+            normalization_params = 'reset'
 
         self.transform(
-            transform = ('normalize', normalization_params)
+            transform = ('normalize', normalization_params,
+                         {'dtype': dtype, 'channels_first': channels_first})
         )
 
     def labels_to_one_hot(self):
@@ -823,6 +1263,10 @@ class AgMLDataLoader(AgMLSerializable):
 
         # Parse the transforms and resizing for the class.
         transforms = self._manager._transform_manager.get_transform_states()
+        if transforms.pop('batch_transform', None):
+            log("Batch transforms are not applied when exporting an "
+                "`AgMLDataLoader` to a `tf.data.Dataset`. To use batch "
+                "transforms in TensorFlow, use `as_keras_sequence()` instead.")
         resizing = self._manager._resize_manager.size
         exporter.digest_transforms(
             transforms = transforms,
@@ -851,6 +1295,13 @@ class AgMLDataLoader(AgMLSerializable):
         instead a copy of the instance the method is run on, so that any
         changes to the loader afterwards don't affect the exported loader.
 
+        Every iteration over the returned `DataLoader` after the first one
+        moves the enclosed loader on to its next epoch (see `set_epoch()`),
+        before any worker processes are started, so each epoch gets new
+        random transforms (and for a sharded loader, a new permutation).
+        With `persistent_workers`, the workers keep the epoch they started
+        with, so call `set_epoch()` on the `dataset` of the loader instead.
+
         Parameters
         ----------
 
@@ -875,8 +1326,11 @@ class AgMLDataLoader(AgMLSerializable):
         batch_size = loader_kwargs.pop(
             'batch_size', self._manager._batch_size)
         self.batch(None)
+        # A sharded loader already shuffles its data with the permutation
+        # for each epoch (see `set_epoch()`), so this isn't done again.
         shuffle = loader_kwargs.pop(
-            'shuffle', self._manager._shuffle)
+            'shuffle', self._manager._shuffle
+            and self._manager._sharding is None)
 
         # The `collate_fn` for object detection is different because
         # the COCO JSON dictionaries each have different formats. So,
@@ -889,9 +1343,19 @@ class AgMLDataLoader(AgMLSerializable):
                 coco = tuple(zip(*[i[1] for i in batch]))
                 return images, coco
 
+        # Each new iteration over the `DataLoader` is a new epoch.
+        class _EpochDataLoader(DataLoader):
+            _iterated = False
+
+            def __iter__(self):
+                if self._iterated:
+                    self.dataset.set_epoch(self.dataset._manager._epoch + 1) # noqa
+                self._iterated = True
+                return super().__iter__()
+
         # Return the DataLoader with a copy of this AgMLDataLoader, so
         # that changes to this will not affect the returned loader.
-        return DataLoader(
+        return _EpochDataLoader(
             self.copy(), # noqa
             batch_size = batch_size,
             shuffle = shuffle,
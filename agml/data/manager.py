@@ -12,6 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import hashlib
+import itertools
+import threading
+
 import numpy as np
 
 from agml.framework import AgMLSerializable
@@ -20,11 +25,67 @@ from agml.data.builder import DataBuilder
 from agml.data.metadata import DatasetMetadata
 from agml.data.managers.transforms import TransformManager
 from agml.data.managers.resize import ImageResizeManager
-from agml.data.managers.training import TrainingManager
+from agml.data.managers.training import TrainingManager, TrainState
+from agml.data.cache import TensorStore
+from agml.data.buffers import BatchBufferPool
+from agml.data.index import LazyDataObjects, DataObjectView
+from agml.data.manifest import load_image_shapes, write_image_shapes
+from agml.data.annotations import find_coco_store, register_coco_store
+from agml.data.packed import find_packed_dataset
+from agml.data.cache import image_cache_info, set_image_cache_size
 
 from agml.utils.general import seed_context, NoArgument
 from agml.utils.image import consistent_shapes
-from agml.utils.logging import log
+from agml.utils.logging import log, tqdm
+from agml.utils.parallel import build_executor
+
+
+# Guards the lazily constructed state of the managers (the worker and buffer
+# pools and the `TensorStore` rows), which can be requested concurrently by
+# the consumer and the prefetching threads, as well as the submission of
+# work to the worker pools, so that a pool isn't shut down in the middle.
+_LAZY_STATE_LOCK = threading.RLock()
+
+
+# The `TrainingManager` of the loader in a process pool worker. This is sent
+# once when each worker starts (see `_init_process_worker()`), rather than
+# being pickled and sent along with every sample.
+_WORKER_TRAIN_MANAGER = None
+
+
+def _init_process_worker(train_manager, root, coco_store, image_cache_bytes):
+    """Initializes a process pool worker with the state of a loader.
+
+    Workers which are spawned (rather than forked) start with empty module
+    registries, so the annotation store and the packed copy of the dataset,
+    as well as the size of the decoded image cache, are registered again, so
+    that the workers use the same fast paths as the main process.
+    """
+    global _WORKER_TRAIN_MANAGER
+    _WORKER_TRAIN_MANAGER = train_manager
+    if coco_store is not None and find_coco_store(root) is None:
+        register_coco_store(root, coco_store)
+    find_packed_dataset(root)
+    if image_cache_bytes > 0:
+        set_image_cache_size(image_cache_bytes)
+
+
+def _apply_in_worker(method, *args):
+    """Calls a method of the `TrainingManager` of a process pool worker."""
+    return getattr(_WORKER_TRAIN_MANAGER, method)(*args)
+
+
+def _seed_from_global_state():
+    """Derives a seed from NumPy's global random state without advancing it.
+
+    The seed is a hash of the current state, so it is reproducible after
+    `np.random.seed` (or `agml.backend.set_seed`), but unlike drawing a
+    random number, it doesn't change the numbers drawn afterwards.
+    """
+    _, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    digest = hashlib.sha1(np.asarray(keys).tobytes())
+    digest.update(repr((position, has_gauss, cached_gaussian)).encode('utf-8'))
+    return int.from_bytes(digest.digest()[:4], 'little') & ((1 << 31) - 1)
 
 
 class DataManager(AgMLSerializable):
@@ -48,7 +109,33 @@ class DataManager(AgMLSerializable):
     serializable = frozenset((
         'data_objects', 'resize_manager', 'accessors', 'task',
         'dataset_name', 'shuffle', 'batch_size', 'dataset_root',
-        'transform_manager', 'builder', 'train_manager'))
+        'transform_manager', 'builder', 'train_manager', 'prefetch',
+        'executor', 'tensor_store', 'batch_buffers', 'compact_index',
+        'image_shapes', 'bucketing', 'bucket_sizes', 'sharding',
+        'seed', 'epoch', 'auto_epoch'))
+
+    # The `DataObject`s, the builder with the dataset contents, the tensor
+    # store, and the image shapes are shared between copies of the manager,
+    # which only copy the transform, resizing, training, shuffling and
+    # batching state.
+    immutable = frozenset(
+        ('data_objects', 'builder', 'tensor_store', 'image_shapes'))
+
+    # The valid ways to group samples into buckets when batching them.
+    _bucket_kinds = ('aspect_ratio', 'size')
+
+    # The live worker pool used to load batches in parallel. This is not
+    # serialized (only its configuration, `_executor`, is), so copies of
+    # the manager lazily construct their own pool when they first need it.
+    _executor_pool = None
+
+    # The pool of reusable batch buffers, which (like the executor pool)
+    # is not serialized, but constructed from `_batch_buffers` when used.
+    _buffer_pool = None
+
+    # The rows of the `TensorStore` for each of the `DataObject`s, which
+    # are looked up lazily (and re-generated whenever the objects are).
+    _tensor_rows = None
 
     def __init__(self, builder, task, name, root, **kwargs):
         # Set the basic class information.
@@ -63,6 +150,7 @@ class DataManager(AgMLSerializable):
                 info = DatasetMetadata(name),
                 root = root)
         self._builder = builder
+        self._compact_index = kwargs.get('compact_index', False)
         self._create_objects(self._builder, task)
 
         # Set up the internal transform managers. These control
@@ -101,8 +189,52 @@ class DataManager(AgMLSerializable):
         # used internally or accessed by the `AgMLDataLoader` externally.
         self._batch_size = None
         self._shuffle = kwargs.get('shuffle', True)
+
+        # When batches are grouped into buckets of similar images, this
+        # stores the `(bucket_by, num_buckets)`, and the bucket sizes store
+        # the `(width, height)` that each image is resized to in a batch.
+        self._bucketing = None
+        self._bucket_sizes = None
+
+        # The seed and the epoch determine the random `Generator` used to
+        # transform each sample (see `_sample_rng()`), as well as the data
+        # permutation shared by all shards when the data is sharded between
+        # multiple processes, in which case this stores the `(num_shards,
+        # index, drop_remainder)` of this shard. By default, the seed is
+        # derived from the global random state (so `np.random.seed` applies),
+        # without advancing it (see `_seed_from_global_state()`).
+        self._sharding = None
+        self._seed = kwargs.get('seed', None)
+        if self._seed is None:
+            self._seed = _seed_from_global_state()
+        self._epoch = 0
+
+        # Whether iterating over the loader increments the epoch after each
+        # complete pass (see `AgMLDataLoader.set_epoch()`), off by default.
+        self._auto_epoch = False
+
         self._maybe_shuffle()
 
+        # Background prefetching is disabled by default. When enabled,
+        # this stores the `(depth, num_threads)` used for iteration.
+        self._prefetch = None
+
+        # Similarly, the samples in a batch are loaded serially unless
+        # an executor is set, which stores the `(kind, num_workers)`.
+        self._executor = None
+
+        # An optional memory-mapped `TensorStore` of the resized data.
+        self._tensor_store = None
+
+        # The maximum number of reusable batch buffers for each batch
+        # shape, or `None` if batches are collated into new arrays.
+        self._batch_buffers = None
+
+        # The `(width, height, channels)` of each of the images, which is
+        # indexed lazily when it is first needed (e.g., for bucketed batching
+        # or 'auto' resizing), and persisted in the manifest of the dataset.
+        self._image_shapes = None
+
     def data_length(self):
         """Calculates the length of the data based on the batching state."""
         return len(self._accessors)
@@ -113,6 +245,16 @@ class DataManager(AgMLSerializable):
         Here, `content` is a dictionary mapping an an input data piece,
         an image, with its corresponding expected output, its annotation.
         """
+        self._tensor_rows = None
+
+        # In the compact mode, the contents are stored in a columnar
+        # `SampleIndex`, and `DataObject`s are only created on demand.
+        if self._compact_index:
+            self._data_objects = LazyDataObjects(
+                index = builder.compact(), task = task,
+                root = self._dataset_root)
+            return
+
         self._data_objects = []
         contents = builder.get_contents()
         if 'inputs' in contents.keys():
@@ -123,7 +265,7 @@ class DataManager(AgMLSerializable):
         for content in list(contents):
             self._data_objects.append(DataObject.create(
                 contents = content, task = task,
-                root = self._dataset_root))
+                root = self._dataset_root, from_store = True))
 
     def _maybe_shuffle(self, seed = None):
         """Wraps automatic shuffling to see if it is enabled or not."""
@@ -132,7 +274,8 @@ class DataManager(AgMLSerializable):
 
     def update_train_state(self, state):
         """Updates the training state in the `TrainingManager`."""
-        self._train_manager.update_state(state)
+        self._train_manager.update_state(state, shapes = self.image_shapes)
+        self._reset_worker_state()
 
     def shuffle(self, seed = None):
         """Shuffles the contents of the `DataManager`.
@@ -140,34 +283,358 @@ class DataManager(AgMLSerializable):
         This method simply shuffles the order of the `DataObject`s
         which are stored inside this `DataManager`. Optionally, a seed
         can be provided to shuffle them inside of a specific context.
+
+        When the batches are grouped into buckets, the batches are formed
+        again from the samples in each of the (shuffled) buckets, and the
+        order of the batches is shuffled across all of the buckets.
+
+        When the data is sharded, the order is instead determined by the
+        seed and the epoch, so that it is the same for all shards; a
+        `seed` given here then replaces the seed of the manager.
         """
+        if self._sharding is not None:
+            if seed is not None:
+                self._seed = seed
+            self._apply_sharding(shuffle = True)
+            return
         if seed is None:
-            np.random.shuffle(self._accessors)
+            self._shuffle_accessors()
         else:
             with seed_context(seed):
-                np.random.shuffle(self._accessors)
+                self._shuffle_accessors()
 
-    def generate_split_contents(self, splits):
-        """Generates split contents given a dictionary of the split indexes.
+    def _shuffle_accessors(self):
+        if self._bucketing is not None and self._batch_size is not None:
+            self._accessors = self._bucket_batches(
+                np.concatenate(self._accessors), shuffle = True)
+        else:
+            np.random.shuffle(self._accessors)
 
-        This method, given a set of data split indexes, applies the indexing
-        to the original content and gets a mapping of images and annotations
-        which are returned back to the `AgMLDataLoader` to be constructed into
-        `DataBuilder`s and wrapped into new `DataManager`s.
+    def set_prefetch(self, depth, num_threads = None):
+        """Sets the depth and number of threads for background prefetching.
+
+        The actual prefetching is done by the `AgMLDataLoader` when it is
+        iterated over; this only stores the parameters. Passing `None` or
+        `0` as the depth disables background prefetching altogether.
         """
-        contents = np.array(
-            list(self._builder.get_contents().items()), dtype = object)
-        return {
-            k: dict(contents[v]) for k, v in splits.items()
-        }
+        if depth is None or depth == 0:
+            self._prefetch = None
+            return
+        if not isinstance(depth, int) or depth < 0:
+            raise ValueError(f"Expected a non-negative integer "
+                             f"prefetch depth, got {depth}.")
+        if num_threads is not None and num_threads < 1:
+            raise ValueError(f"Expected at least one prefetch "
+                             f"thread, got {num_threads}.")
+        self._prefetch = (depth, num_threads)
+
+    def set_executor(self, kind, num_workers = None):
+        """Sets the executor used to load the samples of a batch in parallel.
+
+        The `kind` can be either 'thread' or 'process', and passing `None`
+        resets the manager to loading the samples of a batch serially. The
+        actual pool is only constructed when the first batch is loaded.
+
+        Any existing pool is drained (the batches which were already
+        submitted to it, e.g., by prefetching threads, are completed)
+        before it is shut down.
+        """
+        self._shutdown_executor_pool()
+        if kind is None:
+            self._executor = None
+            return
+        if kind not in ['thread', 'process']:
+            raise ValueError(f"Invalid executor kind '{kind}', expected "
+                             f"either 'thread', 'process', or `None`.")
+        if num_workers is not None and num_workers < 1:
+            raise ValueError(f"Expected at least one worker, got {num_workers}.")
+        self._executor = (kind, num_workers)
+
+    def _get_executor_pool(self):
+        """Returns the worker pool for batch loading, if one is set.
+
+        A process pool is initialized with the `TrainingManager` (see
+        `_init_process_worker()`), so it is rebuilt whenever the state
+        of the `TrainingManager` changes (see `_reset_worker_state()`).
+        """
+        if self._executor is None:
+            return None
+        with _LAZY_STATE_LOCK:
+            if self._executor_pool is None:
+                kind, num_workers = self._executor
+                if kind == 'process':
+                    self._executor_pool = build_executor(
+                        kind, num_workers, initializer = _init_process_worker,
+                        initargs = (self._train_manager, self._dataset_root,
+                                    find_coco_store(self._dataset_root),
+                                    image_cache_info()['max_bytes']))
+                else:
+                    self._executor_pool = build_executor(kind, num_workers)
+            return self._executor_pool
+
+    def _shutdown_executor_pool(self):
+        """Drains and shuts down the current worker pool, if there is one."""
+        with _LAZY_STATE_LOCK:
+            pool, self._executor_pool = self._executor_pool, None
+        if pool is not None:
+            pool.shutdown(wait = True)
+
+    def _reset_worker_state(self):
+        """Rebuilds a process pool after the `TrainingManager` changes."""
+        if self._executor is not None and self._executor[0] == 'process':
+            self._shutdown_executor_pool()
+
+    def set_batch_buffers(self, max_buffers):
+        """Sets the number of reusable batch buffers (or `None` to disable)."""
+        if max_buffers is not None and max_buffers < 1:
+            raise ValueError(f"Expected at least one batch buffer, got {max_buffers}.")
+        self._batch_buffers = max_buffers
+        self._buffer_pool = None
+
+    def _get_buffer_pool(self):
+        """Returns the pool of batch buffers, constructing it if necessary."""
+        if self._batch_buffers is None:
+            return None
+        with _LAZY_STATE_LOCK:
+            if self._buffer_pool is None:
+                self._buffer_pool = BatchBufferPool(
+                    max_buffers = self._batch_buffers)
+            return self._buffer_pool
+
+    def view(self, indexes):
+        """Creates a `DataManager` for a subset of this manager's data.
+
+        The new manager accesses the `DataObject`s (and the content) of this
+        manager through an array of indexes, rather than having its own copy
+        of them, so creating it is only O(len(indexes)). It does, however,
+        get its own copy of the transform, resizing, and training state, as
+        well as its own shuffling and batching, which are all independent.
+        """
+        indexes = np.asarray(indexes, dtype = np.int64)
+        view = copy.copy(self)
+        view._data_objects = DataObjectView(self._data_objects, indexes)
+        view._builder = self._builder.view(indexes)
+        if self._image_shapes is not None:
+            view._image_shapes = self._image_shapes[indexes]
+
+        # The view has its own accessors, which are then re-batched.
+        view._accessors = np.arange(len(indexes))
+        view._batch_size = None
+        view._bucketing, view._bucket_sizes = None, None
+        view._sharding = None
+        view._maybe_shuffle()
+        if self._batch_size is not None:
+            bucket_by, num_buckets = self._bucketing or (None, None)
+            view.batch_data(batch_size = self._batch_size,
+                            bucket_by = bucket_by,
+                            num_buckets = num_buckets)
+        return view
+
+    def shard(self, num_shards, index, drop_remainder = False, seed = 0):
+        """Restricts the data to one of `num_shards` disjoint shards.
+
+        All of the shards use the same permutation of the data, which is
+        generated from the `seed` and the current epoch (so every shard
+        needs to be created with the same seed), and the shard with the
+        given `index` takes every `num_shards`-th sample of it. If the number
+        of samples isn't divisible by `num_shards`, then either the last
+        samples are dropped (`drop_remainder`), or the first samples of the
+        permutation are repeated, so that all of the shards have the same
+        number of samples. If the data is batched, the shard is re-batched.
+        """
+        if not isinstance(num_shards, int) or num_shards < 1:
+            raise ValueError(f"Expected a positive integer number "
+                             f"of shards, got {num_shards}.")
+        if not isinstance(index, int) or not 0 <= index < num_shards:
+            raise ValueError(f"Expected a shard index in the range "
+                             f"[0, {num_shards}), got {index}.")
+        if drop_remainder and len(self._data_objects) < num_shards:
+            raise ValueError(f"Cannot split {len(self._data_objects)} samples "
+                             f"into {num_shards} shards with `drop_remainder`.")
+        self._sharding = (num_shards, index, bool(drop_remainder))
+        self._seed = seed
+        self._epoch = 0
+        self._apply_sharding(shuffle = self._shuffle)
+
+    def set_epoch(self, epoch):
+        """Sets the epoch, which changes the random transforms of each sample.
+
+        If the data is sharded, then this also re-generates the shard.
+        """
+        self._epoch = epoch
+        if self._sharding is not None:
+            self._apply_sharding(shuffle = self._shuffle)
+
+    def on_epoch_end(self):
+        """Moves on to the next epoch, and shuffles the data if enabled."""
+        if self._sharding is not None:
+            self.set_epoch(self._epoch + 1)
+        else:
+            self._epoch += 1
+            self._maybe_shuffle()
 
-    def batch_data(self, batch_size):
+    def _sample_rng(self, index):
+        """Returns the random `Generator` for transforming a sample.
+
+        The generator is derived from the seed, the epoch, and the index of
+        the sample, so the random transforms applied to a sample are the same
+        regardless of which thread or process loads it (or in which order),
+        and without touching the global random state. If there are no active
+        transforms, then this returns `None`, since there is no need for one.
+        """
+        if not self._train_manager.transforms_active:
+            return None
+        return np.random.default_rng(np.random.SeedSequence(
+            (self._seed, self._epoch, int(index))))
+
+    def _batch_rng(self, batch_indexes):
+        """Returns the random `Generator` for the batch transforms of a batch.
+
+        Similarly to `_sample_rng()`, this is derived from the seed, the epoch,
+        and the indexes of the samples in the batch (from a separate stream
+        than those of the samples). If there are no active batch transforms,
+        then this returns `None`.
+        """
+        if not self._train_manager.batch_transforms_active:
+            return None
+        return np.random.default_rng(np.random.SeedSequence(
+            (self._seed, self._epoch) + tuple(int(i) for i in batch_indexes),
+            spawn_key = (1, )))
+
+    def _apply_sharding(self, shuffle):
+        """Regenerates the accessors of the shard for the current epoch."""
+        num_shards, index, drop_remainder = self._sharding
+        num_samples = len(self._data_objects)
+        if shuffle:
+            with seed_context((self._seed, self._epoch)):
+                order = np.random.permutation(num_samples)
+        else:
+            order = np.arange(num_samples)
+        if drop_remainder:
+            order = order[:num_samples - num_samples % num_shards]
+        else:
+            order = np.resize(order, -(-num_samples // num_shards) * num_shards)
+
+        # The batches are formed from the samples of the shard (with the
+        # bucketing, if any, seeded so that it is also reproducible).
+        batch_size, bucketing = self._batch_size, self._bucketing
+        self._accessors = order[index::num_shards]
+        self._batch_size, self._bucketing, self._bucket_sizes = None, None, None
+        if batch_size is not None:
+            bucket_by, num_buckets = bucketing or (None, None)
+            with seed_context((self._seed, self._epoch, index)):
+                self.batch_data(batch_size = batch_size,
+                                bucket_by = bucket_by,
+                                num_buckets = num_buckets)
+
+    def image_shapes(self):
+        """Returns an `(N, 3)` array of the `(width, height, channels)` of images.
+
+        The shapes are read from the headers of JPEG and PNG images (in
+        parallel), so the images aren't decoded, and are then stored (and
+        shared with copies). For a local dataset, the shapes are also stored
+        in its manifest, so later loaders of the dataset only read the shapes
+        of images which haven't been indexed yet (e.g., if files were added).
+        """
+        if self._image_shapes is None:
+            objects = self._data_objects
+            paths = [obj._image_path() for obj in objects]
+            index = load_image_shapes(self._dataset_root)
+            missing = [i for i, path in enumerate(paths) if path not in index]
+            if len(missing) != 0:
+                with build_executor('thread') as pool:
+                    shapes = list(tqdm(
+                        pool.map(lambda i: objects[i].get_image_shape(), missing),
+                        total = len(missing), desc = 'Indexing Image Shapes'))
+                index.update(zip((paths[i] for i in missing), shapes))
+                write_image_shapes(self._dataset_root, index)
+            self._image_shapes = np.array(
+                [index[path] for path in paths], dtype = np.int64).reshape(-1, 3)
+        return self._image_shapes
+
+    def image_sizes(self):
+        """Returns an `(N, 2)` array of the `(width, height)` of each image."""
+        return self.image_shapes()[:, :2]
+
+    def _bucket_batches(self, accessors, shuffle):
+        """Groups samples into buckets of similar images, and batches them.
+
+        The samples are sorted into `num_buckets` buckets with (roughly) the
+        same number of samples, by either the aspect ratio or the area of
+        their images (or if there are at most `num_buckets` distinct values,
+        into one bucket for each). Each bucket then has one size that all of its images
+        are resized and padded to (see `ImageResizeManager.letterbox()`):
+
+        - For 'aspect_ratio', the size has the median aspect ratio of the
+          images in the bucket, and either the area of the image size which
+          the images are resized to, or otherwise the median image area.
+        - For 'size', the size is the median width and height of the images.
+
+        The batches are formed within each bucket (so only the last batch of
+        each bucket can be smaller than the batch size), and when shuffling,
+        both the samples in each bucket and the order of batches are shuffled.
+        """
+        bucket_by, num_buckets = self._bucketing
+        accessors = np.asarray(accessors, dtype = np.int64)
+        if shuffle:
+            accessors = np.random.permutation(accessors)
+        sizes = self.image_sizes()[accessors].astype(np.float64)
+        widths, heights = sizes[:, 0], sizes[:, 1]
+        if bucket_by == 'aspect_ratio':
+            keys = np.log(widths / heights)
+        else:
+            keys = np.log(widths * heights)
+        unique_keys = np.unique(keys)
+        if len(unique_keys) <= num_buckets:
+            assignments = np.searchsorted(unique_keys, keys)
+        else:
+            edges = np.unique(np.quantile(
+                keys, np.linspace(0, 1, num_buckets + 1)[1:-1]))
+            assignments = np.searchsorted(edges, keys, side = 'right')
+
+        bucket_sizes = np.zeros((len(self._data_objects), 2), dtype = np.int64)
+        batches = []
+        for bucket in np.unique(assignments):
+            members = assignments == bucket
+            b_widths, b_heights = widths[members], heights[members]
+            if bucket_by == 'aspect_ratio':
+                ratio = np.median(b_widths / b_heights)
+                if self._resize_manager.size is not None:
+                    area = np.prod(self._resize_manager.size)
+                else:
+                    area = np.median(b_widths * b_heights)
+                size = (np.sqrt(area * ratio), np.sqrt(area / ratio))
+            else:
+                size = (np.median(b_widths), np.median(b_heights))
+            bucket_sizes[accessors[members]] = np.maximum(np.round(size), 1)
+            samples = accessors[members]
+            batches.extend(samples[i:i + self._batch_size]
+                           for i in range(0, len(samples), self._batch_size))
+        self._bucket_sizes = bucket_sizes
+
+        if shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return self._batch_array(batches)
+
+    def batch_data(self, batch_size, bucket_by = None, num_buckets = 8):
         """Batches the data into consistent groups.
 
         The batched data is stored inside of this manager, as a set of
         indexes which are read and loaded when the data is accessed.
         See the information above the `_accessors` parameter above.
+
+        If `bucket_by` is given, then the batches are formed from buckets
+        of images with a similar aspect ratio or size (see `_bucket_batches`).
         """
+        if bucket_by is not None:
+            if bucket_by not in self._bucket_kinds:
+                raise ValueError(f"Invalid bucketing '{bucket_by}', expected "
+                                 f"one of {self._bucket_kinds} or `None`.")
+            if not isinstance(num_buckets, int) or num_buckets < 1:
+                raise ValueError(f"Expected a positive integer number of "
+                                 f"buckets, got {num_buckets}.")
+        self._bucketing, self._bucket_sizes = None, None
+
         # If the data is already batched and a new batch size is called,
         # then update the existing batch sizes. For unbatching the data,
         # update the batch state and then flatten the accessor array.
@@ -186,33 +653,135 @@ class DataManager(AgMLSerializable):
         if batch_size == 1:
             return
 
+        # With bucketing, the batches are formed within each bucket.
+        if bucket_by is not None:
+            self._batch_size = batch_size
+            self._bucketing = (bucket_by, num_buckets)
+            self._accessors = self._bucket_batches(
+                self._accessors, shuffle = self._shuffle)
+            return
+
         # Otherwise, calculate the actual batches and the overflow
         # of the contents, and then update the accessor.
         num_splits = len(self._accessors) // batch_size
         data_items = np.array(self._accessors)
         overflow = len(self._accessors) - num_splits * batch_size
-        extra_items = data_items[-overflow:]
-        batches = np.array_split(
-            np.array(self._accessors
-                     [:num_splits * batch_size]), num_splits)
-        batches.append(extra_items)
-        self._accessors = np.array(batches, dtype = object)
+        batches = []
+        if num_splits != 0:
+            batches = np.array_split(
+                data_items[:num_splits * batch_size], num_splits)
+        if overflow != 0:
+            batches.append(data_items[-overflow:])
+        self._accessors = self._batch_array(batches)
         self._batch_size = batch_size
 
-    def assign_resize(self, image_size):
+    @staticmethod
+    def _batch_array(batches):
+        """Stores a list of batches of indexes in a 1-d object array."""
+        # This can't be created directly with `np.array` from a list of
+        # arrays, since if they all have the same length, it is 2-d.
+        out = np.empty(len(batches), dtype = object)
+        for i, batch in enumerate(batches):
+            out[i] = batch
+        return out
+
+    def assign_resize(self, image_size, reduced_decode = True):
         """Assigns a resizing factor for the image and annotation data."""
         if image_size is None:
             image_size = 'default'
-        self._resize_manager.assign(image_size)
+        self._resize_manager.assign(image_size, shapes = self.image_shapes)
+        self._resize_manager.set_reduced_decode(reduced_decode)
+        self._reset_worker_state()
+
+    def set_resize_cache(self, location):
+        """Enables (or with `None`, disables) the on-disk resize cache."""
+        self._resize_manager.set_disk_cache(location)
+        self._reset_worker_state()
+
+    def build_resize_cache(self, num_workers = None):
+        """Resizes all of the data and writes it to the on-disk resize cache."""
+        if self._resize_manager.disk_cache is None:
+            raise ValueError("The resize cache is not enabled, call "
+                             "`loader.cache_resized_images()` first.")
+        if self._resize_manager.size is None:
+            raise ValueError("Cannot build a resize cache when no image "
+                             "resizing is set, use `loader.resize_images()`.")
+        with build_executor('thread', num_workers) as pool:
+            for _ in tqdm(pool.map(self._resize_manager.load, self._data_objects),
+                          total = len(self._data_objects),
+                          desc = 'Building Resize Cache'):
+                pass
+
+    def default_tensor_store_name(self):
+        """Returns a name identifying the image size and data of a store."""
+        digest = hashlib.sha1()
+        for obj in self._data_objects:
+            digest.update(TensorStore.object_key(obj).encode('utf-8'))
+        width, height = self._resize_manager.size
+        return f'{width}x{height}-{digest.hexdigest()[:8]}'
+
+    def materialize(self, location, num_workers = None):
+        """Builds (or re-uses) a `TensorStore` of all of the resized data."""
+        if location is None:
+            self._tensor_store, self._tensor_rows = None, None
+            return
+        if self._resize_manager.size is None:
+            raise ValueError("Cannot materialize a dataset when no image "
+                             "resizing is set, use `loader.resize_images()`.")
+        if self._task == 'object_detection':
+            raise ValueError("Object detection datasets cannot be materialized "
+                             "into a `TensorStore`, since the number of bounding "
+                             "boxes varies between images.")
+        if TensorStore.exists(location):
+            store = TensorStore(location = location, task = self._task)
+            if store.image_size != tuple(self._resize_manager.size) \
+                    or store.rows_for(self._data_objects) is None:
+                store = None
+        else:
+            store = None
+        if store is None:
+            store = TensorStore.build(
+                location = location, task = self._task,
+                image_size = self._resize_manager.size,
+                objects = self._data_objects,
+                load_fn = self._resize_manager.load,
+                num_workers = num_workers)
+        self._tensor_store, self._tensor_rows = store, None
+
+    def _get_tensor_rows(self):
+        """Returns the `TensorStore` rows of the data, if the store is usable.
+
+        The store is only used when it contains all of the data objects, the
+        current image size matches the stored one, and the loader isn't in a
+        raw (`False`) state, since that skips resizing entirely.
+        """
+        store = self._tensor_store
+        if store is None or self._train_manager.state is TrainState.FALSE:
+            return None
+        if self._resize_manager.size is None or \
+                tuple(self._resize_manager.size) != store.image_size:
+            return None
+        with _LAZY_STATE_LOCK:
+            if self._tensor_rows is None:
+                rows = store.rows_for(self._data_objects)
+                if rows is None:
+                    log("The `TensorStore` of this loader doesn't contain all "
+                        "of its data, so it is being disabled. Call "
+                        "`loader.materialize()` again to rebuild it.")
+                    self._tensor_store = None
+                    return None
+                self._tensor_rows = rows
+            return self._tensor_rows
 
     def push_transforms(self, **transform_dict):
         """Pushes a transformation to the data transform pipeline."""
         # Check if any transforms are being reset and assign them as such.
-        if all(i is NoArgument for i in transform_dict):
+        if all(i is NoArgument for i in transform_dict.values()):
             transform_dict = {
                 'transform': 'reset',
                 'target_transform': 'reset',
-                'dual_transform': 'reset'
+                'dual_transform': 'reset',
+                'batch_transform': 'reset'
             }
         else:
             empty_keys, reset_keys = [], []
@@ -236,11 +805,19 @@ class DataManager(AgMLSerializable):
         # Assign the transforms to the manager.
         for key, transform in transform_dict.items():
             self._transform_manager.assign(key, transform)
+        self._reset_worker_state()
 
-    def _load_one_image_and_annotation(self, obj):
+    def _load_one_image_and_annotation(self, index, bucket_size = None):
         """Loads one image and annotation from a `DataObject`."""
+        batch_state = self._batch_size is not None
+        rows = self._get_tensor_rows() if bucket_size is None else None
+        rng = self._sample_rng(index)
+        if rows is not None:
+            return self._train_manager.process(
+                self._tensor_store.get(rows[index]), batch_state, rng)
         return self._train_manager.apply(
-            obj = obj, batch_state = self._batch_size is not None
+            obj = self._data_objects[index], batch_state = batch_state,
+            bucket_size = bucket_size, rng = rng
         )
 
     def _load_multiple_items(self, indexes):
@@ -253,7 +830,7 @@ class DataManager(AgMLSerializable):
         else:
             for i in indexes:
                 contents.append(self._load_one_image_and_annotation(
-                    self._data_objects[self._accessors[i]]))
+                    self._accessors[i]))
         return contents
 
     def _batch_multi_image_inputs(self, images):
@@ -304,16 +881,80 @@ class DataManager(AgMLSerializable):
         dataset, such as a slice, in that it also stacks the data together
         into a valid batch and returns it as such.
         """
-        # Get the images and annotations from the data objects.
+        # If the batches are grouped into buckets, then all of the images in
+        # the batch are resized (and padded) to the size of their bucket.
+        bucket_size = None
+        if self._bucket_sizes is not None:
+            bucket_size = tuple(int(i) for i in
+                                self._bucket_sizes[batch_indexes[0]])
+
+        # If the data is materialized into a `TensorStore` and there are no
+        # transforms to apply per-sample, then the entire batch is a single
+        # gather from the memory-mapped arrays, with no per-sample work.
+        rows = self._get_tensor_rows() if bucket_size is None else None
+        if rows is not None and not self._train_manager.transforms_active:
+            images, annotations = self._tensor_store.get_batch(
+                rows[np.asarray(batch_indexes, dtype = np.int64)])
+            images, annotations = self._train_manager.process_batch(
+                images, annotations, self._batch_rng(batch_indexes))
+            return self._train_manager.make_batch(
+                images = images,
+                annotations = annotations
+            )
+
+        # Get the images and annotations from the data objects. If an
+        # executor is set, then the per-sample loading is fanned out to
+        # its workers, and the results are gathered back in index order.
+        # The work is submitted while holding the lock, so that the pool
+        # can't be shut down before all of it has been submitted.
+        with _LAZY_STATE_LOCK:
+            pool = self._get_executor_pool()
+            if pool is not None:
+                # Each sample is sent with its own random generator, so that
+                # the transforms applied don't depend on which worker loads
+                # it. Process pool workers already have the `TrainingManager`
+                # (see `_init_process_worker()`), so only the samples are sent.
+                rngs = [self._sample_rng(index) for index in batch_indexes]
+                if rows is not None:
+                    method, args = 'process', (
+                        [self._tensor_store.get(rows[index])
+                         for index in batch_indexes],
+                        itertools.repeat(True), rngs)
+                else:
+                    method, args = 'apply', (
+                        [self._data_objects[index] for index in batch_indexes],
+                        itertools.repeat(True), itertools.repeat(bucket_size),
+                        rngs)
+                if self._executor[0] == 'process':
+                    results = pool.map(
+                        _apply_in_worker, itertools.repeat(method), *args)
+                else:
+                    results = pool.map(
+                        getattr(self._train_manager, method), *args)
+        if pool is None:
+            contents = [self._load_one_image_and_annotation(index, bucket_size)
+                        for index in batch_indexes]
+        else:
+            contents = list(results)
         images, annotations = [], []
-        for index in batch_indexes:
-            image, annotation = self._load_one_image_and_annotation(
-                self._data_objects[index])
+        for image, annotation in contents:
             images.append(image)
             annotations.append(annotation)
 
-        # Attempt to create batched image arrays.
-        images = self._batch_multi_image_inputs(images)
+        # Attempt to create batched image arrays. If the images are being
+        # resized to a fixed size, then they can be collated directly into
+        # a reusable batch buffer, rather than stacking them into a new one.
+        # If there are batch transforms, then they are applied to the batch
+        # before it is converted, so the batch is kept as a NumPy array.
+        batch = None
+        pool = self._get_buffer_pool()
+        batch_transforms = self._train_manager.batch_transforms_active
+        if pool is not None and (self._resize_manager.size is not None
+                                 or bucket_size is not None):
+            batch = self._train_manager.collate_images(
+                images, pool, convert = not batch_transforms)
+        images = batch if batch is not None \
+            else self._batch_multi_image_inputs(images)
 
         # Attempt the same for the annotation arrays. This is more complex
         # since there are many different types of annotations, namely labels,
@@ -321,6 +962,11 @@ class DataManager(AgMLSerializable):
         # create a batch in each of these cases.
         annotations = self._batch_multi_output_annotations(annotations)
 
+        # Apply any batch transforms to the entire batch at once.
+        if batch_transforms:
+            images, annotations = self._train_manager.process_batch(
+                images, annotations, self._batch_rng(batch_indexes))
+
         # Return the batches.
         return self._train_manager.make_batch(
             images = images,
@@ -339,7 +985,7 @@ class DataManager(AgMLSerializable):
         # then we just need to return a single `DataObject`.
         if isinstance(indexes, int) and self._batch_size is None:
             return self._load_one_image_and_annotation(
-                self._data_objects[self._accessors[indexes]]
+                self._accessors[indexes]
             )
 
         # If we have a batch of images, then return the batch.
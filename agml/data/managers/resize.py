@@ -20,8 +20,10 @@ import cv2
 import numpy as np
 
 from agml.framework import AgMLSerializable
+from agml.data.cache import ResizedSampleCache
+from agml.data.tools import _select_coco_boxes # noqa
 from agml.utils.logging import log
-from agml.utils.image import imread_context
+from agml.utils.image import ensure_writeable
 from agml.utils.general import resolve_tuple
 from agml.utils.io import recursive_dirname
 
@@ -62,7 +64,8 @@ class ImageResizeManager(AgMLSerializable):
     a transformation pipeline. This is to prevent data loss.
     """
     serializable = frozenset(
-        ('task', 'dataset_name', 'dataset_root', 'resize_type', 'image_size'))
+        ('task', 'dataset_name', 'dataset_root',
+         'resize_type', 'image_size', 'disk_cache', 'reduced_decode'))
 
     # Stores the path to the local file which contains the
     # information on the image shapes in all of the datasets.
@@ -84,21 +87,57 @@ class ImageResizeManager(AgMLSerializable):
         self._resize_type = 'default'
         self._image_size = None
 
+        # An optional persistent cache of the resized contents.
+        self._disk_cache = None
+
+        # Whether to decode JPEG images at a reduced resolution when
+        # they are much larger than the size they are resized to.
+        self._reduced_decode = True
+
     @property
     def state(self):
         return self._resize_type
 
+    @property
+    def disk_cache(self):
+        return self._disk_cache
+
+    def set_disk_cache(self, location):
+        """Enables (or with `None`, disables) the on-disk resize cache."""
+        if location is None:
+            self._disk_cache = None
+        else:
+            self._disk_cache = ResizedSampleCache(
+                location = location, task = self._task)
+
     @property
     def size(self):
         return self._image_size
 
+    def set_reduced_decode(self, enable):
+        """Sets whether large JPEG images are decoded at a reduced resolution."""
+        self._reduced_decode = bool(enable)
+
+    def _load_contents(self, obj, image_size = None):
+        """Loads the contents of a `DataObject`, before resizing them."""
+        if image_size is None:
+            image_size = self._image_size
+        if self._reduced_decode and image_size is not None:
+            return obj.get(target_size = image_size)
+        return obj.get()
+
     @staticmethod
     def _tuple_euclidean(t1, t2):
         (x1, y1), (x2, y2) = t1, t2
         return np.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
 
-    def assign(self, kind):
-        """Assigns the resize parameter (and does necessary calculations)."""
+    def assign(self, kind, shapes = None):
+        """Assigns the resize parameter (and does necessary calculations).
+
+        For 'auto' resizing, `shapes` is a callable which returns an `(N, 3)`
+        array of the `(width, height, channels)` of each of the images (see
+        `DataManager.image_shapes()`), which the size is inferred from.
+        """
         if kind == 'default':
             self._resize_type = 'default'
             self._image_size = None
@@ -114,20 +153,55 @@ class ImageResizeManager(AgMLSerializable):
                     f"Got a sequence {kind}, expected two values for "
                     f"the height and width but got {len(kind)} values.")
             self._resize_type = 'custom_size'
-            self._image_size = tuple(*kind)
+            self._image_size = tuple(kind)
         elif 'auto' in kind:
-            # This means that the dataloader has been exported in some format.
-            # First, we check whether a different size has automatically been
+            # 'train-auto' means that the dataloader has been exported in some
+            # format. Then, we check whether a different size has already been
             # set, since if it has, we don't want to override that size.
-            if kind == 'train-auto':
-                if self._resize_type == 'default':
-                    info = self._maybe_load_shape_info()
-                    if info is None:
-                        shape = self._random_inference_shape()
-                    else:
-                        shape = self._inference_shape(info)
-                    self._resize_type = 'auto'
-                    self._image_size = resolve_tuple(shape)
+            if kind == 'train-auto' and self._resize_type != 'default':
+                return
+            self._resize_type = 'auto'
+            self._image_size = resolve_tuple(self._auto_shape(shapes))
+
+    def _auto_shape(self, shapes = None):
+        """Infers the size for 'auto' resizing from the image shapes.
+
+        The shapes of the images are read from their headers when given, and
+        otherwise, the shape information stored for the dataset is used.
+        """
+        if shapes is not None:
+            shapes = shapes()
+            if len(shapes) != 0:
+                return self._inference_shape(np.unique(
+                    shapes, return_counts = True, axis = 0))
+        info = self._maybe_load_shape_info()
+        if info is None:
+            return self._get_log_default_shape()
+        return self._inference_shape(info)
+
+    def load(self, obj, bucket_size = None):
+        """Loads the contents of a `DataObject` and resizes them.
+
+        If the on-disk resize cache is enabled and the images are being
+        resized, then the resized contents are read directly from the cache
+        (and written to it the first time that they are loaded), skipping
+        the decoding and resizing of the images altogether.
+
+        If a `bucket_size` is given (when the batches of the data are grouped
+        into buckets of similar images), then the contents are instead resized
+        to fit inside of it and padded to exactly that size (see `letterbox()`).
+        """
+        if bucket_size is not None:
+            return self.letterbox(
+                self._load_contents(obj, bucket_size), bucket_size)
+        cache = self._disk_cache
+        if cache is None or self._image_size is None or not cache.supports(obj):
+            return self.apply(self._load_contents(obj))
+        contents = cache.load(obj, self._image_size, self._reduced_decode)
+        if contents is None:
+            contents = self.apply(self._load_contents(obj))
+            cache.store(obj, self._image_size, contents, self._reduced_decode)
+        return contents
 
     def apply(self, contents):
         """Applies the resizing operation to the input data."""
@@ -141,6 +215,42 @@ class ImageResizeManager(AgMLSerializable):
             return self._resize_image_and_mask(
                 contents, self._image_size)
 
+    def letterbox(self, contents, image_size):
+        """Resizes the contents to fit inside of an image size, then pads them.
+
+        Unlike `apply()`, this preserves the aspect ratio of the images: they
+        are scaled by a single factor to fit inside of the `(width, height)`,
+        and then padded with zeros at the bottom and right. Since the images
+        aren't shifted, bounding boxes only need to be scaled by that factor.
+        """
+        image, annotation = contents
+        if isinstance(image, dict):
+            image = {k: self._letterbox_array(
+                i, image_size, cv2.INTER_LINEAR if k == 'image'
+                else cv2.INTER_NEAREST)[0] for k, i in image.items()}
+            return image, annotation
+        image, scale = self._letterbox_array(image, image_size)
+        if self._task == 'object_detection':
+            bboxes = np.reshape(annotation['bbox'], (-1, 4)) * scale
+            self._update_coco_boxes(annotation, bboxes.astype(np.int32))
+        elif self._task == 'semantic_segmentation':
+            annotation = self._letterbox_array(
+                annotation, image_size, cv2.INTER_NEAREST)[0]
+        return image, annotation
+
+    @staticmethod
+    def _letterbox_array(array, image_size, interpolation = cv2.INTER_LINEAR):
+        height, width = array.shape[:2]
+        t_width, t_height = image_size
+        scale = min(t_width / width, t_height / height)
+        size = (min(t_width, max(1, round(width * scale))),
+                min(t_height, max(1, round(height * scale))))
+        resized = cv2.resize(array, size, interpolation = interpolation)
+        out = np.zeros((t_height, t_width) + array.shape[2:], dtype = array.dtype)
+        out[:size[1], :size[0]] = resized.reshape(
+            (size[1], size[0]) + array.shape[2:])
+        return out, scale
+
     def _inference_shape(self, info):
         """Attempts to inference a shape for the `auto` method.
 
@@ -168,69 +278,50 @@ class ImageResizeManager(AgMLSerializable):
         of shapes and no explicitly majority, then do not use this method.
         """
         shapes, counts = info
-        shapes = shapes[:, :-1]
+        shapes = shapes[:, :2]
         if len(shapes) == 1:
             return shapes[0].tolist()
 
         total_count = np.sum(counts)
         if np.max(counts) > int(total_count * 0.7):
-            return shapes[np.where(counts == np.max(counts))[0]][0].tolist()
+            return shapes[np.argmax(counts)].tolist()
 
         if len(shapes) <= 4:
-            count_proportions = counts.copy() / total_count
-            maybe_max = np.where(count_proportions >= 0.5)[0]
-            if maybe_max:
-                if maybe_max.copy().sort()[-2] <= 0.3:
-                    return shapes[maybe_max].tolist()
+            count_proportions = counts / total_count
+            order = np.argsort(count_proportions)[::-1]
+            if count_proportions[order[0]] > 0.5 \
+                    and count_proportions[order[1]] < 0.3:
+                return shapes[order[0]].tolist()
 
-            two_pluralities = shapes[np.where(count_proportions >= 0.35)[0]]
+            two_pluralities = shapes[count_proportions >= 0.35]
             if len(two_pluralities) != 2:
                 return self._get_log_default_shape()
             outs = (self._tuple_euclidean(two_pluralities[0], self._default_size),
                     self._tuple_euclidean(two_pluralities[1], self._default_size))
-            return two_pluralities[outs.index(max(outs))][0].tolist()
+            return two_pluralities[outs.index(min(outs))].tolist()
 
         return self._get_log_default_shape()
 
-    def _random_inference_shape(self):
-        """Randomly attempts to inference a shape for the dataset.
+    def _maybe_load_shape_info(self):
+        """Loads the contents of the shape information file.
 
-        In the case that there is no shape information saved in the
-        local `.shape.info.pickle` file, this method randomly attempts
-        to inference a dataset shape by randomly selecting images from
-        the dataset and performing calculations (similarly to what it
-        would do in the regular shape inference method, only with a
-        random sample instead of the entire dataset for reference.
+        The file stores the unique `(height, width, channels)` of the images
+        in each dataset (with their counts), which are returned as `(width,
+        height, channels)`, the same as the shapes read from image headers.
         """
-        log(f"Could not find shape information for {self._dataset_name}. "
-            f"Attempting to randomly inference the dataset shape.")
-
-        image_path = os.path.join(self._dataset_root, 'images')
-        images = np.random.choice(os.listdir(image_path), size = 25)
-
-        # Get all of the shapes from the random sample of images.
-        shapes = []
-        for path in images:
-            path = os.path.join(image_path, path)
-            with imread_context(path) as image:
-                shapes.append(image)
-
-        # Inference a valid shape from the shapes. We dispatch to the
-        # regular inferencing method once we have the shapes and counts.
-        unique_shapes, counts = np.unique(shapes, return_counts = True, axis = 0)
-        return self._inference_shape((unique_shapes, counts))
-
-    def _maybe_load_shape_info(self):
-        """Loads the contents of the shape information file."""
         try:
             with open(self._shape_info_file, 'rb') as f:
                 contents = pickle.load(f)
-                return contents.get(self._dataset_name, None)
         except OSError:
             raise EnvironmentError(
                 f"Could not find the local file {self._shape_info_file} "
                 f"containing shape information. There was likely a problem "
                 f"when building AgML. Please re-install it.")
+        info = contents.get(self._dataset_name, None)
+        if info is None:
+            return None
+        shapes, counts = info
+        return shapes[:, [1, 0, 2]], counts
 
     def _get_log_default_shape(self):
         """Returns the default shape and warns that no shape could be inferenced."""
@@ -242,6 +333,11 @@ class ImageResizeManager(AgMLSerializable):
 
     # The following methods conduct the actual resizing of the images
     # and potentially their annotations for the different tasks.
+    #
+    # Images (and masks) may come as read-only arrays from the decoded
+    # image cache, so when no resizing is applied (which would create a
+    # new array anyways), we make sure to return a writeable copy, since
+    # the transforms which come after this may modify them in-place.
 
     def _resize_image_input(self, contents, image_size):
         # If there is only one image input, just return that.
@@ -254,7 +350,7 @@ class ImageResizeManager(AgMLSerializable):
                               image_size,
                               cv2.INTER_NEAREST).astype(np.int32)
                 for k, i in image.items()}, label
-        return image, label
+        return {k: ensure_writeable(i) for k, i in image.items()}, label
 
     @staticmethod
     def _resize_single_image(contents, image_size):
@@ -262,27 +358,37 @@ class ImageResizeManager(AgMLSerializable):
         if image_size is not None:
             # No processing done on the annotation.
             image = cv2.resize(image, image_size, cv2.INTER_NEAREST)
-        return image, label
+        return ensure_writeable(image), label
+
+    @staticmethod
+    def _update_coco_boxes(coco, bboxes):
+        """Sets the rescaled boxes (and their areas) of a COCO dictionary.
+
+        Boxes which have collapsed to a zero width or height (e.g., very
+        small boxes in an image which is resized to a much smaller size)
+        are removed, along with all of their other values.
+        """
+        coco['bbox'] = bboxes
+        coco['area'] = bboxes[:, 2] * bboxes[:, 3]
+        keep = coco['area'] > 0
+        if not keep.all():
+            _select_coco_boxes(coco, keep)
+        return coco
 
     @staticmethod
     def _resize_image_and_coco(contents, image_size):
         image, coco = contents
         if image_size is not None:
-            # Extract the original size of the bounding boxes.
+            # Normalize the bounding boxes by the original size of the image,
+            # and clip them (There might be a case where the bounding box is
+            # on the edge, but goes to just over 1.0 which in turn causes
+            # many bugs. This prevents that). This is done on all of the
+            # `(N, 4)` boxes at once, rather than one box at a time.
             y_scale, x_scale = image.shape[0:2]
-            bboxes = coco['bbox']
-            processed_bboxes = []
-            for bbox in bboxes:
-                x1, y1, width, height = bbox
-                processed_bboxes.append([
-                    x1 / x_scale, y1 / y_scale,
-                    width / x_scale, height / y_scale])
-
-            # Clip the bounding boxes (There might be a case where
-            # the bounding box is on the edge, but goes to just over 1.0
-            # which in turn causes many bugs. This prevents that).
-            processed_bboxes = np.array(processed_bboxes)
-            np.clip(processed_bboxes, 0, 1, processed_bboxes)
+            bboxes = np.reshape(
+                np.asarray(coco['bbox'], dtype = np.float64), (-1, 4))
+            bboxes = bboxes / np.array([x_scale, y_scale, x_scale, y_scale])
+            np.clip(bboxes, 0, 1, out = bboxes)
 
             # Resize the image and calculate its new size ratio.
             image = cv2.resize(
@@ -290,20 +396,9 @@ class ImageResizeManager(AgMLSerializable):
             y_new, x_new = image.shape[0:2]
 
             # Update the bounding boxes and areas with the new ratio.
-            final_processed_bboxes, areas = [], []
-            for bbox in processed_bboxes:
-                x1, y1, width, height = bbox
-                new_bbox = [
-                    int(x1 * x_new), int(y1 * y_new),
-                    int(width * x_new), int(height * y_new)]
-                final_processed_bboxes.append(new_bbox)
-                areas.append(new_bbox[2] * new_bbox[3])
-            final_processed_bboxes = \
-                np.array(final_processed_bboxes).astype(np.int32)
-            coco['bbox'] = final_processed_bboxes
-            areas = np.array(areas).astype(np.int32)
-            coco['area'] = areas
-        return image, coco
+            bboxes = bboxes * np.array([x_new, y_new, x_new, y_new])
+            ImageResizeManager._update_coco_boxes(coco, bboxes.astype(np.int32))
+        return ensure_writeable(image), coco
 
     @staticmethod
     def _resize_image_and_mask(contents, image_size):
@@ -312,7 +407,7 @@ class ImageResizeManager(AgMLSerializable):
             # Resize the image and the mask together if requested.
             image = cv2.resize(image, image_size, cv2.INTER_NEAREST)
             mask = cv2.resize(mask, image_size, cv2.INTER_NEAREST)
-        return image, mask
+        return ensure_writeable(image), ensure_writeable(mask)
 
 
 
@@ -21,7 +21,7 @@ from agml.utils.image import needs_batch_dim
 from agml.backend.tftorch import (
     tf, torch, set_backend, get_backend,
     user_changed_backend, StrictBackendError,
-    _convert_image_to_torch # noqa
+    _convert_image_to_torch, _convert_image_batch_to_torch # noqa
 )
 
 
@@ -84,7 +84,7 @@ class TrainingManager(AgMLSerializable):
         """Exposes the internal state."""
         return self._state
 
-    def update_state(self, state):
+    def update_state(self, state, shapes = None):
         """Updates the state of the training manager.
 
         This updates the state which is used to determine what preprocessing
@@ -127,6 +127,10 @@ class TrainingManager(AgMLSerializable):
         > loader.reset_processing()
 
         This enables the loader to track multiple states.
+
+        When the state is set to 'tf' or 'torch' and the images aren't being
+        resized, their size is inferred ('auto' resizing) from the `shapes`, a
+        callable which returns the shapes of the images, if given.
         """
         # Fully disable all preprocessing.
         if t_(state) == TrainState.FALSE:
@@ -149,7 +153,7 @@ class TrainingManager(AgMLSerializable):
                     raise StrictBackendError(
                         change = 'torch', obj = t_(state))
                 set_backend('torch')
-            self._resize_manager.assign('train-auto')
+            self._resize_manager.assign('train-auto', shapes = shapes)
         elif t_(state) == TrainState.TF:
             self._state = TrainState.TF
             if get_backend() == 'torch':
@@ -157,13 +161,13 @@ class TrainingManager(AgMLSerializable):
                     raise StrictBackendError(
                         change = 'tf', obj = t_(state))
                 set_backend('tf')
-            self._resize_manager.assign('train-auto')
+            self._resize_manager.assign('train-auto', shapes = shapes)
 
         # Set the default conversion (`None`).
         elif t_(state) == TrainState.NONE:
             self._state = TrainState.NONE
 
-    def apply(self, obj, batch_state):
+    def apply(self, obj, batch_state, bucket_size = None, rng = None):
         """Applies preprocessing and conversions to the data contents.
 
         This method is responsible for actually loading and processing
@@ -175,23 +179,33 @@ class TrainingManager(AgMLSerializable):
         See the `TransformManager` and the `ImageResizeManager` for more
         information on the specific preprocessing applied there, and the
         `update_state()` method for more information on the training.
-        """
-        # Extract the raw contents from the `DataObject`.
-        contents = obj.get()
 
+        If the `bucket_size` is given, then the images are resized (and
+        padded) to it, rather than to the size of the `ImageResizeManager`.
+        The `rng` is the random `Generator` passed to the transforms.
+        """
         # If the state is set to `False`, then just return the raw contents.
         if self._state is TrainState.FALSE:
-            return contents
+            return obj.get()
 
-        # In any other case other than `False`, we  resize the images.
-        contents = self._resize_manager.apply(contents)
+        # In any other case other than `False`, we load and resize the
+        # images (potentially through the on-disk resize cache).
+        contents = self._resize_manager.load(obj, bucket_size = bucket_size)
+        return self.process(contents, batch_state, rng)
 
+    def process(self, contents, batch_state, rng = None):
+        """Applies transforms and conversions to loaded, resized contents.
+
+        This is the part of `apply()` which takes place after the data is
+        loaded and resized, and is used directly when the resized contents
+        come from elsewhere (e.g., a `TensorStore`).
+        """
         # If we are in a training state or `None`, (so not an evaluation
         # state or `False`), then we apply the transforms to the images.
         if self._state not in [TrainState.EVAL,
                                TrainState.EVAL_TF,
                                TrainState.EVAL_TORCH]:
-            contents = self._transform_manager.apply(contents)
+            contents = self._transform_manager.apply(contents, rng)
 
         # If the images are not in a batch, then we convert them to tensors
         # here, otherwise, they will be converted when the batch is created.
@@ -201,6 +215,38 @@ class TrainingManager(AgMLSerializable):
         # Return the processed contents.
         return contents
 
+    @property
+    def transforms_active(self):
+        """Returns whether any transforms are applied in the current state."""
+        if self._state in [TrainState.FALSE,
+                           TrainState.EVAL,
+                           TrainState.EVAL_TF,
+                           TrainState.EVAL_TORCH]:
+            return False
+        return not self._transform_manager.empty
+
+    @property
+    def batch_transforms_active(self):
+        """Returns whether any batch transforms are applied in the current state."""
+        if self._state in [TrainState.FALSE,
+                           TrainState.EVAL,
+                           TrainState.EVAL_TF,
+                           TrainState.EVAL_TORCH]:
+            return False
+        return self._transform_manager.has_batch_transforms
+
+    def process_batch(self, images, annotations, rng = None):
+        """Applies the batch transforms to a collated batch of contents.
+
+        This takes place after the batch is collated, but before it is
+        converted to tensors (see `make_batch()`). The `rng` is the random
+        `Generator` for the batch, which is passed to the batch transforms.
+        """
+        if self.batch_transforms_active:
+            images, annotations = self._transform_manager.apply_batch(
+                (images, annotations), rng)
+        return images, annotations
+
     def _train_state_apply(self, contents):
         """Preprocesses the data according to the class's training state."""
         if self._state is TrainState.NONE:
@@ -211,6 +257,34 @@ class TrainingManager(AgMLSerializable):
             return self._torch_tensor_convert(contents, self._task)
         return contents
 
+    def collate_images(self, images, pool, convert = True):
+        """Collates a list of images into a buffer from a `BatchBufferPool`.
+
+        The images are written directly into a recycled buffer, which for a
+        'torch' state is a channels-first `float32` buffer that is exposed as
+        a `torch.Tensor` without any copy. If the images don't all have the
+        same shape and data type, then this returns `None`. If `convert` is
+        `False`, then the batch is always a channels-last NumPy array (e.g.,
+        so that batch transforms can be applied to it before conversion).
+        """
+        first = images[0]
+        for image in images:
+            if not isinstance(image, np.ndarray) or \
+                    image.shape != first.shape or image.dtype != first.dtype:
+                return None
+        if convert and self._state in [TrainState.TORCH, TrainState.EVAL_TORCH] \
+                and first.ndim == 3 and first.shape[0] > first.shape[-1]:
+            height, width, channels = first.shape
+            batch = pool.acquire(
+                (len(images), channels, height, width), np.float32)
+            for i, image in enumerate(images):
+                np.copyto(batch[i], image.transpose(2, 0, 1))
+            return torch.from_numpy(batch)
+        batch = pool.acquire((len(images), ) + first.shape, first.dtype)
+        for i, image in enumerate(images):
+            batch[i] = image
+        return batch
+
     def make_batch(self, images, annotations):
         """Creates a batch of data out of processed images and annotations."""
         if self._state in [TrainState.NONE, TrainState.FALSE, TrainState.EVAL]:
@@ -304,9 +378,10 @@ class TrainingManager(AgMLSerializable):
     @staticmethod
     def _torch_tensor_image_batch_convert(batch):
         """Converts potential multi-image input batch dicts to tensor dicts."""
+        if isinstance(batch, torch.Tensor):
+            return batch
         if isinstance(batch, np.ndarray):
-            return torch.stack([
-                _convert_image_to_torch(image) for image in batch])
+            return _convert_image_batch_to_torch(batch)
         return {k: TrainingManager.
             _torch_tensor_image_batch_convert(b) for k, b in batch.items()}
 
@@ -13,11 +13,72 @@
 # limitations under the License.
 
 import abc
+import sys
+import random
+import threading
 
+import cv2
 import numpy as np
 
 from agml.framework import AgMLSerializable
-from agml.utils.general import seed_context
+from agml.data.tools import _select_coco_boxes # noqa
+
+
+# Serializes the use of the global random states by the transforms which
+# draw from them, so that they can be seeded for each sample.
+_GLOBAL_SEED_LOCK = threading.Lock()
+
+
+def _draw_seed(rng):
+    """Draws a seed for the global random states from a sample's generator."""
+    if rng is None:
+        rng = np.random.default_rng()
+    return int(rng.integers((1 << 31) - 1)) # default is 32-bit systems
+
+
+class global_seed_context(object):
+    """Seeds all of the global random states in a context, then restores them.
+
+    Third-party transforms (e.g., `albumentations` and `torchvision`) draw
+    from the global random states of Python's `random`, `np.random`, and
+    (if it has been imported) PyTorch, so this seeds all of them, and then
+    restores their previous states when exiting. Since these states are
+    shared by all of the threads of a process, the context holds a lock
+    for its entire duration, so that another thread can't reseed them
+    in the middle of a transform.
+    """
+
+    def __init__(self, seed):
+        self._seed = seed
+        self._prev_states = None
+
+    def __enter__(self):
+        _GLOBAL_SEED_LOCK.acquire()
+        torch = sys.modules.get('torch', None)
+        self._prev_states = (
+            random.getstate(), np.random.get_state(),
+            torch.random.get_rng_state() if torch is not None else None)
+        self.reset()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            python_state, numpy_state, torch_state = self._prev_states
+            random.setstate(python_state)
+            np.random.set_state(numpy_state)
+            if torch_state is not None:
+                sys.modules['torch'].random.set_rng_state(torch_state)
+            self._prev_states = None
+        finally:
+            _GLOBAL_SEED_LOCK.release()
+
+    def reset(self):
+        random.seed(self._seed)
+        np.random.seed(self._seed)
+        torch = sys.modules.get('torch', None)
+        if torch is not None:
+            torch.random.manual_seed(self._seed)
+
 
 class TransformApplierBase(AgMLSerializable):
     """Applies a transform to the input data.
@@ -29,9 +90,16 @@ class TransformApplierBase(AgMLSerializable):
     This is used in cases such as `albumentations` transforms, which
     require keyword arguments. This wrapper allows them to be used
     as a traditional method for consistency in application.
+
+    Transforms which are random can set `uses_rng`, in which case the
+    `apply` method receives the random `np.random.Generator` for the
+    sample as the `rng` keyword argument (see `TransformManager.apply`).
     """
     serializable = frozenset(('transform', ))
 
+    # Whether the `apply` method accepts a random `Generator` as `rng`.
+    uses_rng = False
+
     def __init__(self, transform):
         self._transform = transform
 
@@ -40,54 +108,117 @@ class TransformApplierBase(AgMLSerializable):
         """Applies the transformation to the input data."""
         return
 
-    def __call__(self, *args):
+    def __call__(self, *args, rng = None):
+        if self.uses_rng:
+            return self.apply(*args, rng = rng)
         return self.apply(*args)
 
     def __str__(self):
         return self.__class__.__name__ + f": {self._transform}"
 
 
-class AlbumentationsTransformSingle(TransformApplierBase):
+class GlobalStateTransform(TransformApplierBase):
+    """Applies a transform which draws from the global random states.
+
+    Before each call, the global random states are seeded from the sample's
+    random `Generator` (see `global_seed_context`), as is the transform's own
+    generator for those which have one (e.g., `albumentations` pipelines with
+    a `set_random_seed` method). The output then only depends on the sample,
+    so it is the same regardless of how many workers load the data.
+
+    The global random states are shared by all of the threads of a process,
+    so these transforms are applied one at a time, even when the samples are
+    loaded in a thread pool. Functional transforms which accept an `rng`
+    argument don't have this limitation, and run fully in parallel.
+    """
+    uses_rng = True
+
+    def __call__(self, *args, rng = None):
+        seed = _draw_seed(rng)
+        with global_seed_context(seed):
+            if hasattr(self._transform, 'set_random_seed'):
+                self._transform.set_random_seed(seed)
+            return self.apply(*args)
+
+
+class TorchvisionTransform(GlobalStateTransform):
+    def apply(self, image):
+        return self._transform(image)
+
+
+class AlbumentationsTransformSingle(GlobalStateTransform):
     def apply(self, image):
         transform = self._transform(image = image)
         return transform['image']
 
 
-class AlbumentationsTransformMask(TransformApplierBase):
+class AlbumentationsTransformMask(GlobalStateTransform):
     def apply(self, image, mask):
         transform = self._transform(image = image, mask = mask)
         return transform['image'], transform['mask']
 
 
-class AlbumentationsTransformCOCO(TransformApplierBase):
+class AlbumentationsTransformCOCO(GlobalStateTransform):
     def apply(self, image, coco):
         # This method is a bit more complex. We can't just apply it
         # to the COCO JSON dictionary as we need to extract the
-        # bounding boxes/category IDs, do the transformation on those,
-        # and then re-insert them into the COCO dictionary.
-        coco_boxes = coco['bbox']
-        coco_labels = coco['category_id']
-        bboxes = np.c_[coco_boxes, coco_labels]
-        transform = self._transform(image = image, bboxes = bboxes)
-        image, bboxes = transform['image'], \
-                        np.array(transform['bboxes'])[:, :-1]
-        coco['bbox'], areas = bboxes, []
-        for box in bboxes:
-            areas.append(
-                (box[0] + box[2]) * (box[1] + box[3]))
-        coco['area'] = areas.copy()
-        return image, coco
+        # bounding boxes, do the transformation on those, and then
+        # re-insert them into the COCO dictionary. Each box is passed
+        # with its index as a trailing label, so that the values of the
+        # boxes which the transform keeps (e.g., those still visible
+        # after a crop) can be selected afterwards.
+        boxes = np.reshape(np.asarray(coco['bbox'], dtype = np.float32), (-1, 4))
+        indexes = np.arange(len(boxes), dtype = np.float32)
+        transform = self._transform(
+            image = image, bboxes = np.c_[boxes, indexes])
+        transformed = np.reshape(np.asarray(
+            transform['bboxes'], dtype = np.float32), (-1, 5))
+        coco = _select_coco_boxes(coco, transformed[:, 4].astype(np.int64))
+
+        # Update the boxes and their areas, and remove degenerate boxes.
+        bboxes = transformed[:, :4]
+        coco['bbox'] = bboxes
+        coco['area'] = bboxes[:, 2] * bboxes[:, 3]
+        keep = coco['area'] > 0
+        if not keep.all():
+            _select_coco_boxes(coco, keep)
+        return transform['image'], coco
+
+
+class GeneratorTransform(TransformApplierBase):
+    uses_rng = True
+
+    def apply(self, *args, rng = None):
+        # A functional transform with an `rng` argument, which is passed
+        # the random `Generator` of the sample (so its output only depends
+        # on the sample, and not on the global random state).
+        if rng is None:
+            rng = np.random.default_rng()
+        return self._transform(*args, rng = rng)
 
 
 class SameStateImageMaskTransform(TransformApplierBase):
-    def apply(self, image, mask):
-        # This method applies a transformation to the image and mask.
-        # Essentially, we need to set the random seed before applying
-        # it to the image and mask to get the same results for both
-        # the image and the mask. So, we change the seed each time, but
-        # we also reset the seed so that it goes back to normal afterwards.
-        seed = np.random.randint((1 << 31) - 1) # default is 32-bit systems
-        with seed_context(seed) as context:
+    """Applies a transform to an image and its mask with the same randomness.
+
+    The wrapped transform (e.g., a `torchvision` pipeline) is called
+    separately on the image and the mask, and draws from the global random
+    states, so they are all seeded with the same seed (drawn from the
+    sample's generator) before each of the two calls, and the previous
+    states are restored afterwards (see `global_seed_context`).
+
+    As with a `GlobalStateTransform`, the seeded calls hold a process-wide
+    lock, so that loading samples in a thread pool (e.g., `loader.prefetch()`
+    or `loader.use_executor('thread')`) can't reseed the states in between
+    the two calls, and these transforms are applied one at a time. The lock
+    doesn't protect against other code which uses the global random states
+    from another thread without going through it.
+    """
+    uses_rng = True
+
+    def apply(self, image, mask, rng = None):
+        # The seed is drawn from the sample's generator, so it only
+        # depends on the sample and not on the global random state.
+        with global_seed_context(_draw_seed(rng)) as context:
             image = self._transform(image)
             context.reset()
             mask = self._transform(mask)
@@ -95,30 +226,93 @@ class SameStateImageMaskTransform(TransformApplierBase):
 
 
 class NormalizationTransformBase(TransformApplierBase, abc.ABC):
-    """A subclass to mark transforms as normalizing transforms."""
-    pass
+    """A subclass to mark transforms as normalizing transforms.
 
+    The normalization is compiled once, when the transform is created, into
+    a per-channel scale and offset (so an image is normalized as `image *
+    scale - offset`), and for `np.uint8` images, into a lookup table with
+    the output for each pixel value. Normalizing an image is then a single
+    pass which writes the output `dtype` (and optionally, a channels-first
+    layout) directly, without any intermediate `np.float64` arrays.
 
-class ScaleTransform(NormalizationTransformBase):
-    def apply(self, image):
-        if image.max() >= 1 or np.issubdtype(image.dtype, np.integer):
-            image = (image / 255).astype(np.float32)
-        return image
+    Whether an image is scaled from the 0-255 range is decided by its dtype
+    (integer images are, floating-point images are assumed to be 0-1),
+    rather than by scanning the values of the image.
+    """
+    serializable = frozenset((
+        'transform', 'dtype', 'channels_first', 'scale', 'offset', 'lut'))
+    immutable = frozenset(('scale', 'offset', 'lut'))
 
+    def __init__(self, transform, dtype = np.float32, channels_first = False):
+        super().__init__(transform)
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float16, np.float32):
+            raise ValueError(f"Expected normalized images to be either "
+                             f"`float16` or `float32`, got {dtype}.")
+        self._dtype = dtype
+        self._channels_first = channels_first
+
+        # The scale is for 0-1 images, and is divided by 255 for integers.
+        mean, std = self._statistics()
+        self._scale = (1 / std).astype(np.float32)
+        self._offset = (mean / std).astype(np.float32)
+
+        # The lookup table has a row for each `np.uint8` value and a column
+        # for each channel. `float16` tables are stored as their raw bits,
+        # since OpenCV's `LUT` may not support `float16` tables directly.
+        lut = np.arange(256, dtype = np.float64)[:, None] / 255 / std - mean / std
+        lut = lut.astype(dtype)
+        self._lut = lut.view(np.uint16) if dtype == np.float16 else lut
+
+    @abc.abstractmethod
+    def _statistics(self):
+        """Returns the per-channel mean and standard deviation (as `float64`)."""
+        raise NotImplementedError()
 
-class NormalizationTransform(NormalizationTransformBase):
     def apply(self, image):
-        # This method applies normalization to input images, scaling them
-        # to a 0-1 float range, and performing scaling normalization.
-        if image.max() >= 1 or np.issubdtype(image.dtype, np.integer):
-            image = (image / 255).astype(np.float32)
+        channels = 1 if image.ndim == 2 else image.shape[-1]
+        if image.dtype == np.uint8 and image.ndim in (2, 3) \
+                and self._lut.shape[1] in (1, channels):
+            return self._apply_lut(image, channels)
+        return self._apply_scale_offset(image)
+
+    def _apply_lut(self, image, channels):
+        lut = self._lut
+        if not self._channels_first or image.ndim == 2:
+            out = cv2.LUT(image, lut.reshape(1, 256, -1))
+        else:
+            out = np.empty((channels, ) + image.shape[:2], dtype = lut.dtype)
+            for c in range(channels):
+                table = np.ascontiguousarray(lut[:, min(c, lut.shape[1] - 1)])
+                cv2.LUT(image[..., c], table.reshape(1, 256), dst = out[c])
+        return out.view(self._dtype)
 
+    def _apply_scale_offset(self, image):
+        scale, offset = self._scale, self._offset
+        if np.issubdtype(image.dtype, np.integer):
+            scale = scale / np.float32(255)
+        if self._channels_first and image.ndim == 3:
+            image = image.transpose(2, 0, 1)
+            scale, offset = scale[:, None, None], offset[:, None, None]
+        out = np.empty(np.broadcast_shapes(image.shape, scale.shape),
+                       dtype = self._dtype)
+        np.multiply(image, scale, out = out)
+        np.subtract(out, offset, out = out)
+        return out
+
+
+class ScaleTransform(NormalizationTransformBase):
+    def _statistics(self):
+        # Scaling is normalization with a mean of 0 and a std of 1.
+        return np.zeros((1, )), np.ones((1, ))
+
+
+class NormalizationTransform(NormalizationTransformBase):
+    def _statistics(self):
+        # The `_transform` parameter is the mean and standard deviation.
         mean, std = self._transform
-        mean = np.array(mean, dtype = np.float32)
-        std = np.array(std, dtype = np.float32)
-        denominator = np.reciprocal(std, dtype = np.float32)
-        image = (image - mean) * denominator
-        return image
+        return (np.array(mean, dtype = np.float64).reshape(-1),
+                np.array(std, dtype = np.float64).reshape(-1))
 
 
 class OneHotLabelTransform(TransformApplierBase):
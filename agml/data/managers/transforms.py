@@ -17,27 +17,48 @@ import inspect
 import functools
 from enum import Enum
 
+import numpy as np
+
 from agml.framework import AgMLSerializable
 from agml.backend.tftorch import (
     get_backend, set_backend, user_changed_backend, StrictBackendError
 )
 from agml.data.managers.transform_helpers import (
+    TransformApplierBase,
     AlbumentationsTransformSingle,
     AlbumentationsTransformMask,
     AlbumentationsTransformCOCO,
+    TorchvisionTransform,
+    GeneratorTransform,
     SameStateImageMaskTransform,
     NormalizationTransformBase,
     ScaleTransform,
     NormalizationTransform,
     OneHotLabelTransform
 )
+from agml.data.batch_transforms import BatchTransform
 from agml.utils.logging import log
 
 
+def _writeable_annotation(annotation):
+    """Returns a COCO JSON dictionary whose arrays can be modified in place.
+
+    The annotations of object detection datasets are zero-copy, read-only
+    slices of the dataset's `COCOAnnotationStore`, so any read-only arrays
+    are copied before they are passed to a user's transform.
+    """
+    if not isinstance(annotation, dict):
+        return annotation
+    return {key: value.copy() if isinstance(value, np.ndarray)
+            and not value.flags.writeable else value
+            for key, value in annotation.items()}
+
+
 class TransformKind(Enum):
     Transform = 'transform'
     TargetTransform = 'target_transform'
     DualTransform = 'dual_transform'
+    BatchTransform = 'batch_transform'
 
 
 # Shorthand form of the enum for testing explicit values.
@@ -64,6 +85,10 @@ class TransformManager(AgMLSerializable):
     stored as a `dual_transform` internally. The above case applies to
     semantic segmentation and object detection transformations, but
     there is no `dual_transform` for image classification.
+
+    Additionally, a `batch_transform` is applied to entire batches of
+    images and annotations, after they have been collated (see the
+    `apply_batch()` method and `agml.data.batch_transforms`).
     """
     serializable = frozenset(('task', 'transforms'))
 
@@ -71,6 +96,17 @@ class TransformManager(AgMLSerializable):
         self._task = task
         self._transforms = dict()
 
+    @property
+    def empty(self):
+        """Returns whether there are no per-sample transforms assigned."""
+        return not any(state for kind, state in self._transforms.items()
+                       if kind != 'batch_transform')
+
+    @property
+    def has_batch_transforms(self):
+        """Returns whether there are any batch transforms assigned."""
+        return bool(self._transforms.get('batch_transform', None))
+
     def get_transform_states(self):
         """Returns a copy of the existing transforms."""
         transform_dict = {}
@@ -94,7 +130,7 @@ class TransformManager(AgMLSerializable):
         # just processing the input image, and then passed as just a 
         # `transform` (or else it will clash in object detection tasks).
         # Otherwise, it is stored internally as a `dual_transform`.
-        if transform is not None:
+        if transform is not None and t_(kind) != TransformKind.BatchTransform:
             try:
                 if 'albumentations' in transform.__module__:
                     if t_(kind) == TransformKind.Transform:
@@ -106,8 +142,11 @@ class TransformManager(AgMLSerializable):
                 # Some type of object that doesn't have `__module__`.
                 pass
 
-        # Validate the transformation based on the task and kind.
-        if self._task == 'image_classification':
+        # Validate the transformation based on the task and kind. Batch
+        # transforms are validated in the same way for all of the tasks.
+        if t_(kind) == TransformKind.BatchTransform:
+            transform = self._construct_batch_transform(transform)
+        elif self._task == 'image_classification':
             if t_(kind) == TransformKind.Transform:
                 transform = self._maybe_normalization_or_regular_transform(transform)
             elif t_(kind) == TransformKind.TargetTransform:
@@ -149,7 +188,7 @@ class TransformManager(AgMLSerializable):
             else:
                 self._transforms[kind] = [transform]
 
-    def apply(self, contents):
+    def apply(self, contents, rng = None):
         """Applies a transform to a set of input data.
 
         This method controls the application of the actual transforms. It
@@ -172,8 +211,15 @@ class TransformManager(AgMLSerializable):
         are applied. After the transforms are applied in this order, they
         returned and if passed again, they will have a different transform
         applied to them. The state is independent of the images passed.
+
+        The `rng` is the random `np.random.Generator` for the sample, which
+        is passed to the transforms that accept one (see `TransformApplierBase`).
         """
         image, annotation = contents
+        if self._task == 'object_detection' and (
+                self._transforms.get('target_transform', None)
+                or self._transforms.get('dual_transform', None)):
+            annotation = _writeable_annotation(annotation)
 
         # Iterate through the different types of transforms.
         for kind in TransformKind:
@@ -181,27 +227,44 @@ class TransformManager(AgMLSerializable):
                 transform = self._transforms.get('transform', None)
                 if transform is not None:
                     for t in transform:
-                        image = self._apply_to_objects(t, (image, ), kind)
+                        image = self._apply_to_objects(
+                            t, (image, ), kind, rng)
             if kind == TransformKind.TargetTransform:
                 transform = self._transforms.get('target_transform', None)
                 if transform is not None:
                     for t in transform:
                         annotation = self._apply_to_objects(
-                            t, (annotation, ), kind)
+                            t, (annotation, ), kind, rng)
             if kind == TransformKind.DualTransform:
                 transform = self._transforms.get('dual_transform', None)
                 if transform is not None:
                     for t in transform:
                         image, annotation = self._apply_to_objects(
-                            t, (image, annotation), kind)
+                            t, (image, annotation), kind, rng)
 
         # Return the processed image and annotation.
         return image, annotation
 
+    def apply_batch(self, contents, rng = None):
+        """Applies the batch transforms to a collated batch of data.
+
+        This is applied after all of the images and annotations in a batch
+        have been processed (with the regular transforms) and collated, so
+        the `contents` are the batch of images and the batch of annotations.
+        The `rng` is the random `np.random.Generator` for the entire batch.
+        """
+        images, annotations = contents
+        for t in self._transforms.get('batch_transform', []):
+            images, annotations = self._apply_to_objects(
+                t, (images, annotations), TransformKind.BatchTransform, rng)
+        return images, annotations
+
     @staticmethod
-    def _apply_to_objects(transform, contents, kind):
+    def _apply_to_objects(transform, contents, kind, rng = None):
         """Applies the actual transformations in a context."""
         try:
+            if isinstance(transform, TransformApplierBase):
+                return transform(*contents, rng = rng)
             return transform(*contents)
         except Exception as e:
             default_msg = (f"Encountered an error when attempting to apply "
@@ -245,8 +308,11 @@ class TransformManager(AgMLSerializable):
         except:
             self._transforms['transform'] = []
 
+        # Any options for the compiled normalization (the output dtype and
+        # layout) are passed as a dictionary in the third value, if at all.
+        options = transform[2] if len(transform) > 2 else {}
         if transform[1] == 'scale':
-            tfm = ScaleTransform(None)
+            tfm = ScaleTransform(None, **options)
             if norm_transform_index != -1:
                 self._transforms['transform'][norm_transform_index] = tfm
             else:
@@ -258,7 +324,7 @@ class TransformManager(AgMLSerializable):
                 # Default ImageNet mean and std.
                 mean = [0.485, 0.456, 0.406]
                 std = [0.229, 0.224, 0.225]
-            tfm = NormalizationTransform((mean, std))
+            tfm = NormalizationTransform((mean, std), **options)
             if norm_transform_index != -1:
                 self._transforms['transform'][norm_transform_index] = tfm
             else:
@@ -268,6 +334,20 @@ class TransformManager(AgMLSerializable):
                 self._transforms['transform'].pop(norm_transform_index)
         return
 
+    @staticmethod
+    def _maybe_generator_transform(transform):
+        """Wraps a functional transform which accepts a random `Generator`.
+
+        A functional transform can have an `rng` argument, in which case
+        it is passed the random `np.random.Generator` for each sample, which
+        is derived from the loader's seed, the epoch, and the sample's index.
+        Using it (rather than the global random state) makes the output of
+        the transform reproducible, regardless of any parallel loading.
+        """
+        if 'rng' in inspect.signature(transform).parameters:
+            return GeneratorTransform(transform)
+        return transform
+
     # The following methods implement different checks which validate
     # as well as process input transformations, and manage the backend.
     # The transforms here will be also checked to match a specific
@@ -291,11 +371,12 @@ class TransformManager(AgMLSerializable):
         # the function is valid. Note that this also includes partial methods.
         elif isinstance(transform, (types.FunctionType, functools.partial)):
             sig = inspect.signature(transform).parameters
-            if not len(sig) == 1:
+            num_args = len(sig) - ('rng' in sig)
+            if not num_args == 1:
                 raise TypeError("Expected a single-image transform passed "
                                 "to `transform` to accept one input image,"
-                                f"instead got {len(sig)} parameters.")
-            return transform
+                                f"instead got {num_args} parameters.")
+            return TransformManager._maybe_generator_transform(transform)
 
         # An `albumentations` transform to be applied to the image. This
         # wraps the transform into a method which treats it as a regular
@@ -304,13 +385,14 @@ class TransformManager(AgMLSerializable):
             return AlbumentationsTransformSingle(transform)
 
         # A set of `torchvision` transforms wrapped into a `T.Compose` object
-        # or just a single transformation. This simply confirms the backend.
+        # or just a single transformation. This confirms the backend, and
+        # wraps the transform so that its random state is seeded per sample.
         elif 'torchvision' in transform.__module__:
             if get_backend() != 'torch':
                 if user_changed_backend():
                     raise StrictBackendError(change = 'tf', obj = transform)
                 set_backend('tf')
-            return transform
+            return TorchvisionTransform(transform)
 
         # A `tf.keras.Sequential` preprocessing model or an individual
         # Keras preprocessing layer. This simply confirms the backend.
@@ -351,12 +433,13 @@ class TransformManager(AgMLSerializable):
         # the function is valid. Note that this also includes partial methods.
         elif isinstance(transform, (types.FunctionType, functools.partial)):
             sig = inspect.signature(transform).parameters
-            if not len(sig) == 2:
+            num_args = len(sig) - ('rng' in sig)
+            if not num_args == 2:
                 raise TypeError(f"Expected a semantic segmentation transform "
                                 f"passed to `transform` to accept two args: "
                                 f"an input image and an annotation mask, "
-                                f"instead got {len(sig)} parameters.")
-            return transform
+                                f"instead got {num_args} parameters.")
+            return TransformManager._maybe_generator_transform(transform)
 
         # An `albumentations` transform to be applied to the image. This
         # wraps the transform into a method which treats it as a regular
@@ -412,12 +495,13 @@ class TransformManager(AgMLSerializable):
         # the function is valid. Note that this also includes partial methods.
         elif isinstance(transform, (types.FunctionType, functools.partial)):
             sig = inspect.signature(transform).parameters
-            if not len(sig) == 2:
+            num_args = len(sig) - ('rng' in sig)
+            if not num_args == 2:
                 raise TypeError(f"Expected a object detection transform passed "
                                 f"to `transform` to accept two args: an input "
                                 f"image and a COCO JSON dictionary, instead "
-                                f"got {len(sig)} parameters.")
-            return transform
+                                f"got {num_args} parameters.")
+            return TransformManager._maybe_generator_transform(transform)
 
         # An `albumentations` transform to be applied to the image. This
         # wraps the transform into a method which treats it as a regular
@@ -430,4 +514,35 @@ class TransformManager(AgMLSerializable):
         # each of the potential cases of the transformations.
         return transform
 
+    def _construct_batch_transform(self, transform):
+        """Validates a transform which is applied to an entire batch.
 
+        Batch transforms are either one of the `BatchTransform`s in the module
+        `agml.data.batch_transforms`, which are bound to the task, or a method
+        which accepts a batch of images and a batch of annotations (and
+        optionally, a random `Generator` as `rng`) and returns both of them.
+        """
+        # This case is used for clearing a transformation.
+        if transform is None:
+            return None
+
+        # One of the built-in batch transforms, which may also need to
+        # update the annotations, so they need to know the task.
+        if isinstance(transform, BatchTransform):
+            return transform.for_task(self._task)
+
+        # A general functional transformation, which is validated in the
+        # same way as the other functional transforms (see above).
+        elif isinstance(transform, (types.FunctionType, functools.partial)):
+            sig = inspect.signature(transform).parameters
+            num_args = len(sig) - ('rng' in sig)
+            if not num_args == 2:
+                raise TypeError(f"Expected a batch transform to accept two "
+                                f"args: a batch of images and a batch of "
+                                f"annotations, instead got {num_args} parameters.")
+            return self._maybe_generator_transform(transform)
+
+        # Any other callable is applied to the batch as-is.
+        if not callable(transform):
+            raise TypeError(f"Expected a callable batch transform, got {transform}.")
+        return transform
@@ -0,0 +1,187 @@
+# Copyright 2021 UC Davis Plant AI and Biophysics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A persisted manifest of the contents of a local dataset.
+
+Generating the contents of a dataset (see the `DataBuilder`) requires
+listing every directory in the dataset, or parsing its entire annotation
+file, which on a networked filesystem can take a long time for large
+datasets. The manifest stores the generated contents as a `SampleIndex`
+(and for object detection, a `COCOAnnotationStore`), in `.npy` files which
+are memory-mapped when loaded, inside the `.agml_cache` directory of the
+dataset. Later loaders for the dataset then load the manifest instead.
+
+The manifest is validated with a cheap fingerprint of the dataset: the
+names of the entries in the dataset directory, the modification times of
+each of its sub-directories (which change whenever a file is added to or
+removed from them), and the modification time and size of the annotation
+file. If any of these has changed, the manifest is re-generated.
+
+Next to the manifest, the `.agml_cache` directory also stores an index of
+the `(width, height, channels)` of the images in the dataset, read from their
+headers (see `DataManager.image_shapes`), which is built the first time that
+it is needed and validated the same way. It is kept in its own directory, so
+it isn't removed when the manifest is re-written.
+"""
+import os
+import json
+import shutil
+
+import numpy as np
+
+from agml.data.index import SampleIndex
+from agml.data.annotations import COCOAnnotationStore
+
+
+# The version of the manifest format. Manifests with a different version
+# are ignored (and overwritten), so this changes when the format does.
+_MANIFEST_VERSION = 1
+
+
+def manifest_location(root):
+    """Returns the location of the manifest for a dataset directory."""
+    return os.path.join(root, '.agml_cache', 'manifest')
+
+
+def dataset_fingerprint(root):
+    """Generates a cheap fingerprint of the contents of a dataset directory."""
+    entries, directories, files = [], {}, {}
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            entries.append(entry.name)
+            stat = entry.stat()
+            if entry.is_dir():
+                directories[entry.name] = stat.st_mtime_ns
+            else:
+                files[entry.name] = [stat.st_mtime_ns, stat.st_size]
+    return {'entries': sorted(entries),
+            'directories': directories,
+            'files': files}
+
+
+def load_manifest(root, task):
+    """Loads the manifest of a dataset, if it exists and is still valid.
+
+    Returns a tuple of the `SampleIndex` and the `COCOAnnotationStore`
+    (`None` for tasks other than object detection), or `None` if there is
+    no valid manifest for the dataset.
+    """
+    location = manifest_location(root)
+    try:
+        with open(os.path.join(location, 'manifest.json'), 'r') as f:
+            info = json.load(f)
+        if info.get('version', None) != _MANIFEST_VERSION \
+                or info['root'] != root or info['task'] != task \
+                or info['fingerprint'] != dataset_fingerprint(root):
+            return None
+        index = SampleIndex.load(location, info['index'])
+        coco_store = None
+        if info['coco']:
+            coco_store = COCOAnnotationStore.load(location)
+    except (OSError, ValueError, KeyError):
+        return None
+    return index, coco_store
+
+
+def write_manifest(root, task, index, coco_store = None):
+    """Writes the manifest of a dataset, returning whether it was written.
+
+    The manifest is written into a temporary directory and then moved into
+    place, so a partially-written manifest is never loaded. If the dataset
+    directory can't be written to (e.g., a read-only filesystem), then no
+    manifest is written and the contents are generated on every load.
+    """
+    location = manifest_location(root)
+    tmp_location = location + f'.tmp{os.getpid()}'
+    try:
+        fingerprint = dataset_fingerprint(root)
+        if os.path.exists(tmp_location):
+            shutil.rmtree(tmp_location)
+        os.makedirs(tmp_location)
+        info = {'version': _MANIFEST_VERSION, 'root': root, 'task': task,
+                'fingerprint': fingerprint, 'index': index.save(tmp_location),
+                'coco': coco_store is not None}
+        if coco_store is not None:
+            coco_store.save(tmp_location)
+        with open(os.path.join(tmp_location, 'manifest.json'), 'w') as f:
+            json.dump(info, f)
+        if os.path.exists(location):
+            shutil.rmtree(location)
+        os.rename(tmp_location, location)
+    except OSError:
+        shutil.rmtree(tmp_location, ignore_errors = True)
+        return False
+    return True
+
+
+def _image_shapes_location(root):
+    return os.path.join(root, '.agml_cache', 'image_shapes')
+
+
+def load_image_shapes(root):
+    """Loads the image shape index of a dataset, if it exists and is valid.
+
+    Returns a dictionary mapping the absolute path of each indexed image to
+    its `(width, height, channels)`, which is empty if there is no valid
+    index for the dataset (or the dataset isn't a local directory).
+    """
+    if root is None or not os.path.isdir(root):
+        return {}
+    location = _image_shapes_location(root)
+    try:
+        with open(os.path.join(location, 'image_shapes.json'), 'r') as f:
+            info = json.load(f)
+        if info.get('version', None) != _MANIFEST_VERSION \
+                or info['fingerprint'] != dataset_fingerprint(root):
+            return {}
+        shapes = np.load(os.path.join(location, 'image_shapes.npy'))
+        if shapes.shape != (len(info['paths']), 3):
+            return {}
+    except (OSError, ValueError, KeyError):
+        return {}
+    return dict(zip(info['paths'], map(tuple, shapes.tolist())))
+
+
+def write_image_shapes(root, shapes):
+    """Writes the image shape index of a dataset, returning whether it was.
+
+    The `shapes` map the absolute path of each image to its `(width, height,
+    channels)`. Like the manifest, the index is written into a temporary
+    directory and then moved into place, and isn't written if the dataset
+    directory can't be written to.
+    """
+    if root is None or not os.path.isdir(root):
+        return False
+    location = _image_shapes_location(root)
+    tmp_location = location + f'.tmp{os.getpid()}'
+    try:
+        fingerprint = dataset_fingerprint(root)
+        if os.path.exists(tmp_location):
+            shutil.rmtree(tmp_location)
+        os.makedirs(tmp_location)
+        np.save(os.path.join(tmp_location, 'image_shapes.npy'), np.array(
+            list(shapes.values()), dtype = np.int64).reshape(-1, 3))
+        with open(os.path.join(tmp_location, 'image_shapes.json'), 'w') as f:
+            json.dump({'version': _MANIFEST_VERSION, 'fingerprint': fingerprint,
+                       'paths': list(shapes.keys())}, f)
+        if os.path.exists(location):
+            shutil.rmtree(location)
+        os.rename(tmp_location, location)
+    except OSError:
+        shutil.rmtree(tmp_location, ignore_errors = True)
+        return False
+    return True
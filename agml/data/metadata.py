@@ -68,6 +68,7 @@ class DatasetMetadata(AgMLSerializable):
     be accessed by treating the `info` object as a dictionary.
     """
     serializable = frozenset(('name', 'metadata', 'citation_meta'))
+    immutable = serializable
 
     def __init__(self, name):
         self._load_source_info(name)
@@ -14,16 +14,37 @@
 
 import os
 import abc
-from functools import wraps
+from functools import wraps, lru_cache
 
-import cv2
 import numpy as np
 
 from agml.framework import AgMLSerializable
-from agml.utils.image import imread_context
+from agml.data.cache import cached_image
+from agml.data.packed import read_packed_file
+from agml.data.annotations import find_coco_store
+from agml.utils.image import (
+    imread_context, imdecode_context, bgr_to_rgb, read_image_header,
+    reduced_decode_factor, REDUCED_DECODE_FLAGS
+)
 from agml.utils.general import scalar_unpack
 
 
+@lru_cache(maxsize = 1 << 16)
+def _read_image_header(path, root = None):
+    """Returns the header shape of a JPEG or PNG image, or `None`.
+
+    The headers are cached by path (with a bounded number of entries), so
+    repeated lookups of the size of an image don't access the file again.
+    """
+    if not path.lower().endswith(('.jpg', '.jpeg', '.png')):
+        return None
+    buffer = read_packed_file(path, root)
+    try:
+        return read_image_header(buffer if buffer is not None else path)
+    except OSError:
+        return None
+
+
 class DataObject(AgMLSerializable):
     """Stores a single piece of data and its corresponding annotation.
 
@@ -40,6 +61,7 @@ class DataObject(AgMLSerializable):
     """
     serializable = frozenset(
         ('image_object', 'annotation_obj', 'dataset_root'))
+    immutable = serializable
     _abstract = frozenset(('_load_image_input', '_parse_annotation'))
 
     def __init__(self, image, annotation, root):
@@ -64,31 +86,118 @@ class DataObject(AgMLSerializable):
         return f"<DataObject: {self._image_object}, {self._annotation_obj}>"
 
     @staticmethod
-    def _parse_image(path):
-        with imread_context(os.path.abspath(path)) as image:
-            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    def _read_image(path, flags = None, root = None):
+        # If the dataset (at `root`) has a packed copy, then the image is
+        # decoded directly from the packed shards instead of the file.
+        buffer = read_packed_file(path, root)
+        if buffer is not None:
+            with imdecode_context(buffer, path, flags = flags) as image:
+                return image
+        with imread_context(path, flags = flags) as image:
+            return image
+
+    @staticmethod
+    def _image_header(path, root = None):
+        """Returns the header shape of a JPEG or PNG image, or `None`."""
+        return _read_image_header(path, root)
+
+    @staticmethod
+    def _jpeg_size(path, root = None):
+        """Returns the full size of a JPEG image, or `None` if not a JPEG."""
+        if not path.lower().endswith(('.jpg', '.jpeg')):
+            return None
+        header = DataObject._image_header(path, root)
+        return None if header is None else header[:2]
 
     @staticmethod
-    def _parse_depth_image(path):
-        with imread_context(os.path.abspath(path), flags = -1) as image:
+    def _decode_factor(path, target_size, root = None):
+        """Returns the reduced JPEG decoding factor for a target size."""
+        if target_size is None:
+            return 1
+        size = DataObject._jpeg_size(path, root)
+        if size is None:
+            return 1
+        return reduced_decode_factor(size, target_size)
+
+    @staticmethod
+    def _parse_image(path, target_size = None, root = None):
+        path = os.path.abspath(path)
+
+        # If the image is going to be resized to a much smaller size, then
+        # a JPEG image is decoded directly at a reduced resolution (which
+        # is still at least as large as the target), before the final resize.
+        factor = DataObject._decode_factor(path, target_size, root)
+        flags = REDUCED_DECODE_FLAGS.get(factor, None)
+
+        def _load():
+            return bgr_to_rgb(DataObject._read_image(
+                path, flags = flags, root = root))
+        if factor == 1:
+            return cached_image((path, 'rgb'), _load)
+        return cached_image((path, 'rgb', factor), _load)
+
+    @staticmethod
+    def _parse_depth_image(path, root = None):
+        path = os.path.abspath(path)
+
+        def _load():
+            image = DataObject._read_image(path, flags = -1, root = root)
             return image.astype(np.int32)
+        return cached_image((path, 'depth'), _load)
 
     @staticmethod
     def _parse_spectral_image(path):
         None # noqa, prevents `all abstract methods must be implemented`
         raise NotImplementedError("Multi/Hyperspectral images are not yet supported.")
 
-    def get(self):
+    def get(self, target_size = None):
         """Returns the image and annotation pair with applied transforms.
 
         This method is the main exposed method to process the data. It loads
         the image and processes the annotation, then applies transformations.
+
+        If a `target_size` is given, it is the `(width, height)` the image
+        will be resized to afterwards, and JPEG images which are at least
+        twice as large are decoded at a reduced resolution (1/2, 1/4, or 1/8).
+        The returned image is then smaller than the full image (but at least
+        as large as the target size), and any annotation which is measured in
+        pixels (e.g., bounding boxes) is rescaled to match the returned image.
+        """
+        return self._load(target_size)
+
+    def get_annotation(self):
+        """Returns only the parsed annotation, without loading the image."""
+        return self._parse_annotation(self._annotation_obj)
+
+    def get_image_shape(self):
+        """Returns the `(width, height, channels)` of the input image.
+
+        For JPEG and PNG images, this is read from the header of the file,
+        so the image isn't decoded; other images are decoded to get it.
+        """
+        path = self._image_path()
+        shape = self._image_header(path, self._dataset_root)
+        if shape is None:
+            image = self._read_image(path, root = self._dataset_root)
+            channels = image.shape[2] if image.ndim == 3 else 1
+            shape = (image.shape[1], image.shape[0], channels)
+        return shape
+
+    def get_image_size(self):
+        """Returns the `(width, height)` of the input image.
+
+        This is the size from `get_image_shape()`, so it is read from the
+        header of JPEG and PNG images rather than by decoding the image.
         """
-        return self._load()
+        return self.get_image_shape()[:2]
 
-    def _load(self):
+    def _image_path(self):
+        """Returns the absolute path to the input image."""
+        return os.path.abspath(self._image_object)
+
+    def _load(self, target_size = None):
         """Loads the image and annotation and returns them."""
-        image = self._load_image_input(self._image_object)
+        image = self._load_image_input(self._image_object, target_size)
         annotation = self._parse_annotation(self._annotation_obj)
         return image, annotation
 
@@ -106,14 +215,20 @@ class DataObject(AgMLSerializable):
             setattr(cls, name, method)
 
     @staticmethod
-    def create(contents, task, root):
-        """Creates a new `DataObject` for the corresponding task."""
+    def create(contents, task, root, from_store = False):
+        """Creates a new `DataObject` for the corresponding task.
+
+        For object detection, `from_store` indicates that the contents are
+        those of the dataset's `COCOAnnotationStore`, in which case the
+        annotation is sliced from the store rather than parsed each time.
+        """
         if task == 'image_classification':
             cls = ImageClassificationDataObject
         elif task == 'image_regression':
             cls = ImageRegressionDataObject
         elif task == 'object_detection':
-            cls = ObjectDetectionDataObject
+            return ObjectDetectionDataObject(
+                *contents, root, from_store = from_store)
         elif task == 'semantic_segmentation':
             cls = SemanticSegmentationDataObject
         else:
@@ -123,7 +238,7 @@ class DataObject(AgMLSerializable):
     # The following methods are used to load the image and annotation.
 
     @abc.abstractmethod
-    def _load_image_input(self, path):
+    def _load_image_input(self, path, target_size = None):
         """Loads image inputs based on the task. Derived by subclasses."""
         raise NotImplementedError()
 
@@ -171,21 +286,25 @@ class DataObject(AgMLSerializable):
         return annotation
 
     @staticmethod
-    def _parse_mask(obj):
+    def _parse_mask(obj, root = None):
         """Parses a mask for a semantic segmentation task."""
-        with imread_context(os.path.realpath(obj)) as image:
+        path = os.path.realpath(obj)
+
+        def _load():
+            image = DataObject._read_image(path, root = root)
             if image.ndim == 3:
                 if not np.all(image[:, :, 0] == image[:, :, 1]):
                     raise TypeError(
                         f"Invalid annotation mask of shape {image.shape}.")
                 image = image[:, :, 0]
             return np.squeeze(image)
+        return cached_image((path, 'mask'), _load)
 
 
 class ImageClassificationDataObject(DataObject):
     """Serves as a `DataObject` for image classification tasks."""
-    def _load_image_input(self, path):
-        return self._parse_image(path)
+    def _load_image_input(self, path, target_size = None):
+        return self._parse_image(path, target_size, self._dataset_root)
 
     def _parse_annotation(self, obj):
         return self._parse_label(obj)
@@ -193,19 +312,22 @@ class ImageClassificationDataObject(DataObject):
 
 class ImageRegressionDataObject(DataObject):
     """Serves as a `DataObject` for image regression tasks."""
-    def _load_image_input(self, contents):
+    def _load_image_input(self, contents, target_size = None):
         # The easy case, when there is only one input image.
-        if isinstance(contents, str) and os.path.exists(contents):
-            return self._parse_image(contents)
+        if isinstance(contents, str):
+            return self._parse_image(
+                contents, target_size, self._dataset_root)
 
         # Otherwise, we have a dictionary containing multiple
         # input types, so we need to independently load those.
         images = dict.fromkeys(contents.keys(), None)
         for c_type, path in contents.items():
             if c_type == 'image':
-                images[c_type] = self._parse_image(path)
+                images[c_type] = self._parse_image(
+                    path, target_size, self._dataset_root)
             elif c_type == 'depth_image':
-                images[c_type] = self._parse_depth_image(path)
+                images[c_type] = self._parse_depth_image(
+                    path, self._dataset_root)
             else:
                 images[c_type] = self._parse_spectral_image(path)
         return images
@@ -213,24 +335,71 @@ class ImageRegressionDataObject(DataObject):
     def _parse_annotation(self, obj):
         return obj
 
+    def _image_path(self):
+        # For multiple input types, the size is that of the RGB image.
+        if isinstance(self._image_object, str):
+            return os.path.abspath(self._image_object)
+        return os.path.abspath(self._image_object['image'])
+
 
 class ObjectDetectionDataObject(DataObject):
     """Serves as a `DataObject` from object detection tasks."""
-    def _load_image_input(self, path):
+    serializable = DataObject.serializable | frozenset(('from_store',))
+    immutable = serializable
+
+    def __init__(self, image, annotation, root, from_store = False):
+        super().__init__(image, annotation, root)
+
+        # Whether the object was created from the same contents as the
+        # `COCOAnnotationStore` of the dataset (see `_parse_annotation()`).
+        self._from_store = from_store
+
+    def _load_image_input(self, path, target_size = None):
         path = os.path.join(self._dataset_root, 'images', path)
-        return self._parse_image(path)
+        return self._parse_image(path, target_size, self._dataset_root)
+
+    def _image_path(self):
+        return os.path.abspath(os.path.join(
+            self._dataset_root, 'images', self._image_object))
 
     def _parse_annotation(self, obj):
+        # The annotation is sliced from the pre-parsed store of the dataset's
+        # annotations, if the object was created from it, rather than being
+        # parsed each time. Other objects (e.g., with a modified annotation)
+        # always have their own annotation parsed.
+        store = None
+        if self._from_store:
+            store = find_coco_store(self._dataset_root)
+        if store is not None:
+            annotation = store.get(self._image_object)
+            if annotation is not None:
+                return annotation
         return self._parse_coco(obj)
 
+    def _load(self, target_size = None):
+        image, annotation = super()._load(target_size)
+
+        # If the image was decoded at a reduced resolution, then the
+        # bounding boxes (and their areas) are scaled to match it.
+        if target_size is not None:
+            size = self._jpeg_size(self._image_path(), self._dataset_root)
+            if size is not None and size != image.shape[1::-1]:
+                x_scale = image.shape[1] / size[0]
+                y_scale = image.shape[0] / size[1]
+                if len(annotation['bbox']) != 0:
+                    annotation['bbox'] = annotation['bbox'] * np.array(
+                        [x_scale, y_scale, x_scale, y_scale])
+                    annotation['area'] = annotation['area'] * (x_scale * y_scale)
+        return image, annotation
+
 
 class SemanticSegmentationDataObject(DataObject):
     """Serves as a `DataObject` for semantic segmentation tasks."""
-    def _load_image_input(self, path):
-        return self._parse_image(path)
+    def _load_image_input(self, path, target_size = None):
+        return self._parse_image(path, target_size, self._dataset_root)
 
     def _parse_annotation(self, obj):
-        return self._parse_mask(obj)
+        return self._parse_mask(obj, self._dataset_root)
 
 
 
@@ -0,0 +1,299 @@
+# Copyright 2021 UC Davis Plant AI and Biophysics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A packed, random-access format for storing local datasets.
+
+Datasets with many small files can be slow to read on networked
+filesystems, where opening (and checking the existence of) every file
+costs more than actually decoding it. A packed dataset stores all of the
+files of a dataset directory in a few large shard files, alongside an
+index of their offsets. Files are then read directly from memory-mapped
+shards, without any per-file filesystem access.
+
+A packed copy of a dataset is stored next to the dataset directory, e.g.
+`~/.agml/datasets/<name>.agmlpack` for `~/.agml/datasets/<name>`, and
+when it exists, it is used transparently by the `AgMLDataLoader`.
+"""
+import os
+import mmap
+import shutil
+import threading
+import posixpath
+
+import numpy as np
+
+from agml.backend.config import data_save_path
+from agml.utils.logging import tqdm
+
+
+__all__ = ['pack_dataset']
+
+
+# The extension of the directory containing a packed dataset.
+_PACK_EXTENSION = '.agmlpack'
+
+
+def _pack_location(root):
+    """Returns the location of the packed copy of a dataset directory."""
+    return os.path.normpath(root) + _PACK_EXTENSION
+
+
+def pack_dataset(dataset, dataset_path = None, shard_size = 1 << 30):
+    """Packs a local dataset directory into a few large shard files.
+
+    This reads all of the files in a local dataset directory (the images,
+    as well as the annotation files and masks), and writes them sequentially
+    into shard files of roughly `shard_size` bytes, along with an index of
+    the path, shard, offset, and length of each file. The packed dataset is
+    stored next to the dataset directory, and from then on, any loader for
+    the dataset reads files from the shards instead of the individual files.
+
+    The dataset directory itself is kept, since the packed copy doesn't
+    need to contain files which aren't read by the `AgMLDataLoader`. If the
+    contents of the dataset directory are changed, the dataset should be
+    packed again, which overwrites the existing packed copy.
+
+    Parameters
+    ----------
+    dataset : str
+        Either the name of a dataset in the default dataset save directory,
+        or the path to a local dataset directory.
+    dataset_path : str, optional
+        The directory containing the dataset, if not the default directory.
+    shard_size : int
+        The approximate size of each shard file, in bytes.
+
+    Returns
+    -------
+    The path to the packed dataset.
+    """
+    # Resolve the path to the dataset.
+    if os.path.isdir(dataset):
+        root = dataset
+    else:
+        base = dataset_path if dataset_path is not None else data_save_path()
+        root = os.path.join(os.path.expanduser(base), dataset)
+        if os.path.basename(os.path.normpath(base)) == dataset:
+            root = os.path.expanduser(base)
+    root = os.path.abspath(root)
+    if not os.path.isdir(root):
+        raise NotADirectoryError(
+            f"Could not find a local dataset directory at '{root}'.")
+
+    # Gather all of the (non-hidden) files in the dataset.
+    files = []
+    for current, dirs, names in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(names):
+            if name.startswith('.'):
+                continue
+            files.append(os.path.join(current, name))
+
+    # Write the shards into a temporary location, and then move it into
+    # place, so that a partially written dataset is never picked up.
+    location = _pack_location(root)
+    tmp_location = location + '.tmp'
+    if os.path.exists(tmp_location):
+        shutil.rmtree(tmp_location)
+    os.makedirs(tmp_location)
+    paths, shards, offsets, lengths = [], [], [], []
+    shard_index, shard_offset, shard = 0, 0, None
+    try:
+        for path in tqdm(files, desc = f'Packing {os.path.basename(root)}'):
+            if shard is None or shard_offset >= shard_size:
+                if shard is not None:
+                    shard.close()
+                    shard_index += 1
+                shard = open(os.path.join(
+                    tmp_location, f'shard_{shard_index:05d}.bin'), 'wb')
+                shard_offset = 0
+            with open(path, 'rb') as f:
+                contents = f.read()
+            shard.write(contents)
+            paths.append(os.path.relpath(path, root).replace(os.sep, '/'))
+            shards.append(shard_index)
+            offsets.append(shard_offset)
+            lengths.append(len(contents))
+            shard_offset += len(contents)
+    finally:
+        if shard is not None:
+            shard.close()
+
+    # The paths are stored as one encoded buffer with offsets into it.
+    encoded = [p.encode('utf-8') for p in paths]
+    path_offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+    np.cumsum([len(p) for p in encoded], out = path_offsets[1:])
+    np.savez(os.path.join(tmp_location, 'index.npz'),
+             paths = np.frombuffer(b''.join(encoded), dtype = np.uint8),
+             path_offsets = path_offsets,
+             shards = np.array(shards, dtype = np.int32),
+             offsets = np.array(offsets, dtype = np.int64),
+             lengths = np.array(lengths, dtype = np.int64))
+
+    # Replace any existing packed copy of the dataset.
+    if os.path.exists(location):
+        shutil.rmtree(location)
+    os.rename(tmp_location, location)
+    _forget_packed_dataset(root)
+    return location
+
+
+class PackedDataset(object):
+    """Provides random access to the files in a packed dataset.
+
+    The shards are memory-mapped when they are first accessed, and files
+    are returned as zero-copy views into the mapped shards. This can also
+    be used to list the contents of directories in the packed dataset
+    without any filesystem access to the original dataset directory.
+    """
+
+    def __init__(self, location, root):
+        self._location = location
+        self._roots = tuple(dict.fromkeys((root, os.path.realpath(root))))
+        with np.load(os.path.join(location, 'index.npz')) as index:
+            buffer = index['paths'].tobytes()
+            path_offsets = index['path_offsets']
+            self._shards = index['shards']
+            self._offsets = index['offsets']
+            self._lengths = index['lengths']
+        self._entries = {
+            buffer[start:end].decode('utf-8'): i for i, (start, end) in
+            enumerate(zip(path_offsets[:-1], path_offsets[1:]))}
+        self._mapped_shards = {}
+        self._directories = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, relpath):
+        return relpath in self._entries
+
+    def _get_shard(self, index):
+        shard = self._mapped_shards.get(index, None)
+        if shard is None:
+            with self._lock:
+                shard = self._mapped_shards.get(index, None)
+                if shard is None:
+                    path = os.path.join(
+                        self._location, f'shard_{index:05d}.bin')
+                    with open(path, 'rb') as f:
+                        shard = mmap.mmap(
+                            f.fileno(), 0, access = mmap.ACCESS_READ)
+                    self._mapped_shards[index] = shard
+        return shard
+
+    def read_path(self, path):
+        """Returns the contents of a file given its absolute path, or `None`.
+
+        The path can be under either the dataset directory as it was found,
+        or its real path (e.g., with symbolic links resolved).
+        """
+        for root in self._roots:
+            if path.startswith(root + os.sep):
+                return self.read(path[len(root) + 1:].replace(os.sep, '/'))
+        return None
+
+    def read(self, relpath):
+        """Returns the contents of a file as a `np.uint8` array, or `None`."""
+        i = self._entries.get(relpath, None)
+        if i is None:
+            return None
+        if self._lengths[i] == 0:
+            return np.empty(0, dtype = np.uint8)
+        shard = self._get_shard(int(self._shards[i]))
+        return np.frombuffer(shard, dtype = np.uint8,
+                             count = int(self._lengths[i]),
+                             offset = int(self._offsets[i]))
+
+    def _build_directories(self):
+        directories = {}
+        for path in self._entries:
+            parent, name = posixpath.split(path)
+            directories.setdefault(parent, [set(), []])[1].append(name)
+            while parent != '':
+                parent, name = posixpath.split(parent)
+                directories.setdefault(parent, [set(), []])[0].add(name)
+        self._directories = directories
+
+    def list_dir(self, reldir):
+        """Returns the sub-directories and files in a directory, or `None`."""
+        if self._directories is None:
+            self._build_directories()
+        reldir = posixpath.normpath(reldir).strip('/')
+        if reldir == '.':
+            reldir = ''
+        contents = self._directories.get(reldir, None)
+        if contents is None:
+            return None
+        return sorted(contents[0]), list(contents[1])
+
+
+# A registry of the packed datasets which have been found, keyed by the
+# root of the original dataset directory (with `None` if not packed).
+_PACKED_DATASETS = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def find_packed_dataset(root, refresh = False):
+    """Returns the `PackedDataset` for a dataset directory, if it exists.
+
+    The result is cached (including when the dataset isn't packed), so
+    later lookups do no filesystem access. If `refresh` is set, then a
+    dataset which wasn't packed before is checked again, e.g., when a new
+    loader is created for it, in case it was packed in another process.
+    """
+    root = os.path.normpath(os.path.abspath(root))
+    try:
+        packed = _PACKED_DATASETS[root]
+        if packed is not None or not refresh:
+            return packed
+    except KeyError:
+        pass
+    with _REGISTRY_LOCK:
+        if _PACKED_DATASETS.get(root, None) is None:
+            # The packed copy is next to the directory, or for an alias of
+            # the directory (e.g., a symbolic link), next to its real path.
+            packed = None
+            for location in dict.fromkeys((
+                    _pack_location(root),
+                    _pack_location(os.path.realpath(root)))):
+                if os.path.exists(os.path.join(location, 'index.npz')):
+                    packed = PackedDataset(location, root)
+                    break
+            _PACKED_DATASETS[root] = packed
+        return _PACKED_DATASETS[root]
+
+
+def _forget_packed_dataset(root):
+    """Removes a dataset directory and its aliases from the registry."""
+    real_root = os.path.realpath(root)
+    with _REGISTRY_LOCK:
+        for key in list(_PACKED_DATASETS):
+            if key == root or os.path.realpath(key) == real_root:
+                _PACKED_DATASETS.pop(key, None)
+
+
+def read_packed_file(path, root):
+    """Reads a file from a packed dataset, or returns `None` if unavailable.
+
+    The `root` is the dataset directory which the file belongs to, whose
+    packed copy is looked up once (see `find_packed_dataset`), so this does
+    no filesystem access for files of datasets which aren't packed.
+    """
+    if root is None:
+        return None
+    packed = find_packed_dataset(root)
+    if packed is None:
+        return None
+    return packed.read_path(path)
+
@@ -0,0 +1,334 @@
+# Copyright 2021 UC Davis Plant AI and Biophysics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Exact, streaming statistics of the images and annotations in a dataset.
+
+The statistics are accumulated chunk by chunk, so no more than one chunk of
+images is ever held at once, and the partial statistics of each chunk are
+merged exactly (using the parallel variance algorithm of Chan et al.), so the
+chunks can be processed in parallel. The mean and standard deviation are those
+of all of the pixels in the dataset, rather than an average over the images.
+"""
+import numpy as np
+
+from agml.utils.logging import tqdm
+from agml.utils.parallel import build_executor
+
+
+__all__ = ['DatasetStatistics', 'compute_statistics']
+
+
+# The number of bins in the histogram of each channel. Integer images are
+# binned by their 0-255 value, and float images over the 0-1 range.
+_HISTOGRAM_BINS = 256
+
+
+def _add_counts(total, counts):
+    """Adds two arrays of counts, padding the shorter one with zeros."""
+    if total is None:
+        return counts.copy()
+    if len(counts) > len(total):
+        total, counts = counts, total
+    total = total.copy()
+    total[:len(counts)] += counts
+    return total
+
+
+def _as_image(image):
+    """Returns the image of a sample (which may have multiple inputs)."""
+    if isinstance(image, dict):
+        image = image['image']
+    return np.asarray(image)
+
+
+class DatasetStatistics(object):
+    """Accumulates exact statistics of the images and annotations of a dataset.
+
+    The pixel statistics are computed per channel, for the images scaled to
+    the 0-1 range (integer images are divided by 255, and float images are
+    assumed to already be in 0-1), which is the range of the images that they
+    are used to normalize. `uint8` images are first counted into a histogram,
+    from which their mean and variance are computed exactly, without creating
+    a floating-point copy of the image.
+
+    The annotation statistics depend on the `task`: for image classification
+    and object detection, the number of images (or objects) of each class are
+    counted, and for semantic segmentation, the number of masks containing each
+    class as well as the number of pixels of each class.
+
+    Parameters
+    ----------
+    task : str
+        The task of the dataset, which determines how annotations are counted.
+    """
+
+    def __init__(self, task = None):
+        self._task = task
+        self._num_images = 0
+        self._count = 0
+        self._mean = None
+        self._m2 = None
+        self._histogram = None
+        self._class_counts = None
+        self._mask_pixel_counts = None
+
+    @property
+    def task(self):
+        return self._task
+
+    @property
+    def num_images(self):
+        """The number of images which have been accumulated."""
+        return self._num_images
+
+    @property
+    def num_pixels(self):
+        """The number of pixels (per channel) which have been accumulated."""
+        return self._count
+
+    @property
+    def mean(self):
+        """The per-channel mean of the pixels in the 0-1 range."""
+        return self._mean
+
+    @property
+    def variance(self):
+        """The per-channel (population) variance of the pixels."""
+        if self._m2 is None:
+            return None
+        return self._m2 / max(self._count, 1)
+
+    @property
+    def std(self):
+        """The per-channel (population) standard deviation of the pixels."""
+        if self._m2 is None:
+            return None
+        return np.sqrt(self.variance)
+
+    @property
+    def histogram(self):
+        """A `(channels, 256)` array with the histogram of each channel."""
+        return self._histogram
+
+    @property
+    def class_counts(self):
+        """The number of images (or objects or masks) of each class.
+
+        This is indexed by the class label, so for object detection (which
+        has one-indexed category IDs), the first count is always zero.
+        """
+        return self._class_counts
+
+    @property
+    def mask_pixel_counts(self):
+        """The number of pixels of each class (for semantic segmentation)."""
+        return self._mask_pixel_counts
+
+    def to_dict(self):
+        """Returns the statistics as a JSON-serializable dictionary."""
+        def _list(value):
+            return None if value is None else value.tolist()
+        return {'num_images': self._num_images,
+                'num_pixels': self._count,
+                'mean': _list(self.mean),
+                'std': _list(self.std),
+                'class_counts': _list(self._class_counts),
+                'mask_pixel_counts': _list(self._mask_pixel_counts)}
+
+    def _merge_moments(self, count, mean, m2):
+        """Merges the moments of a set of pixels into the running moments."""
+        if count == 0:
+            return
+        if self._count == 0:
+            self._count, self._mean, self._m2 = count, mean, m2
+            return
+        if len(mean) != len(self._mean):
+            raise ValueError(
+                f"Got images with {len(mean)} channels, but the previous "
+                f"images had {len(self._mean)} channels.")
+        total = self._count + count
+        delta = mean - self._mean
+        self._mean = self._mean + delta * (count / total)
+        self._m2 = self._m2 + m2 + delta ** 2 * (self._count * count / total)
+        self._count = total
+
+    def _update_pixels(self, pixels):
+        """Accumulates an `(N, channels)` array of pixels."""
+        channels = pixels.shape[1]
+        offsets = np.arange(channels) * _HISTOGRAM_BINS
+        if pixels.dtype == np.uint8:
+            bins = pixels
+        else:
+            if np.issubdtype(pixels.dtype, np.integer):
+                pixels = pixels / 255
+            bins = np.clip(pixels * _HISTOGRAM_BINS, 0, _HISTOGRAM_BINS - 1)
+            bins = bins.astype(np.intp)
+        histogram = np.bincount(
+            (bins + offsets).ravel(), minlength = channels * _HISTOGRAM_BINS
+        ).reshape(channels, _HISTOGRAM_BINS)
+
+        # The moments of `uint8` pixels are computed exactly from their
+        # histogram, and those of any other pixels from the pixels.
+        count = len(pixels)
+        if pixels.dtype == np.uint8:
+            values = np.arange(_HISTOGRAM_BINS) / 255
+            mean = histogram @ values / max(count, 1)
+            m2 = np.sum(histogram * (values - mean[:, None]) ** 2, axis = 1)
+        else:
+            mean = pixels.mean(axis = 0, dtype = np.float64)
+            m2 = np.sum((pixels - mean) ** 2, axis = 0, dtype = np.float64)
+        self._merge_moments(count, mean, m2)
+        if self._histogram is None:
+            self._histogram = histogram
+        else:
+            self._histogram = self._histogram + histogram
+
+    def _update_classes(self, labels):
+        labels = np.asarray(labels)
+        if labels.ndim > 1 or (labels.ndim == 1 and labels.dtype.kind == 'f'):
+            labels = np.argmax(labels.reshape(-1, labels.shape[-1]), axis = -1)
+        labels = labels.astype(np.int64).ravel()
+        self._class_counts = _add_counts(
+            self._class_counts, np.bincount(labels))
+
+    def _update_mask(self, mask):
+        counts = np.bincount(np.asarray(mask, dtype = np.int64).ravel())
+        self._mask_pixel_counts = _add_counts(self._mask_pixel_counts, counts)
+        self._class_counts = _add_counts(
+            self._class_counts, (counts > 0).astype(np.int64))
+
+    def _update_annotation(self, annotation):
+        if self._task == 'image_classification':
+            self._update_classes(annotation)
+        elif self._task == 'object_detection':
+            self._update_classes(np.asarray(
+                annotation['category_id'], dtype = np.int64))
+        elif self._task == 'semantic_segmentation':
+            self._update_mask(annotation)
+
+    def update(self, image, annotation = None):
+        """Accumulates the statistics of a single image and its annotation."""
+        image = _as_image(image)
+        channels = image.shape[2] if image.ndim == 3 else 1
+        self._update_pixels(image.reshape(-1, channels))
+        self._num_images += 1
+        if annotation is not None:
+            self._update_annotation(annotation)
+        return self
+
+    def update_batch(self, images, annotations = None):
+        """Accumulates the statistics of a stacked batch of images.
+
+        The `images` are a `(B, H, W, C)` array (or `(B, H, W)` for single
+        channel images), and the `annotations` are the batched annotations,
+        e.g., an array of labels or a `(B, H, W)` array of masks.
+        """
+        images = _as_image(images)
+        channels = images.shape[3] if images.ndim == 4 else 1
+        self._update_pixels(images.reshape(-1, channels))
+        self._num_images += len(images)
+        if annotations is not None:
+            if self._task == 'semantic_segmentation':
+                for mask in annotations:
+                    self._update_mask(mask)
+            elif self._task == 'image_classification':
+                self._update_classes(annotations)
+        return self
+
+    def merge(self, other):
+        """Merges the statistics of another `DatasetStatistics` into these."""
+        self._merge_moments(other._count, other._mean, other._m2)
+        self._num_images += other._num_images
+        if other._histogram is not None:
+            self._histogram = other._histogram if self._histogram is None \
+                else self._histogram + other._histogram
+        for name in ('_class_counts', '_mask_pixel_counts'):
+            if getattr(other, name) is not None:
+                setattr(self, name, _add_counts(
+                    getattr(self, name), getattr(other, name)))
+        return self
+
+    def __repr__(self):
+        return f"<DatasetStatistics: {self._num_images} images, " \
+               f"mean={self.mean}, std={self.std}>"
+
+
+def _flatten_accessors(manager):
+    """Returns the indexes of all of the data objects used by a manager."""
+    accessors = manager._accessors # noqa
+    if manager._batch_size is None: # noqa
+        return np.asarray(accessors, dtype = np.int64)
+    if len(accessors) == 0:
+        return np.zeros(0, dtype = np.int64)
+    return np.concatenate([np.atleast_1d(np.asarray(
+        batch, dtype = np.int64)) for batch in accessors])
+
+
+def compute_statistics(loader, num_workers = None, chunk_size = 64):
+    """Computes the exact statistics of the images and annotations of a loader.
+
+    The images are loaded as they would be by the loader, including any
+    resizing (and its on-disk resize cache, or a `TensorStore` from
+    `loader.materialize()`, which is read directly), but without any
+    transforms or normalization. The samples are split into chunks of
+    `chunk_size`, whose statistics are computed in parallel by a pool of
+    threads and then merged, so the result doesn't depend on the number
+    of workers (see `DatasetStatistics`).
+
+    Parameters
+    ----------
+    loader : AgMLDataLoader
+        The loader to compute the statistics of.
+    num_workers : int, optional
+        The number of threads to use (by default, the number of CPUs).
+    chunk_size : int
+        The number of samples in each chunk.
+
+    Returns
+    -------
+    A `DatasetStatistics` with the statistics of the loader.
+    """
+    if chunk_size < 1:
+        raise ValueError(f"Expected a positive chunk size, got {chunk_size}.")
+    manager = loader._manager # noqa
+    task = loader.task
+    indexes = _flatten_accessors(manager)
+    chunks = [indexes[i:i + chunk_size]
+              for i in range(0, len(indexes), chunk_size)]
+    rows = manager._get_tensor_rows() # noqa
+    store = manager._tensor_store # noqa
+    objects = manager._data_objects # noqa
+    resize_manager = manager._resize_manager # noqa
+
+    def _chunk_statistics(chunk):
+        statistics = DatasetStatistics(task = task)
+        if rows is not None and task != 'object_detection':
+            images, annotations = store.get_batch(rows[chunk])
+            if task == 'image_regression':
+                annotations = None
+            return statistics.update_batch(images, annotations)
+        for index in chunk:
+            image, annotation = resize_manager.load(objects[int(index)])
+            if task == 'image_regression':
+                annotation = None
+            statistics.update(image, annotation)
+        return statistics
+
+    statistics = DatasetStatistics(task = task)
+    with build_executor('thread', num_workers) as pool:
+        for partial in tqdm(pool.map(_chunk_statistics, chunks),
+                            total = len(chunks), desc = 'Computing Statistics'):
+            statistics.merge(partial)
+    return statistics
@@ -28,25 +28,19 @@ def _resolve_coco_annotations(annotations):
     if isinstance(annotations, np.ndarray):
         return annotations
     if isinstance(annotations, list):
-        if not isinstance(annotations[0], dict):
+        if len(annotations) == 0 or not isinstance(annotations[0], dict):
             return annotations
-        if len(annotations) == 1:
-            return annotations
-        annotation = {'bboxes': [], 'labels': [], 'area': [],
-                      'image_id': "", 'iscrowd': [], 'segmentation': []}
-        for a_set in annotations:
-            annotation['bboxes'].append(a_set['bbox'])
-            annotation['labels'].append(a_set['category_id'])
-            annotation['iscrowd'].append(a_set['iscrowd'])
-            annotation['segmentation'].append(a_set['segmentation'])
-            annotation['area'].append(a_set['area'])
-            annotation['image_id'] = a_set['image_id']
-        for key, value in annotation.items():
-            out = np.array(value)
-            if np.isscalar(out):
-                out = out.item()
-            annotation[key] = out
-        return annotation
+
+        # Each of the values is built into an array in a single pass over
+        # the annotations, rather than appending them to lists one by one.
+        segmentation = np.empty(len(annotations), dtype = object)
+        segmentation[:] = [a.get('segmentation', []) for a in annotations]
+        return {'bboxes': np.array([a['bbox'] for a in annotations]).reshape(-1, 4),
+                'labels': np.array([a['category_id'] for a in annotations]),
+                'area': np.array([a['area'] for a in annotations]),
+                'image_id': annotations[-1]['image_id'],
+                'iscrowd': np.array([a.get('iscrowd', 0) for a in annotations]),
+                'segmentation': segmentation}
     elif isinstance(annotations, dict):
         return annotations
     else:
@@ -55,6 +49,29 @@ def _resolve_coco_annotations(annotations):
             "dictionary or a list of multiple dictionaries.")
 
 
+# The values of a COCO JSON annotation dictionary with one entry per box.
+_COCO_BOX_KEYS = ('bbox', 'category_id', 'area', 'iscrowd', 'segmentation')
+
+
+def _select_coco_boxes(coco, keep):
+    """Selects a subset of the boxes in a COCO JSON annotation dictionary.
+
+    The `keep` argument is either a boolean mask or an array of indexes
+    of the boxes, which is applied to all of the values that have one
+    entry per box (the other values, e.g., the image ID, are unchanged).
+    The dictionary is updated in-place, and then also returned.
+    """
+    num_boxes = len(coco['bbox'])
+    for key in _COCO_BOX_KEYS:
+        value = coco.get(key, None)
+        if value is None or len(value) != num_boxes:
+            continue
+        if not isinstance(value, np.ndarray):
+            value = np.array(value, dtype = object if key == 'segmentation' else None)
+        coco[key] = value[keep]
+    return coco
+
+
 def coco_to_bboxes(annotations):
     """Extracts the bounding boxes and labels from COCO JSON annotations.
 
@@ -73,7 +90,23 @@ def coco_to_bboxes(annotations):
     Two arrays consisting of the bounding boxes and labels.
     """
     annotations = _resolve_coco_annotations(annotations)
-    return annotations['bboxes'], annotations['labels']
+    if 'bboxes' in annotations:
+        return annotations['bboxes'], annotations['labels']
+    return (np.reshape(annotations['bbox'], (-1, 4)),
+            np.asarray(annotations['category_id']))
+
+
+# The formats of `convert_bbox_format`, each with a conversion of an `(N, 4)`
+# array in that format to COCO JSON boxes. Note that these conversions are
+# kept exactly as they were when the boxes were converted one at a time.
+_LEGACY_BBOX_FORMATS = [
+    (('x1', 'x2', 'y1', 'y2'), lambda b: np.stack(
+        [b[:, 0], b[:, 2], abs(b[:, 1] - b[:, 0]), abs(b[:, 3] - b[:, 2])], -1)),
+    (('x_min', 'y_min', 'x_max', 'y_max'), lambda b: np.stack(
+        [b[:, 0], b[:, 3], abs(b[:, 2] - b[:, 0]), abs(b[:, 3] - b[:, 1])], -1)),
+    (('x_min', 'y_min', 'width', 'height'), lambda b: np.stack(
+        [b[:, 0], b[:, 1] - b[:, 3], b[:, 2], b[:, 3]], -1)),
+    (('x1', 'y1', 'width', 'height'), lambda b: b)]
 
 
 def convert_bbox_format(annotations_or_bboxes, fmt):
@@ -95,6 +128,9 @@ def convert_bbox_format(annotations_or_bboxes, fmt):
     can be in any order, this just needs to be reflected in the 'fmt'
     argument, and it should contain some combination of the above.
 
+    All of the boxes are converted at once. For conversions between the
+    named formats (e.g., 'pascal_voc' and 'yolo'), see `convert_bboxes`.
+
     Parameters
     ----------
     annotations_or_bboxes : {np.ndarray, list, dict}
@@ -113,8 +149,7 @@ def convert_bbox_format(annotations_or_bboxes, fmt):
         annotations = annotations_or_bboxes['bboxes']
     else:
         annotations = annotations_or_bboxes
-        if isinstance(annotations[0], (int, float)):
-            annotations = [annotations]
+    annotations = np.reshape(np.asarray(annotations), (-1, 4))
     if isinstance(fmt, str):
         if ',' in fmt:
             fmt = fmt.split(',')
@@ -122,52 +157,302 @@ def convert_bbox_format(annotations_or_bboxes, fmt):
             fmt = fmt.split(' ')
     if len(fmt) != 4:
         raise ValueError(f"Argument 'fmt' should contain 4 values, got {len(fmt)}.")
-    
-    # Define all of the intermediate conversion methods
-    def _x1_x2_y1_y2_to_coco(annotation): # noqa
-        x1, x2, y1, y2 = annotation
-        width, height = abs(x2 - x1), abs(y2 - y1)
-        return [x1, y1, width, height]
-    def _xmin_ymin_xmax_ymax_to_coco(annotation): # noqa
-        xmin, ymin, xmax, ymax = annotation
-        width, height = abs(xmax - xmin), abs(ymax - ymin)
-        return [xmin, ymax, width, height]
-    def _xmin_ymin_width_height_to_coco(annotation): # noqa
-        xmin, ymin, width, height = annotation
-        x1, y1 = xmin, ymin - height
-        return [x1, y1, width, height]
-    def _x1_y1_width_height_to_coco(annotation): # noqa
-        return annotation # This is just here for reordering.
 
     # Resolve the format
-    fmt_bases = [['x1', 'x2', 'y1', 'y2'],
-                 ['x_min', 'y_min', 'x_max', 'y_max'],
-                 ['x_min', 'y_min', 'width', 'height'],
-                 ['x1', 'y1', 'width', 'height']]
-    fmt_map = {0: _x1_x2_y1_y2_to_coco,
-               1: _xmin_ymin_xmax_ymax_to_coco,
-               2: _xmin_ymin_width_height_to_coco,
-               3: _x1_y1_width_height_to_coco}
-    fmt_found = False
     map_fmt, select_order = None, None
-    for indx, base in enumerate(fmt_bases):
+    for base, convert in _LEGACY_BBOX_FORMATS:
         if all(i in base for i in fmt):
-            fmt_found, map_fmt = True, fmt_map[indx]
-            select_order = [base.index(i) for i in fmt]
-    if not fmt_found:
+            map_fmt, select_order = convert, [base.index(i) for i in fmt]
+    if map_fmt is None:
         raise ValueError(
             f"Invalid format {fmt}, see `convert_bbox_format` "
             f"for information about valid formats.")
 
-    # Convert the formats
-    formatted_annotations = []
-    for bbox in annotations:
-        sorted_bbox = np.array(bbox)[select_order]
-        formatted_annotations.append(map_fmt(sorted_bbox))
-    formatted_annotations = np.array(formatted_annotations)
+    # Convert all of the boxes at once.
+    formatted_annotations = map_fmt(annotations[:, select_order])
     if isinstance(annotations_or_bboxes, dict):
         res = annotations_or_bboxes.copy()
         res['bboxes'] = formatted_annotations
         return res
     return resolve_list_value(formatted_annotations)
 
+
+# The bounding box formats which are supported by the box methods below,
+# mapped from their names (and aliases) to a canonical name. These are:
+#
+# 1. 'coco' ('xywh'): (`x_min`, `y_min`, `width`, `height`).
+# 2. 'pascal_voc' ('xyxy'): (`x_min`, `y_min`, `x_max`, `y_max`).
+# 3. 'yolo' ('cxcywh'): (`x_center`, `y_center`, `width`, `height`).
+#
+# All of these are in image coordinates, so `y_min` is the top of a box.
+_BBOX_FORMATS = {'coco': 'coco', 'xywh': 'coco',
+                 'pascal_voc': 'pascal_voc', 'xyxy': 'pascal_voc',
+                 'yolo': 'yolo', 'cxcywh': 'yolo'}
+
+
+def _resolve_bbox_format(fmt):
+    try:
+        return _BBOX_FORMATS[fmt.lower()]
+    except (KeyError, AttributeError):
+        raise ValueError(
+            f"Invalid bounding box format {fmt}, expected "
+            f"one of {list(_BBOX_FORMATS.keys())}.")
+
+
+def _as_bbox_array(bboxes):
+    bboxes = np.asarray(bboxes)
+    if bboxes.size == 0:
+        return np.zeros((0, 4), dtype = np.result_type(bboxes, np.float32))
+    if bboxes.shape[-1] != 4:
+        raise ValueError(
+            f"Expected bounding boxes with 4 values in "
+            f"their last dimension, got shape {bboxes.shape}.")
+    return bboxes
+
+
+def convert_bboxes(bboxes, source = 'coco', target = 'pascal_voc'):
+    """Converts bounding boxes between formats.
+
+    The supported formats are 'coco' (`x_min`, `y_min`, `width`, `height`),
+    'pascal_voc' (`x_min`, `y_min`, `x_max`, `y_max`), and 'yolo'
+    (`x_center`, `y_center`, `width`, `height`), which can also be
+    referred to as 'xywh', 'xyxy', and 'cxcywh', respectively.
+
+    Parameters
+    ----------
+    bboxes : Any
+        An array of shape `(..., 4)` with the bounding boxes.
+    source : str
+        The format of the input bounding boxes.
+    target : str
+        The format to convert the bounding boxes to.
+
+    Returns
+    -------
+    An array of the same shape with the converted bounding boxes.
+    """
+    bboxes = _as_bbox_array(bboxes)
+    source, target = _resolve_bbox_format(source), _resolve_bbox_format(target)
+    if source == target:
+        return bboxes.copy()
+
+    # Convert to `pascal_voc`, and then from there to the target format.
+    a, b, c, d = np.moveaxis(bboxes, -1, 0)
+    if source == 'coco':
+        a, b, c, d = a, b, a + c, b + d
+    elif source == 'yolo':
+        a, b, c, d = a - c / 2, b - d / 2, a + c / 2, b + d / 2
+    if target == 'coco':
+        a, b, c, d = a, b, c - a, d - b
+    elif target == 'yolo':
+        a, b, c, d = (a + c) / 2, (b + d) / 2, c - a, d - b
+    return np.stack([a, b, c, d], axis = -1)
+
+
+def bbox_iou(bboxes1, bboxes2, fmt = 'coco'):
+    """Computes the pairwise intersection-over-union of two sets of boxes.
+
+    Parameters
+    ----------
+    bboxes1 : Any
+        An `(N, 4)` array of bounding boxes.
+    bboxes2 : Any
+        An `(M, 4)` array of bounding boxes.
+    fmt : str
+        The format of both sets of bounding boxes (see `convert_bboxes`).
+
+    Returns
+    -------
+    An `(N, M)` array with the IoU of each pair of boxes.
+    """
+    bboxes1 = convert_bboxes(
+        np.reshape(_as_bbox_array(bboxes1), (-1, 4)), fmt, 'pascal_voc')
+    bboxes2 = convert_bboxes(
+        np.reshape(_as_bbox_array(bboxes2), (-1, 4)), fmt, 'pascal_voc')
+    return _pairwise_iou(bboxes1.astype(np.float64), bboxes2.astype(np.float64))
+
+
+def _pairwise_iou(bboxes1, bboxes2):
+    """Computes the IoU of two sets of `pascal_voc` float boxes."""
+    area1 = (bboxes1[:, 2] - bboxes1[:, 0]) * (bboxes1[:, 3] - bboxes1[:, 1])
+    area2 = (bboxes2[:, 2] - bboxes2[:, 0]) * (bboxes2[:, 3] - bboxes2[:, 1])
+    top_left = np.maximum(bboxes1[:, None, :2], bboxes2[None, :, :2])
+    bottom_right = np.minimum(bboxes1[:, None, 2:], bboxes2[None, :, 2:])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    intersection = wh[..., 0] * wh[..., 1]
+    union = area1[:, None] + area2[None, :] - intersection
+    return np.divide(intersection, union, out = np.zeros_like(intersection),
+                     where = union > 0)
+
+
+def clip_bboxes(bboxes, image_size, fmt = 'coco'):
+    """Clips bounding boxes to the bounds of an image.
+
+    Parameters
+    ----------
+    bboxes : Any
+        An array of shape `(..., 4)` with the bounding boxes.
+    image_size : tuple
+        The `(width, height)` of the image.
+    fmt : str
+        The format of the bounding boxes (see `convert_bboxes`).
+
+    Returns
+    -------
+    An array with the clipped bounding boxes, in the same format.
+    """
+    width, height = image_size
+    bboxes = convert_bboxes(bboxes, fmt, 'pascal_voc')
+    np.clip(bboxes, 0, np.array([width, height, width, height],
+                                dtype = bboxes.dtype), out = bboxes)
+    return convert_bboxes(bboxes, 'pascal_voc', fmt)
+
+
+def normalize_bboxes(bboxes, image_size, fmt = 'coco', clip = True):
+    """Normalizes bounding boxes by the size of an image to the range [0, 1].
+
+    Parameters
+    ----------
+    bboxes : Any
+        An array of shape `(..., 4)` with the bounding boxes.
+    image_size : tuple
+        The `(width, height)` of the image.
+    fmt : str
+        The format of the bounding boxes (see `convert_bboxes`).
+    clip : bool
+        Whether to clip the boxes to the image first, so that parts of
+        boxes which are outside of the image don't go outside of [0, 1].
+
+    Returns
+    -------
+    A float array with the normalized bounding boxes, in the same format.
+    """
+    width, height = image_size
+    bboxes = _as_bbox_array(bboxes).astype(np.float64)
+    if clip:
+        bboxes = clip_bboxes(bboxes, image_size, fmt)
+    # Each of the formats alternates between x and y values.
+    return bboxes / np.array([width, height, width, height], dtype = np.float64)
+
+
+def denormalize_bboxes(bboxes, image_size, fmt = 'coco'):
+    """Scales normalized bounding boxes to the size of an image.
+
+    This is the inverse of `normalize_bboxes`: the boxes are scaled from
+    the range [0, 1] to the `(width, height)` of the image. The `fmt` is
+    accepted for symmetry with the other methods, since all formats scale
+    in the same way.
+    """
+    _resolve_bbox_format(fmt)
+    width, height = image_size
+    bboxes = _as_bbox_array(bboxes).astype(np.float64)
+    return bboxes * np.array([width, height, width, height], dtype = np.float64)
+
+
+def _overlapping_pairs(bboxes, iou_threshold, max_pairs = 1 << 22):
+    """Finds the pairs of `pascal_voc` boxes with an IoU above a threshold.
+
+    Rather than computing the IoU of every pair of boxes, the boxes are
+    sorted by their left edge, and only the pairs of boxes whose ranges of
+    x-coordinates overlap are compared, in chunks of up to `max_pairs`.
+    Returns the indexes of the boxes in each pair, with `first < second`.
+    """
+    order = np.argsort(bboxes[:, 0], kind = 'stable')
+    sorted_bboxes = bboxes[order]
+    ends = np.searchsorted(sorted_bboxes[:, 0], sorted_bboxes[:, 2], 'left')
+    counts = np.maximum(ends - np.arange(1, len(bboxes) + 1), 0)
+    cumulative = np.cumsum(counts)
+    firsts, seconds = [], []
+    start = 0
+    while start < len(bboxes):
+        # Take as many boxes as fit into the chunk (and at least one).
+        base = cumulative[start - 1] if start > 0 else 0
+        stop = max(int(np.searchsorted(
+            cumulative, base + max_pairs, 'right')), start + 1)
+        chunk_counts = counts[start:stop]
+        first = np.repeat(np.arange(start, stop), chunk_counts)
+        second = np.arange(len(first)) - np.repeat(
+            np.cumsum(chunk_counts) - chunk_counts, chunk_counts) + first + 1
+        a, b = sorted_bboxes[first], sorted_bboxes[second]
+        wh = np.clip(np.minimum(a[:, 2:], b[:, 2:])
+                     - np.maximum(a[:, :2], b[:, :2]), 0, None)
+        intersection = wh[:, 0] * wh[:, 1]
+        union = ((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+                 + (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]) - intersection)
+        overlapping = intersection > iou_threshold * union
+        if iou_threshold <= 0:
+            overlapping &= union > 0
+        firsts.append(order[first[overlapping]])
+        seconds.append(order[second[overlapping]])
+        start = stop
+    first, second = np.concatenate(firsts), np.concatenate(seconds)
+    return np.minimum(first, second), np.maximum(first, second)
+
+
+def non_max_suppression(bboxes, scores, iou_threshold = 0.5,
+                        labels = None, fmt = 'coco'):
+    """Runs non-maximum suppression on a set of predicted bounding boxes.
+
+    Boxes are considered in order of decreasing score, and a box is removed
+    if it overlaps a higher-scoring box which was kept with an IoU that is
+    greater than `iou_threshold`. If `labels` are passed, then only boxes
+    with the same label can suppress each other.
+
+    This is vectorized over all of the boxes, rather than being run one box
+    at a time: the pairs of overlapping boxes are found first (only comparing
+    boxes which overlap horizontally, not all pairs of boxes), and then all
+    of the boxes are resolved together, with a number of passes that depends
+    on the longest chain of overlapping boxes (not the number of boxes).
+
+    Parameters
+    ----------
+    bboxes : Any
+        An `(N, 4)` array of bounding boxes.
+    scores : Any
+        An `(N,)` array with the score of each of the bounding boxes.
+    iou_threshold : float
+        The IoU above which a box is suppressed by a higher-scoring box.
+    labels : Any
+        An optional `(N,)` array with the class label of each box.
+    fmt : str
+        The format of the bounding boxes (see `convert_bboxes`).
+
+    Returns
+    -------
+    An array with the indexes of the kept boxes, by decreasing score.
+    """
+    bboxes = convert_bboxes(np.reshape(
+        _as_bbox_array(bboxes), (-1, 4)), fmt, 'pascal_voc').astype(np.float64)
+    scores = np.asarray(scores).reshape(-1)
+    if len(scores) != len(bboxes):
+        raise ValueError(f"Got {len(bboxes)} bounding boxes, "
+                         f"but {len(scores)} scores.")
+    if len(bboxes) == 0:
+        return np.zeros((0,), dtype = np.int64)
+
+    # Boxes with different labels are moved so that they can't overlap.
+    if labels is not None:
+        labels = np.asarray(labels).reshape(-1)
+        if len(labels) != len(bboxes):
+            raise ValueError(f"Got {len(bboxes)} bounding boxes, "
+                             f"but {len(labels)} labels.")
+        _, label_ids = np.unique(labels, return_inverse = True)
+        offset = bboxes.max() - min(bboxes.min(), 0) + 1
+        bboxes = bboxes + (label_ids.reshape(-1) * offset)[:, None]
+
+    # Each pair is directed from the higher-scoring box to the other one.
+    order = np.argsort(-scores, kind = 'stable')
+    bboxes = bboxes[order]
+    higher, lower = _overlapping_pairs(bboxes, iou_threshold)
+
+    # A box is kept if no kept box before it overlaps it. Since each box
+    # only depends on the boxes before it, iterating this from all of the
+    # boxes being kept reaches the greedy result once it stops changing.
+    keep = np.ones(len(bboxes), dtype = bool)
+    while True:
+        suppressed = np.zeros(len(bboxes), dtype = bool)
+        suppressed[lower[keep[higher]]] = True
+        if np.array_equal(~suppressed, keep):
+            break
+        keep = ~suppressed
+    return order[keep]
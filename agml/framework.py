@@ -26,17 +26,27 @@ class AgMLSerializable(object):
     defined `__getstate__` and `__setstate__` method which consists
     of a dictionary with the necessary class attributes. In addition,
     it will have a `__copy__` and `__deepcopy__` method which have
-    the same behavior (the class is always deep copied).
+    the same behavior (`__copy__` goes through `__deepcopy__`), deep
+    copying all of the attributes except for the `immutable` ones.
 
     Subclasses only need to define a `serializable` property with a
     frozen set of strings containing the attributes that are to be
     serialized. The expectation is that the strings in the set will
     all be the name of attributes minus a leading underscore.
 
+    Subclasses can also define an `immutable` property, a subset of the
+    `serializable` attributes which are never modified after they are
+    constructed (e.g., the contents of a dataset). These are shared by
+    reference between copies of an object rather than being deep copied,
+    so copies only duplicate the remaining (mutable) state. Objects which
+    are referenced more than once within an object are copied only once,
+    so that the copies reference each other in the same way.
+
     In turn, objects can be used with a JSON serialization format,
     the pickle serialization format, or copied as desired.
     """
     serializable: "frozenset"
+    immutable = frozenset()
 
     def __getstate__(self):
         state = {}
@@ -55,13 +65,23 @@ class AgMLSerializable(object):
             setattr(self, f'_{field}', state[field])
 
     def __copy__(self):
-        params = self.__getstate__()
-        cls = super(AgMLSerializable, self).__new__(self.__class__)
-        cls.__setstate__(copy.deepcopy(params))
-        return cls
+        return self.__deepcopy__({})
 
     def __deepcopy__(self, memo = None):
-        return self.__copy__()
+        if memo is None:
+            memo = {}
+        if id(self) in memo:
+            return memo[id(self)]
+        cls = super(AgMLSerializable, self).__new__(self.__class__)
+        memo[id(self)] = cls
+        state = {}
+        for param, value in self.__getstate__().items():
+            if param in self.immutable:
+                state[param] = value
+            else:
+                state[param] = copy.deepcopy(value, memo)
+        cls.__setstate__(state)
+        return cls
 
 
 
@@ -13,7 +13,15 @@
 # limitations under the License.
 
 import os
+import io
+import json
+import time
+import zlib
+import shutil
+import hashlib
 import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 from agml.utils.data import (
@@ -22,20 +30,640 @@ from agml.utils.data import (
 from agml.utils.logging import tqdm, log
 
 
+# The location of the public datasets, formatted with the dataset name.
+_DATASET_URL = "https://agdata-data.s3.us-west-1.amazonaws.com/{}.zip"
 
-def download_dataset(dataset_name, dest_dir):
+# The default size of each of the ranges that files are downloaded in.
+_DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# The size of the reads from each response (and of the checksum reads).
+_STREAM_BLOCK_SIZE = 1024 * 1024
+
+# The file which marks that a dataset has been completely extracted.
+COMPLETE_MARKER = '.agml_complete'
+
+# The compression methods which can be extracted while they are downloaded.
+_STREAMABLE_METHODS = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+
+
+def _progress_path(path):
+    """Returns the path of the sidecar progress file of a download."""
+    return path + '.part.json'
+
+
+def _load_progress(path, info):
+    """Loads the completed chunks of a partial download, if it is resumable.
+
+    A partial download is only resumed if its progress file describes the
+    same file (the same URL, size, chunk size, and `ETag`/`Last-Modified`
+    validator) as the one being downloaded.
+    """
+    try:
+        with open(_progress_path(path), 'r') as f:
+            progress = json.load(f)
+        if any(progress.get(k, None) != v for k, v in info.items()):
+            return set()
+    except (OSError, ValueError):
+        return set()
+    return set(progress.get('completed', []))
+
+
+def _write_progress(path, info, completed):
+    """Atomically writes the sidecar progress file of a download."""
+    tmp_path = _progress_path(path) + f'.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(info, completed = sorted(completed)), f)
+    os.replace(tmp_path, _progress_path(path))
+
+
+def _remove_partial(path):
+    for file in (path + '.part', _progress_path(path)):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def _verify_checksum(path, checksum):
+    """Verifies a file against an `algorithm:hexdigest` (or SHA-256) checksum."""
+    algorithm, _, digest = checksum.rpartition(':')
+    hasher = hashlib.new(algorithm or 'sha256')
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_STREAM_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest() == digest.lower()
+
+
+def _build_session(num_connections):
+    """Creates a `requests.Session` with a pool of `num_connections`."""
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections = num_connections, pool_maxsize = num_connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _describe_remote(session, url):
+    """Returns the resolved URL, size, and range support of a remote file.
+
+    Also returns the information which identifies the remote file in the
+    progress file of a download (its `ETag` or `Last-Modified` validator).
+    """
+    r = session.head(url, allow_redirects = True, timeout = 60)
+    r.raise_for_status()
+    size = int(r.headers.get('Content-Length', -1))
+    ranged = size > 0 and r.headers.get('Accept-Ranges', '') == 'bytes'
+    validator = r.headers.get('ETag', None) \
+                or r.headers.get('Last-Modified', None)
+    return r.url, size, ranged, validator
+
+
+def _open_range(session, url, start, end):
+    """Opens a streamed request for the bytes `start` to `end` (inclusive)."""
+    r = session.get(url, stream = True, timeout = 60,
+                    headers = {'Range': f'bytes={start}-{end}'})
+    try:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError(f"The server ignored the range request for '{url}'.")
+    except BaseException:
+        r.close()
+        raise
+    return r
+
+
+def _run_resumable(work, pending, path, info, completed,
+                   num_connections, retries, progress):
+    """Runs the pending parts of a download in parallel, recording each one.
+
+    Each `work(part)` returns the number of bytes that it downloaded, and is
+    retried (with a backoff) if it fails, after the bytes that it reported
+    to the progress bar are removed from it. Once a part is done, it is added
+    to the `completed` parts in the progress file, so it is never re-run.
+    """
+    import requests
+
+    lock = threading.Lock()
+
+    def _run(part):
+        for attempt in range(retries + 1):
+            counter = _ProgressCounter(progress)
+            try:
+                work(part, counter)
+                break
+            except (requests.RequestException, IOError):
+                counter.revert()
+                if attempt == retries:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+        with lock:
+            completed.add(part[0])
+            _write_progress(path, info, completed)
+
+    with ThreadPoolExecutor(max_workers = num_connections) as pool:
+        # Consume the results, so that any error is re-raised.
+        for _ in pool.map(_run, pending):
+            pass
+
+
+class _ProgressCounter(object):
+    """Updates a progress bar, and counts the bytes that it was updated by."""
+    def __init__(self, progress):
+        self._progress = progress
+        self.count = 0
+
+    def update(self, n):
+        self.count += n
+        self._progress.update(n)
+
+    def revert(self):
+        self._progress.update(-self.count)
+        self.count = 0
+
+
+def _download_range(session, url, path, start, end, progress):
+    """Downloads the bytes `start` to `end` (inclusive) into the partial file."""
+    written = 0
+    with _open_range(session, url, start, end) as r:
+        with open(path + '.part', 'r+b') as f:
+            f.seek(start)
+            for block in r.iter_content(chunk_size = _STREAM_BLOCK_SIZE):
+                f.write(block)
+                written += len(block)
+                progress.update(len(block))
+    if written != end - start + 1:
+        raise IOError(f"Received {written} bytes for the range {start}-{end} "
+                      f"of '{url}', expected {end - start + 1} bytes.")
+
+
+def _download_stream(session, url, path, progress):
+    """Downloads a file in a single request (when ranges aren't supported)."""
+    with session.get(url, stream = True, timeout = 60) as r:
+        r.raise_for_status()
+        with open(path + '.part', 'wb') as f:
+            for block in r.iter_content(chunk_size = _STREAM_BLOCK_SIZE):
+                f.write(block)
+                progress.update(len(block))
+
+
+def _download_description(desc, path, size):
+    if desc is None:
+        desc = f"Downloading {os.path.basename(path)}"
+    if size > 0:
+        desc += f" (size = {round(size / 1000000, 1)} MB)"
+    return desc
+
+
+def download_file(url, path, num_connections = 8, chunk_size = _DEFAULT_CHUNK_SIZE,
+                  checksum = None, retries = 3, desc = None):
+    """Downloads a file over HTTP, in parallel and resumably.
+
+    If the server supports HTTP range requests, then the file is split into
+    chunks of `chunk_size` bytes, which are downloaded by `num_connections`
+    parallel connections directly into a partial file (`<path>.part`). The
+    completed chunks are recorded in a sidecar progress file (`<path>.part.json`),
+    so if the download is interrupted (or a chunk fails more than `retries`
+    times), calling this again resumes it, only downloading the missing chunks.
+    Otherwise, the file is downloaded in a single request.
+
+    Once downloaded, the size of the file is verified against the size reported
+    by the server and, if given, its `checksum` (an `algorithm:hexdigest`, e.g.,
+    `md5:...`, or a SHA-256 hex digest), before it is moved to `path`.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the file to download.
+    path : str
+        The local path to save the file to.
+    num_connections : int
+        The number of parallel connections to download the file with.
+    chunk_size : int
+        The size of each of the ranges the file is downloaded in, in bytes.
+    checksum : str, optional
+        The checksum to verify the downloaded file against.
+    retries : int
+        The number of times to retry each chunk if it fails.
+    desc : str, optional
+        The description of the download progress bar.
+
+    Returns
+    -------
+    The path of the downloaded file.
+    """
+    if num_connections < 1:
+        raise ValueError(f"Expected at least one connection, got {num_connections}.")
+    if chunk_size < 1:
+        raise ValueError(f"Expected a positive chunk size, got {chunk_size}.")
+
+    with _build_session(num_connections) as session:
+        url_, size, ranged, validator = _describe_remote(session, url)
+        desc = _download_description(desc, path, size)
+        if not ranged:
+            with tqdm(total = max(size, 0), desc = desc, unit = 'B',
+                      unit_scale = True) as progress:
+                try:
+                    _download_stream(session, url_, path, progress)
+                except BaseException:
+                    _remove_partial(path)
+                    raise
+        else:
+            info = {'url': url, 'size': size, 'chunk_size': chunk_size,
+                    'validator': validator}
+            completed = _load_progress(path, info)
+            if completed and (not os.path.exists(path + '.part')
+                              or os.path.getsize(path + '.part') != size):
+                completed = set()
+            if not completed:
+                with open(path + '.part', 'wb') as f:
+                    f.truncate(size)
+                _write_progress(path, info, completed)
+            chunks = [(i, i * chunk_size, min((i + 1) * chunk_size, size) - 1)
+                      for i in range((size + chunk_size - 1) // chunk_size)]
+            done_bytes = sum(end - start + 1 for i, start, end
+                             in chunks if i in completed)
+
+            def _download_chunk(chunk, counter):
+                _, start, end = chunk
+                _download_range(session, url_, path, start, end, counter)
+
+            with tqdm(total = size, initial = done_bytes, desc = desc,
+                      unit = 'B', unit_scale = True) as progress:
+                try:
+                    _run_resumable(
+                        _download_chunk,
+                        [c for c in chunks if c[0] not in completed],
+                        path, info, completed, num_connections,
+                        retries, progress)
+                except BaseException:
+                    # Without any completed chunks, there is nothing to resume.
+                    if not completed:
+                        _remove_partial(path)
+                    raise
+
+    # Verify the downloaded file. A corrupt file can't be resumed,
+    # so it is removed and the next download starts from scratch.
+    if size > 0 and os.path.getsize(path + '.part') != size:
+        _remove_partial(path)
+        raise IOError(f"The download of '{url}' has the wrong size, "
+                      f"expected {size} bytes. Please try again.")
+    if checksum is not None and not _verify_checksum(path + '.part', checksum):
+        _remove_partial(path)
+        raise IOError(f"The download of '{url}' doesn't match its "
+                      f"checksum. Please try downloading it again.")
+    os.replace(path + '.part', path)
+    if os.path.exists(_progress_path(path)):
+        os.remove(_progress_path(path))
+    return path
+
+
+def dataset_is_complete(path):
+    """Returns whether a downloaded dataset directory is complete.
+
+    When a dataset has been completely extracted, a marker file is written
+    into its directory. A dataset directory without the marker is complete
+    unless there is an unfinished download of it (a progress file next to
+    it), so that datasets from before the marker, and local datasets which
+    were never downloaded, are still found.
+    """
+    if not os.path.isdir(path):
+        return False
+    if os.path.exists(os.path.join(path, COMPLETE_MARKER)):
+        return True
+    return not os.path.exists(_progress_path(path.rstrip(os.sep) + '.zip'))
+
+
+def _mark_complete(path):
+    """Atomically writes the completion marker into a dataset directory."""
+    os.makedirs(path, exist_ok = True)
+    tmp_path = os.path.join(path, COMPLETE_MARKER + f'.tmp{os.getpid()}')
+    with open(tmp_path, 'w') as f:
+        json.dump({'completed': time.time()}, f)
+    os.replace(tmp_path, os.path.join(path, COMPLETE_MARKER))
+
+
+def _staging_path(archive_path):
+    """Returns the directory which an archive is extracted into at first."""
+    return archive_path + '.extracting'
+
+
+def _swap_in(staging_dir, dest_dir):
+    """Moves the contents of a staging directory into the destination.
+
+    Each existing entry which is replaced is first moved out of the way and
+    then removed, so an entry is either entirely old or entirely new.
+    """
+    for entry in os.listdir(staging_dir):
+        target = os.path.join(dest_dir, entry)
+        old_target = None
+        if os.path.lexists(target):
+            old_target = target + f'.old{os.getpid()}'
+            os.rename(target, old_target)
+        os.rename(os.path.join(staging_dir, entry), target)
+        if old_target is not None:
+            if os.path.isdir(old_target) and not os.path.islink(old_target):
+                shutil.rmtree(old_target)
+            else:
+                os.remove(old_target)
+    os.rmdir(staging_dir)
+
+
+def _member_path(dest_dir, name):
+    """Returns the path that an archive member is extracted to.
+
+    As in `zipfile`, absolute paths and parent directory components are
+    removed, so that members can't be extracted outside of `dest_dir`.
+    """
+    parts = [p for p in name.replace('\\', '/').split('/')
+             if p not in ('', '.', '..')]
+    if not parts:
+        return None
+    return os.path.join(dest_dir, *parts)
+
+
+def _write_member(info, blocks, dest_dir, decompress = True):
+    """Writes an archive member from a stream of (compressed) blocks.
+
+    The member is written to a temporary file which is moved into place
+    once it is complete (and its CRC is verified), so that each file only
+    becomes visible in the dataset directory once it has been extracted.
+    """
+    target = _member_path(dest_dir, info.filename)
+    if target is None or info.is_dir():
+        for _ in blocks:
+            pass
+        if target is not None:
+            os.makedirs(target, exist_ok = True)
+        return
+    os.makedirs(os.path.dirname(target), exist_ok = True)
+    decompressor = None
+    if decompress and info.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    crc, tmp_path = 0, target + f'.part{threading.get_ident()}'
+    try:
+        with open(tmp_path, 'wb') as f:
+            for block in blocks:
+                if decompressor is not None:
+                    block = decompressor.decompress(block)
+                crc = zlib.crc32(block, crc)
+                f.write(block)
+            if decompressor is not None:
+                block = decompressor.flush()
+                crc = zlib.crc32(block, crc)
+                f.write(block)
+        if crc != info.CRC:
+            raise IOError(f"The archive member '{info.filename}' is corrupt.")
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class _RangeFile(io.RawIOBase):
+    """A read-only, seekable file whose reads are HTTP range requests.
+
+    This is used to read the central directory of a remote zip archive
+    with `zipfile`, which only needs a few small reads from its end.
+    """
+    def __init__(self, session, url, size):
+        super().__init__()
+        self._session, self._url = session, url
+        self._size, self._position = size, 0
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def read(self, n = -1):
+        end = self._size if n is None or n < 0 \
+            else min(self._position + n, self._size)
+        if end <= self._position:
+            return b''
+        with _open_range(self._session, self._url,
+                         self._position, end - 1) as r:
+            data = r.content
+        self._position += len(data)
+        return data
+
+
+class _ResponseStream(object):
+    """Reads exact amounts of bytes from a streamed response."""
+    def __init__(self, response, progress):
+        self._blocks = response.iter_content(chunk_size = _STREAM_BLOCK_SIZE)
+        self._buffer = b''
+        self._progress = progress
+        self.position = 0
+
+    def _next_block(self):
+        block = next(self._blocks, b'')
+        if not block:
+            raise IOError("The archive download ended unexpectedly.")
+        self._progress.update(len(block))
+        return block
+
+    def blocks(self, n):
+        """Yields the next `n` bytes, in blocks."""
+        self.position += n
+        while n > 0:
+            if not self._buffer:
+                self._buffer = self._next_block()
+            block, self._buffer = self._buffer[:n], self._buffer[n:]
+            n -= len(block)
+            yield block
+
+    def read(self, n):
+        return b''.join(self.blocks(n))
+
+    def skip(self, n):
+        for _ in self.blocks(n):
+            pass
+
+
+def _group_members(infos, end_offset, chunk_size):
+    """Groups consecutive archive members into ranges of about `chunk_size`.
+
+    Returns a list of `(index, start, end, members)` groups, where the bytes
+    `start` to `end` (inclusive) contain all of the members in the group. A
+    member which is larger than `chunk_size` is in a group of its own.
+    """
+    infos = sorted(infos, key = lambda i: i.header_offset)
+    ends = [i.header_offset for i in infos[1:]] + [end_offset]
+    groups, members, start = [], [], None
+    for info, end in zip(infos, ends):
+        if members and end - start > chunk_size:
+            groups.append((len(groups), start, info.header_offset - 1, members))
+            members = []
+        if not members:
+            start = info.header_offset
+        members.append(info)
+    if members:
+        groups.append((len(groups), start, end_offset - 1, members))
+    return groups
+
+
+def _extract_group(session, url, group, dest_dir, progress):
+    """Downloads a group of archive members and extracts them as they arrive."""
+    _, start, end, members = group
+    with _open_range(session, url, start, end) as r:
+        stream = _ResponseStream(r, progress)
+        for info in members:
+            stream.skip(info.header_offset - start - stream.position)
+            header = stream.read(30)
+            if header[:4] != b'PK\x03\x04':
+                raise IOError(f"Invalid local header for the archive "
+                              f"member '{info.filename}'.")
+            stream.skip(int.from_bytes(header[26:28], 'little')
+                        + int.from_bytes(header[28:30], 'little'))
+            _write_member(info, stream.blocks(info.compress_size), dest_dir)
+
+
+def _extract_archive(path, dest_dir, num_workers):
+    """Extracts a local zip archive, with its members split between threads."""
+    with zipfile.ZipFile(path, 'r') as z:
+        infos = z.infolist()
+
+    def _extract(members):
+        # Each thread reads the archive through its own file handle.
+        with zipfile.ZipFile(path, 'r') as z:
+            for info in members:
+                with z.open(info) as f:
+                    _write_member(info, iter(lambda: f.read(
+                        _STREAM_BLOCK_SIZE), b''), dest_dir, decompress = False)
+
+    with ThreadPoolExecutor(max_workers = num_workers) as pool:
+        for _ in pool.map(_extract, [infos[i::num_workers]
+                                     for i in range(num_workers)]):
+            pass
+
+
+def download_and_extract(url, dest_dir, name, num_connections = 8,
+                         chunk_size = _DEFAULT_CHUNK_SIZE, checksum = None,
+                         retries = 3, desc = None):
+    """Downloads a zip archive and extracts it, overlapping the two.
+
+    If the server supports HTTP range requests, then the central directory of
+    the archive is read first (from the end of the archive), and its members
+    are split into groups of about `chunk_size` bytes. Each group is downloaded
+    by one of `num_connections` parallel connections and extracted while it is
+    streamed in, so the archive is never stored on disk. The completed groups
+    are recorded in a sidecar progress file (`<dest_dir>/<name>.zip.part.json`),
+    so an interrupted download resumes from the groups which are left.
+
+    Otherwise (or when a `checksum` of the entire archive has to be verified,
+    or the archive uses an unsupported compression), the archive is downloaded
+    with `download_file` and then extracted in parallel.
+
+    The archive is extracted into a staging directory next to it (see
+    `_staging_path`), and only once everything has been extracted is a
+    completion marker written and the contents moved into `dest_dir`,
+    replacing any existing copy of the dataset. So an existing copy stays
+    intact until then, and no stale files from it are left behind.
+    """
+    archive_path = os.path.join(dest_dir, name + '.zip')
+    staging_dir = _staging_path(archive_path)
+    completed = set()
+    try:
+        with _build_session(num_connections) as session:
+            url_, size, ranged, validator = _describe_remote(session, url)
+            infos = None
+            if ranged and checksum is None:
+                with zipfile.ZipFile(_RangeFile(session, url_, size), 'r') as z:
+                    infos, end_offset = z.infolist(), z.start_dir
+                if any(i.compress_type not in _STREAMABLE_METHODS
+                       or i.flag_bits & 0x1 for i in infos):
+                    infos = None
+
+            if infos is not None:
+                # The progress file is only written once the server has
+                # responded, and a partial extraction is only resumed if
+                # the groups which it recorded are still in the staging
+                # directory (otherwise, it starts again from scratch).
+                info = {'url': url, 'size': size, 'chunk_size': chunk_size,
+                        'validator': validator}
+                groups = _group_members(infos, end_offset, chunk_size)
+                completed = _load_progress(archive_path, info)
+                if not completed or not os.path.isdir(staging_dir):
+                    completed = set()
+                    shutil.rmtree(staging_dir, ignore_errors = True)
+                _write_progress(archive_path, info, completed)
+                done_bytes = sum(end - start + 1 for i, start, end, _
+                                 in groups if i in completed)
+
+                def _extract(group, counter):
+                    _extract_group(session, url_, group, staging_dir, counter)
+
+                with tqdm(total = end_offset, initial = done_bytes, unit = 'B',
+                          unit_scale = True, desc = _download_description(
+                            desc, archive_path, size)) as progress:
+                    _run_resumable(
+                        _extract, [g for g in groups if g[0] not in completed],
+                        archive_path, info, completed, num_connections,
+                        retries, progress)
+
+        # If the archive couldn't be streamed, it is downloaded and then
+        # extracted (an archive is only ever moved into place once it has been
+        # verified). It is downloaded under a separate name, since
+        # `download_file` keeps (and removes) its own progress file next to it.
+        if infos is None:
+            download_path = os.path.join(dest_dir, name + '.download.zip')
+            if not os.path.exists(download_path):
+                download_file(url, download_path,
+                              num_connections = num_connections,
+                              chunk_size = chunk_size, checksum = checksum,
+                              retries = retries, desc = desc)
+            shutil.rmtree(staging_dir, ignore_errors = True)
+            _extract_archive(download_path, staging_dir, num_connections)
+            os.remove(download_path)
+    except BaseException:
+        # A download which failed before any of it could be resumed
+        # (e.g., if the server couldn't be reached) leaves nothing behind.
+        if not completed:
+            shutil.rmtree(staging_dir, ignore_errors = True)
+            if os.path.exists(_progress_path(archive_path)):
+                os.remove(_progress_path(archive_path))
+        raise
+
+    _mark_complete(os.path.join(staging_dir, name))
+    _swap_in(staging_dir, dest_dir)
+    if os.path.exists(_progress_path(archive_path)):
+        os.remove(_progress_path(archive_path))
+
+
+def download_dataset(dataset_name, dest_dir, num_connections = 8,
+                     chunk_size = _DEFAULT_CHUNK_SIZE):
     """
     Downloads dataset from agdata-data s3 file storage.
 
+    The dataset is extracted while it is downloaded, in parallel chunks (see
+    `download_and_extract`), and if the download is interrupted, downloading
+    the dataset again resumes it.
+
     Parameters
     ----------
     dataset_name : str
         name of dataset to download
     dest_dir : str
         path for saving downloaded dataset
+    num_connections : int
+        number of parallel connections to download with
+    chunk_size : int
+        size of each of the chunks the dataset is downloaded in, in bytes
     """
-    import requests
-
     # Validate dataset name
     source_info = load_public_sources()
     if dataset_name not in source_info.keys():
@@ -48,48 +676,23 @@ def download_dataset(dataset_name, dest_dir):
                 f"'{dataset_name.replace('-', '_')}.'")
             dataset_name = dataset_name.replace('-', '_')
 
-    # Connect to S3 and generate unsigned URL for bucket object
-    url = f"https://agdata-data.s3.us-west-1.amazonaws.com/{dataset_name}.zip"
+    # Generate the unsigned URL for the bucket object
+    url = _DATASET_URL.format(dataset_name)
 
     # File path of zipped dataset
     if dataset_name in dest_dir:
         dest_dir = os.path.dirname(dest_dir)
     os.makedirs(dest_dir, exist_ok = True)
-    dataset_download_path = os.path.join(
-        dest_dir, dataset_name + '.zip')
-
-    # Download object from bucket
-    try:
-        with requests.Session() as sess:
-            r = sess.get(url, stream = True)
-            r.raise_for_status()
-            content_size = int(r.headers['Content-Length'])
-            pg = tqdm(total = content_size,
-                      desc = f"Downloading {dataset_name} "
-                             f"(size = {round(content_size/ 1000000, 1)} MB)")
-            with open(dataset_download_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size = 8192):
-                    f.write(chunk)
-                    pg.update(8192)
-            pg.close()
-    except BaseException as e:
-        try:
-            pg.close()
-        except (NameError, UnboundLocalError):
-            pass
-        if os.path.exists(dataset_download_path):
-            os.remove(dataset_download_path)
-        raise e
-
-    # Unzip downloaded dataset
-    with zipfile.ZipFile(dataset_download_path, 'r') as z:
-        print(f'[AgML Download]: Extracting files for {dataset_name}... ', end = '')
-        z.extractall(path = dest_dir)
-        print('Done!')
 
-    # Delete zipped file
-    if os.path.exists(dataset_download_path):
-        os.remove(dataset_download_path)
+    # Download and extract the object from the bucket (verifying it against
+    # its checksum, if one is listed for the dataset). A partial download is
+    # kept to be resumed, and the dataset is only marked as complete once
+    # all of its files have been extracted.
+    download_and_extract(url, dest_dir, dataset_name,
+                         num_connections = num_connections,
+                         chunk_size = chunk_size,
+                         checksum = source_info[dataset_name].get('checksum', None),
+                         desc = f"Downloading {dataset_name}")
 
     # Print dataset copyright info
-    copyright_print(dataset_name, os.path.splitext(dataset_download_path)[0])
+    copyright_print(dataset_name, os.path.join(dest_dir, dataset_name))
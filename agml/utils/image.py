@@ -15,6 +15,7 @@
 import os
 
 import cv2
+import numpy as np
 
 
 def consistent_shapes(objects):
@@ -32,6 +33,161 @@ def consistent_shapes(objects):
             return False
 
 
+def ensure_writeable(image):
+    """Returns a writeable version of the image, copying only if needed."""
+    if isinstance(image, np.ndarray) and not image.flags.writeable:
+        return image.copy()
+    return image
+
+
+# The JPEG start-of-frame markers, which contain the image dimensions.
+# These are `0xC0` to `0xCF`, except for DHT (`0xC4`), JPG (`0xC8`),
+# and DAC (`0xCC`), which are other markers in the same range.
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class _HeaderReader(object):
+    """Reads sequential chunks from either an open file or a buffer."""
+    def __init__(self, source):
+        self._file, self._buffer, self._position = None, None, 0
+        if hasattr(source, 'read'):
+            self._file = source
+        else:
+            self._buffer = memoryview(source).cast('B')
+
+    def read(self, n):
+        if self._file is not None:
+            return self._file.read(n)
+        chunk = self._buffer[self._position:self._position + n]
+        self._position += n
+        return bytes(chunk)
+
+    def skip(self, n):
+        if self._file is not None:
+            self._file.seek(n, os.SEEK_CUR)
+        else:
+            self._position += n
+
+
+def _parse_jpeg_header(reader):
+    if reader.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        marker = reader.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        while code == 0xFF: # padding before a marker
+            byte = reader.read(1)
+            if not byte:
+                return None
+            code = byte[0]
+        # Markers without a length (and the end of the headers).
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            continue
+        if code in (0xD9, 0xDA):
+            return None
+        length = reader.read(2)
+        if len(length) < 2:
+            return None
+        length = int.from_bytes(length, 'big')
+        if code in _JPEG_SOF_MARKERS:
+            # The precision, height, width, and number of components.
+            data = reader.read(6)
+            if len(data) < 6:
+                return None
+            height = int.from_bytes(data[1:3], 'big')
+            width = int.from_bytes(data[3:5], 'big')
+            return width, height, data[5]
+        reader.skip(length - 2)
+
+
+# The number of channels of each PNG color type (grayscale, RGB,
+# palette, grayscale with alpha, and RGBA). Palette images are
+# decoded as RGB images, so they have three channels.
+_PNG_COLOR_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+
+def _parse_png_header(reader):
+    # The signature, then the length and type of the IHDR chunk (which
+    # is always the first chunk), followed by the width, height, bit
+    # depth, and color type of the image.
+    data = reader.read(26)
+    if len(data) < 26 or data[:8] != b'\x89PNG\r\n\x1a\n' \
+            or data[12:16] != b'IHDR':
+        return None
+    width = int.from_bytes(data[16:20], 'big')
+    height = int.from_bytes(data[20:24], 'big')
+    channels = _PNG_COLOR_CHANNELS.get(data[25], None)
+    if channels is None:
+        return None
+    return width, height, channels
+
+
+def _parse_image_header(reader):
+    start = reader.read(2)
+    if len(start) < 2:
+        return None
+    reader.skip(-2)
+    if start == b'\xff\xd8':
+        return _parse_jpeg_header(reader)
+    if start == b'\x89P':
+        return _parse_png_header(reader)
+    return None
+
+
+def read_image_header(source):
+    """Returns the `(width, height, channels)` of an image from its header.
+
+    This supports JPEG images (from their start-of-frame marker) and PNG
+    images (from their IHDR chunk), and only reads the first few bytes of
+    the file rather than decoding the image. The `source` can either be
+    the path to the image, or a buffer containing the encoded contents of
+    the file. If the source isn't a JPEG or PNG image, this returns `None`.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return _parse_image_header(_HeaderReader(f))
+    return _parse_image_header(_HeaderReader(source))
+
+
+def reduced_decode_factor(source_size, target_size):
+    """Returns the largest JPEG decoding scale factor for a target size.
+
+    JPEG images can be decoded directly at 1/2, 1/4, or 1/8 of their full
+    resolution (by skipping the high frequency coefficients), which is much
+    faster than a full decode. This returns the largest of these factors
+    for which the reduced image is still at least as large as the target
+    `(width, height)` in both dimensions, or 1 if none of them are.
+    """
+    (width, height), (t_width, t_height) = source_size, target_size
+    for factor in (8, 4, 2):
+        if width >= factor * t_width and height >= factor * t_height:
+            return factor
+    return 1
+
+
+# The `cv2.imread` flags to decode a JPEG at a reduced resolution. The
+# EXIF orientation is ignored, like with `cv2.IMREAD_UNCHANGED`.
+REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2 | cv2.IMREAD_IGNORE_ORIENTATION,
+    4: cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_IGNORE_ORIENTATION,
+    8: cv2.IMREAD_REDUCED_COLOR_8 | cv2.IMREAD_IGNORE_ORIENTATION}
+
+
+def bgr_to_rgb(image):
+    """Converts a BGR image to RGB, in-place when possible.
+
+    Three-channel images (which are freshly decoded, and thus owned by the
+    caller) have their channels swapped in-place, without allocating a new
+    image. Other images (e.g., with an alpha channel) are converted to a
+    new three-channel RGB image, as with `cv2.cvtColor`.
+    """
+    if image.ndim == 3 and image.shape[2] == 3 and image.flags.writeable:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst = image)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
 def needs_batch_dim(image):
     """Determines whether an image has or is missing a batch dimension."""
     if not hasattr(image, 'shape'):
@@ -57,18 +213,12 @@ class imread_context(object):
     """
     def __init__(self, path, flags = None):
         self._path = path
-        if not os.path.exists(path):
-            raise ValueError(
-                f"The image path '{path}' does not exist. "
-                f"Please check the dataset you are using, "
-                f"and if files are missing, re-download it.")
         self.flags = flags
         if self.flags is None:
             self.flags = cv2.IMREAD_UNCHANGED
 
     def __enter__(self):
         try:
-
             img = cv2.imread(self._path, self.flags)
         except cv2.error:
             raise ValueError(
@@ -77,6 +227,13 @@ class imread_context(object):
                 f"using and re-download it if files are missing.")
         else:
             if img is None:
+                # The existence of the file is only checked once reading
+                # has failed, so that a successful read is one syscall.
+                if not os.path.exists(self._path):
+                    raise ValueError(
+                        f"The image path '{self._path}' does not exist. "
+                        f"Please check the dataset you are using, "
+                        f"and if files are missing, re-download it.")
                 raise ValueError(
                     f"The image at '{self._path}' is empty,"
                     f" corrupted, or could not be read. Please "
@@ -87,3 +244,31 @@ class imread_context(object):
         pass
 
 
+class imdecode_context(object):
+    """Wraps the `cv2.imdecode` function into a context.
+
+    This is the equivalent of `imread_context` for images which have
+    already been read into memory as an encoded buffer (for example,
+    from a packed dataset), with the same detailed error messages.
+    """
+    def __init__(self, buffer, path, flags = None):
+        self._buffer = buffer
+        self._path = path
+        self.flags = flags
+        if self.flags is None:
+            self.flags = cv2.IMREAD_UNCHANGED
+
+    def __enter__(self):
+        try:
+            img = cv2.imdecode(self._buffer, self.flags)
+        except cv2.error:
+            img = None
+        if img is None:
+            raise ValueError(
+                f"The image at '{self._path}' is empty,"
+                f" corrupted, or could not be read. Please "
+                f"re-download the dataset you are using.")
+        return img
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
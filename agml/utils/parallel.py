@@ -0,0 +1,111 @@
+# Copyright 2021 UC Davis Plant AI and Biophysics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def default_num_workers(limit = None):
+    """Returns a sensible default number of workers for this machine."""
+    count = os.cpu_count() or 1
+    if limit is not None:
+        count = min(count, limit)
+    return max(count, 1)
+
+
+def build_executor(kind, num_workers = None, initializer = None, initargs = ()):
+    """Builds a `concurrent.futures` executor of the given kind.
+
+    Parameters
+    ----------
+    kind : str
+        Either 'thread' for a thread pool, or 'process' for a process pool.
+    num_workers : int, optional
+        The number of workers in the pool, defaults to the number of cores.
+    initializer : callable, optional
+        A method which is called with `initargs` when each worker starts.
+    initargs : tuple
+        The arguments passed to the `initializer`.
+
+    Returns
+    -------
+    A `ThreadPoolExecutor` or `ProcessPoolExecutor`.
+    """
+    if num_workers is None:
+        num_workers = default_num_workers()
+    if kind == 'thread':
+        return ThreadPoolExecutor(
+            max_workers = num_workers, thread_name_prefix = 'agml-worker',
+            initializer = initializer, initargs = initargs)
+    elif kind == 'process':
+        return ProcessPoolExecutor(
+            max_workers = num_workers, initializer = initializer,
+            initargs = initargs)
+    raise ValueError(f"Invalid executor kind '{kind}', expected "
+                     f"either 'thread' or 'process'.")
+
+
+def prefetch_iterator(fn, indexes, depth = 2, num_threads = None):
+    """Iterates over `fn(index)` for each index, loading ahead in threads.
+
+    A bounded queue of at most `depth` pending results is kept filled
+    by a pool of `num_threads` worker threads, so that the work for
+    upcoming items overlaps with the consumer's work on the current
+    one. Results are yielded in the same order as `indexes`, and an
+    exception raised in a worker is re-raised to the caller when the
+    corresponding item is reached.
+
+    Parameters
+    ----------
+    fn : callable
+        The method which loads a single item from its index.
+    indexes : iterable
+        The indexes to load, in the order they should be yielded.
+    depth : int
+        The maximum number of items which are loaded ahead of time.
+    num_threads : int, optional
+        The number of worker threads (defaults to `depth`, bounded by
+        the number of available cores).
+
+    Returns
+    -------
+    A generator which yields the loaded items in order.
+    """
+    if depth < 1:
+        raise ValueError(f"Expected a prefetch depth of at least 1, got {depth}.")
+    if num_threads is None:
+        num_threads = default_num_workers(limit = depth)
+
+    indexes = iter(indexes)
+    executor = ThreadPoolExecutor(
+        max_workers = num_threads, thread_name_prefix = 'agml-prefetch')
+    pending = collections.deque()
+    try:
+        for index in itertools.islice(indexes, depth):
+            pending.append(executor.submit(fn, index))
+        while pending:
+            # Getting the result re-raises any exception from the worker.
+            result = pending.popleft().result()
+            for index in itertools.islice(indexes, 1):
+                pending.append(executor.submit(fn, index))
+            yield result
+    finally:
+        # If iteration stops early (e.g., a `break` or an exception), we
+        # don't want to keep loading data which will never be consumed.
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait = True)
+
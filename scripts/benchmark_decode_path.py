@@ -0,0 +1,116 @@
+# Copyright 2021 UC Davis Plant AI and Biophysics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks the memory allocated by the image decoding path, per sample.
+
+This compares the previous decoding path (an existence check, `cv2.imread`,
+a copying BGR -> RGB conversion, resizing, and a per-image float conversion
+to PyTorch which is then stacked into a batch) against the current one (an
+in-place colour conversion and a single-pass conversion of the entire batch).
+
+NumPy/OpenCV allocations are measured with `tracemalloc` (as the peak memory
+while loading a batch), and PyTorch allocations with the PyTorch profiler.
+"""
+
+import os
+import time
+import argparse
+import tracemalloc
+
+import cv2
+import numpy as np
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+import agml
+from agml.data.object import DataObject
+from agml.utils.image import bgr_to_rgb
+from agml.backend.tftorch import _convert_image_batch_to_torch # noqa
+
+ap = argparse.ArgumentParser()
+ap.add_argument('--dataset', type = str, default = 'bean_disease_uganda',
+                help = 'The image classification dataset to benchmark with.')
+ap.add_argument('--image-size', type = int, nargs = 2, default = (224, 224),
+                help = 'The size that images are resized to.')
+ap.add_argument('--batch-size', type = int, default = 16,
+                help = 'The number of images in each batch.')
+ap.add_argument('--batches', type = int, default = 8,
+                help = 'The number of batches to benchmark.')
+args = ap.parse_args()
+
+
+def legacy_load(path, image_size):
+    if not os.path.exists(path):
+        raise ValueError(f"The image path '{path}' does not exist.")
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return cv2.resize(image, image_size)
+
+
+def legacy_to_torch(images):
+    return torch.stack([torch.from_numpy(image).permute(2, 0, 1).float()
+                        for image in images])
+
+
+def current_load(path, image_size):
+    image = bgr_to_rgb(DataObject._read_image(path)) # noqa
+    return cv2.resize(image, image_size)
+
+
+def current_to_torch(images):
+    return _convert_image_batch_to_torch(images)
+
+
+def measure(load_fn, convert_fn, batches, image_size):
+    numpy_peaks, torch_bytes, start = [], [], time.perf_counter()
+    for paths in batches:
+        tracemalloc.start()
+        images = np.array([load_fn(path, image_size) for path in paths])
+        numpy_peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        with profile(activities = [ProfilerActivity.CPU],
+                     profile_memory = True) as prof:
+            convert_fn(images)
+        torch_bytes.append(sum(max(e.self_cpu_memory_usage, 0)
+                               for e in prof.key_averages()))
+    elapsed = time.perf_counter() - start
+    num_samples = sum(len(b) for b in batches)
+    return (np.sum(numpy_peaks) / num_samples,
+            np.sum(torch_bytes) / num_samples,
+            elapsed / num_samples)
+
+
+loader = agml.data.AgMLDataLoader(args.dataset)
+if loader.task != 'image_classification':
+    raise ValueError("The benchmark expects an image classification dataset.")
+paths = [os.path.abspath(obj._image_object) # noqa
+         for obj in loader._manager._data_objects] # noqa
+paths = paths[:args.batch_size * args.batches]
+batches = [paths[i:i + args.batch_size]
+           for i in range(0, len(paths), args.batch_size)]
+image_size = tuple(args.image_size)
+
+# Warm up the page cache, so that both paths read files from memory.
+measure(current_load, current_to_torch, batches[:1], image_size)
+
+print(f"{'path':<10}{'numpy peak/sample':>20}"
+      f"{'torch bytes/sample':>20}{'ms/sample':>12}")
+for name, load_fn, convert_fn in [
+        ('legacy', legacy_load, legacy_to_torch),
+        ('current', current_load, current_to_torch)]:
+    numpy_bytes, torch_bytes, seconds = measure(
+        load_fn, convert_fn, batches, image_size)
+    print(f"{name:<10}{numpy_bytes:>20,.0f}"
+          f"{torch_bytes:>20,.0f}{seconds * 1000:>12.2f}")
@@ -14,6 +14,9 @@
 
 """
 Generates the normalization info for new or changed datasets.
+
+The mean and standard deviation are the exact statistics of all of the pixels
+in each dataset (see `agml.data.compute_statistics`), computed in parallel.
 """
 
 import os
@@ -22,7 +25,6 @@ import shutil
 import argparse
 
 import agml
-import numpy as np
 from tqdm import tqdm
 
 # Parse input arguments (get the datasets to re-generate).
@@ -59,19 +61,9 @@ for ds in tqdm(datasets, desc = 'Processing Datasets'):
         leave = False
     loader = agml.data.AgMLDataLoader(ds)
 
-    # Get the mean/std of individual images.
-    num_images, mean, std = 0, 0., 0.
-    for contents in tqdm(loader, desc = 'Loader Iteration', leave = False):
-        num_images += 1
-        image, _ = contents # noqa
-        if isinstance(image, dict):
-            image = image['image']
-        image = (image / 255).astype(np.float32)
-        image = np.reshape(np.transpose(image, (2, 0, 1)), (3, -1))
-        mean += image.mean(-1)
-        std += image.std(-1)
-    mean = tuple((mean / num_images).tolist()) # noqa
-    std = tuple((std / num_images).tolist()) # noqa
+    # Get the exact mean/std of all of the pixels in the dataset.
+    statistics = agml.data.compute_statistics(loader)
+    mean, std = statistics.mean.tolist(), statistics.std.tolist()
     source_info[loader.name]['stats'] = {
         'mean': tuple(mean),
         'std': tuple(std)
@@ -14,6 +14,10 @@
 
 """
 Generates the shape information file for new datasets or changed datasets.
+
+The shapes are read from the image headers of each dataset (the same index
+that is used for 'auto' resizing), rather than by decoding every image, and
+are stored as the unique `(height, width, channels)` with their counts.
 """
 
 import os
@@ -52,18 +56,14 @@ if datasets[0] == 'all':
 for ds in tqdm(datasets, desc = 'Processing Datasets'):
     if hasattr(ds, 'name'):
         ds = ds.name
-    current_shapes, leave = [], True
+    leave = True
     if not os.path.exists(os.path.join(
             os.path.expanduser('~'), '.agml', 'datasets', ds)):
         leave = False
     loader = agml.data.AgMLDataLoader(ds)
-    for contents in tqdm(loader, desc = 'Loader Iteration', leave = False):
-        image, _ = contents
-        if isinstance(image, dict):
-            image = image['image']
-        current_shapes.append(image.shape)
+    shapes = loader._manager.image_shapes() # noqa
     shape_contents[loader.name] = np.unique(
-        current_shapes, return_counts = True, axis = 0)
+        shapes[:, [1, 0, 2]], return_counts = True, axis = 0)
     if not leave:
         shutil.rmtree(loader.dataset_root)
 
@@ -80,3 +80,34 @@ def test_coco_formatting_minmax():
         eg_box, 'x1 x2 y1 y2') == eg_output)
 
 
+def test_convert_bboxes_formats(coco_example):
+    bboxes = agdata.coco_to_bboxes(coco_example)[0]
+    voc = agdata.convert_bboxes(bboxes, 'coco', 'pascal_voc')
+    assert np.all(voc[:, 2:] == bboxes[:, :2] + bboxes[:, 2:])
+    yolo = agdata.convert_bboxes(voc, 'xyxy', 'yolo')
+    assert np.allclose(yolo[:, :2], bboxes[:, :2] + bboxes[:, 2:] / 2)
+    assert np.allclose(agdata.convert_bboxes(yolo, 'cxcywh', 'coco'), bboxes)
+
+
+def test_bbox_iou_clip_and_normalize():
+    bboxes = np.array([[0, 0, 10, 10], [5, 0, 10, 10], [20, 20, 5, 5]])
+    iou = agdata.bbox_iou(bboxes, bboxes)
+    assert np.allclose(np.diag(iou), 1)
+    assert np.isclose(iou[0, 1], 50 / 150) and iou[0, 2] == 0
+    assert agdata.clip_bboxes(bboxes, (22, 22)).tolist()[2] == [20, 20, 2, 2]
+    normalized = agdata.normalize_bboxes(bboxes, (20, 10))
+    assert normalized.min() >= 0 and normalized.max() <= 1
+    assert np.allclose(agdata.denormalize_bboxes(
+        normalized[:2], (20, 10)), bboxes[:2])
+
+
+def test_non_max_suppression():
+    bboxes = np.array([[2, 3, 10, 10], [1, 1, 10, 10], [2, 2, 10, 10],
+                       [50, 50, 10, 10], [9, 0, 10, 10]])
+    scores = np.array([0.9, 0.8, 0.95, 0.5, 0.7])
+    assert agdata.non_max_suppression(
+        bboxes, scores, 0.5).tolist() == [2, 4, 3]
+    # Boxes with different labels don't suppress each other.
+    labels = np.array([0, 1, 0, 0, 0])
+    assert agdata.non_max_suppression(
+        bboxes, scores, 0.5, labels = labels).tolist() == [2, 1, 4, 3]
@@ -12,15 +12,78 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import os
 import time
 import shutil
+import hashlib
+import zipfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
 import pytest
 
 import agml.data as agdata
+from agml.utils import downloads
 from agml.utils.data import load_public_sources
 
 
+class _RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves the `content` of the server, with support for HTTP ranges.
+
+    Range requests starting at any of the offsets in `server.fail_starts`
+    send half of their range and then drop the connection (once for each
+    offset), to simulate an interrupted download.
+    """
+    def log_message(self, *args):
+        pass
+
+    def _send_headers(self, status, length, extra = None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"test"')
+        for key, value in (extra or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def do_HEAD(self): # noqa
+        self._send_headers(200, len(self.server.content))
+
+    def do_GET(self): # noqa
+        content = self.server.content
+        requested = self.headers.get('Range', None)
+        if requested is None:
+            self._send_headers(200, len(content))
+            self.wfile.write(content)
+            return
+        start, end = (int(i) for i in requested.split('=')[1].split('-'))
+        data = content[start:end + 1]
+        with self.server.lock:
+            self.server.ranges.append((start, end))
+            fail = start in self.server.fail_starts
+            self.server.fail_starts.discard(start)
+        self._send_headers(206, len(data), {
+            'Content-Range': f'bytes {start}-{end}/{len(content)}'})
+        if fail:
+            self.wfile.write(data[:len(data) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _RangeRequestHandler)
+    server.content, server.fail_starts, server.ranges = b'', set(), []
+    server.lock = threading.Lock()
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 def test_location_filters():
     uganda_filter = agdata.public_data_sources(
         location = 'country:uganda')
@@ -42,3 +105,143 @@ def test_source_download():
     assert os.path.exists(os.path.join(local_path, 'bean_disease_uganda'))
     assert not os.path.exists(os.path.join(local_path, 'bean_disease_uganda.zip'))
     shutil.rmtree(os.path.join(local_path))
+
+
+def test_resumable_download(local_server, tmp_path):
+    content = os.urandom(1000003)
+    local_server.content = content
+    local_server.fail_starts = {100000, 500000}
+    url = f'http://127.0.0.1:{local_server.server_address[1]}/data.zip'
+    path = str(tmp_path / 'data.zip')
+
+    # Interrupted chunks aren't retried, so the download fails, but
+    # the completed chunks are kept (and recorded) to be resumed.
+    with pytest.raises(IOError):
+        downloads.download_file(url, path, num_connections = 4,
+                                chunk_size = 100000, retries = 0)
+    assert os.path.exists(path + '.part') and os.path.exists(path + '.part.json')
+    num_requests = len(local_server.ranges)
+    downloads.download_file(url, path, num_connections = 4, chunk_size = 100000,
+                            checksum = hashlib.sha256(content).hexdigest())
+    with open(path, 'rb') as f:
+        assert f.read() == content
+    assert not os.path.exists(path + '.part.json')
+    assert len(local_server.ranges) - num_requests < 11
+
+    # A checksum mismatch removes the download.
+    os.remove(path)
+    with pytest.raises(IOError):
+        downloads.download_file(url, path, checksum = 'md5:0')
+    assert not os.path.exists(path) and not os.path.exists(path + '.part')
+
+
+def _build_archive(name):
+    """Builds a zip archive of a small dataset, with mixed compression."""
+    buffer, files = io.BytesIO(), {}
+    with zipfile.ZipFile(buffer, 'w') as z:
+        for i in range(20):
+            path = f'{name}/images/{i}.bin'
+            files[path] = os.urandom(5000) if i % 2 else bytes(20000)
+            z.writestr(path, files[path], compress_type = zipfile.ZIP_STORED
+                       if i % 2 else zipfile.ZIP_DEFLATED)
+    return buffer.getvalue(), files
+
+
+def test_streamed_extraction(local_server, tmp_path):
+    local_server.content, files = _build_archive('dataset')
+    with zipfile.ZipFile(io.BytesIO(local_server.content)) as z:
+        groups = downloads._group_members( # noqa
+            z.infolist(), z.start_dir, 10000)
+    local_server.fail_starts = {groups[-1][1]}
+    url = f'http://127.0.0.1:{local_server.server_address[1]}/dataset.zip'
+
+    # The last group is interrupted, which fails the download, but the other
+    # groups are extracted (into the staging directory), and the dataset
+    # isn't moved into place until the download resumes.
+    with pytest.raises(IOError):
+        downloads.download_and_extract(
+            url, str(tmp_path), 'dataset', num_connections = 1,
+            chunk_size = 10000, retries = 0)
+    assert not downloads.dataset_is_complete(str(tmp_path / 'dataset'))
+    staging = tmp_path / 'dataset.zip.extracting' / 'dataset' / 'images'
+    assert os.path.exists(staging / '0.bin')
+    assert not os.path.exists(staging / '19.bin')
+    num_requests = len(local_server.ranges)
+    downloads.download_and_extract(
+        url, str(tmp_path), 'dataset', chunk_size = 10000)
+    assert downloads.dataset_is_complete(str(tmp_path / 'dataset'))
+    resumed = local_server.ranges[num_requests:]
+    assert sum(start < groups[-1][1] for start, _ in resumed) == 0
+    for path, contents in files.items():
+        with open(tmp_path / path, 'rb') as f:
+            assert f.read() == contents
+    assert os.listdir(tmp_path) == ['dataset']
+
+    # With a checksum, the archive is downloaded and then extracted.
+    downloads.download_and_extract(
+        url, str(tmp_path), 'dataset', num_connections = 3, checksum = hashlib.sha256(
+            local_server.content).hexdigest())
+    assert downloads.dataset_is_complete(str(tmp_path / 'dataset'))
+    assert sorted(os.listdir(tmp_path)) == ['dataset']
+
+
+def test_interrupted_overwrite(local_server, tmp_path, monkeypatch):
+    local_server.content, files = _build_archive('dataset')
+    url = f'http://127.0.0.1:{local_server.server_address[1]}/dataset.zip'
+    checksum = hashlib.sha256(local_server.content).hexdigest()
+    downloads.download_and_extract(url, str(tmp_path), 'dataset')
+    assert downloads.dataset_is_complete(str(tmp_path / 'dataset'))
+
+    # Overwriting the dataset is interrupted before the server responds
+    # (which leaves nothing behind), and then after the archive is
+    # downloaded (but before it is extracted), and the existing copy of
+    # the dataset is kept intact in between.
+    def _interrupt(*args, **kwargs):
+        raise IOError("The download was interrupted.")
+
+    monkeypatch.setattr(downloads, '_describe_remote', _interrupt)
+    with pytest.raises(IOError):
+        downloads.download_and_extract(url, str(tmp_path), 'dataset')
+    assert downloads.dataset_is_complete(str(tmp_path / 'dataset'))
+    assert sorted(os.listdir(tmp_path)) == ['dataset']
+    with pytest.raises(IOError):
+        downloads.download_and_extract(url, str(tmp_path), 'missing')
+    assert sorted(os.listdir(tmp_path)) == ['dataset']
+    monkeypatch.undo()
+
+    download_file = downloads.download_file
+
+    def _interrupt_after(*args, **kwargs):
+        download_file(*args, **kwargs)
+        _interrupt()
+
+    monkeypatch.setattr(downloads, 'download_file', _interrupt_after)
+    with pytest.raises(IOError):
+        downloads.download_and_extract(
+            url, str(tmp_path), 'dataset', checksum = checksum)
+    assert downloads.dataset_is_complete(str(tmp_path / 'dataset'))
+    monkeypatch.undo()
+
+    # The overwritten dataset replaces the existing copy entirely.
+    with open(tmp_path / 'dataset' / 'images' / 'stale.bin', 'wb') as f:
+        f.write(b'stale')
+    downloads.download_and_extract(
+        url, str(tmp_path), 'dataset', checksum = checksum)
+    assert downloads.dataset_is_complete(str(tmp_path / 'dataset'))
+    assert sorted(os.listdir(tmp_path)) == ['dataset']
+    assert sorted(os.listdir(tmp_path / 'dataset' / 'images')) == \
+           sorted(os.path.basename(path) for path in files)
+
+
+def test_dataset_download_local(local_server, tmp_path, monkeypatch):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as z:
+        z.writestr('bean_disease_uganda/images/a.txt', 'contents')
+    local_server.content = buffer.getvalue()
+    monkeypatch.setattr(downloads, '_DATASET_URL', f'http://127.0.0.1:'
+                        f'{local_server.server_address[1]}/{{}}.zip')
+    downloads.download_dataset('bean_disease_uganda', str(tmp_path),
+                               num_connections = 2, chunk_size = 64)
+    assert os.path.exists(tmp_path / 'bean_disease_uganda' / 'images' / 'a.txt')
+    assert downloads.dataset_is_complete(str(tmp_path / 'bean_disease_uganda'))
+    assert not os.path.exists(tmp_path / 'bean_disease_uganda.zip')